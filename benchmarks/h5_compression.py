@@ -0,0 +1,105 @@
+"""Benchmark the write/read throughput and file size of the .h5 compression options of PipelineStep
+
+Usage:
+    python benchmarks/h5_compression.py --image_size 4096 --nr_instances 20000 --repeats 3
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from histocartography.pipeline import get_dataset_options
+
+CODECS = {
+    "none": dict(compression=None),
+    "lzf": dict(compression="lzf"),
+    "lzf+shuffle": dict(compression="lzf", shuffle=True),
+    "gzip-1": dict(compression="gzip", compression_level=1),
+    "gzip-1+shuffle": dict(compression="gzip", compression_level=1, shuffle=True),
+    "gzip-4": dict(compression="gzip", compression_level=4),
+    "gzip-4+shuffle": dict(compression="gzip", compression_level=4, shuffle=True),
+    "gzip-9": dict(compression="gzip", compression_level=9),
+}
+
+
+def make_instance_map(image_size: int, nr_instances: int, seed: int = 0) -> np.ndarray:
+    """Generate a uint16 instance map with elliptic nuclei-like instances on a background of 0"""
+    rng = np.random.default_rng(seed)
+    instance_map = np.zeros((image_size, image_size), dtype=np.uint16)
+    radius = 6
+    yy, xx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    for label in range(1, nr_instances + 1):
+        a, b = rng.uniform(3, radius, size=2)
+        shape = (yy / a) ** 2 + (xx / b) ** 2 <= 1
+        y, x = rng.integers(radius, image_size - radius, size=2)
+        window = instance_map[y - radius:y + radius + 1, x - radius:x + radius + 1]
+        window[shape] = label
+    return instance_map
+
+
+def make_features(nr_instances: int, nr_features: int, seed: int = 0) -> np.ndarray:
+    """Generate float32 features resembling pooled post-ReLU CNN embeddings"""
+    rng = np.random.default_rng(seed)
+    features = rng.standard_normal((nr_instances, nr_features)).astype(np.float32)
+    return np.maximum(features, 0)
+
+
+def benchmark(data: np.ndarray, options: dict, out_dir: str, repeats: int) -> dict:
+    """Measure write and read throughput (MB/s) and file size (MB) of a dataset for given options"""
+    path = os.path.join(out_dir, "benchmark.h5")
+    size_mb = data.nbytes / 1e6
+    write_times, read_times = list(), list()
+    for _ in range(repeats):
+        if os.path.exists(path):
+            os.remove(path)
+        start = time.perf_counter()
+        with h5py.File(path, "w") as output_file:
+            output_file.create_dataset(
+                "default_key_0", data=data, **get_dataset_options(data, **options)
+            )
+        write_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        with h5py.File(path, "r") as input_file:
+            reloaded = input_file["default_key_0"][()]
+        read_times.append(time.perf_counter() - start)
+    assert np.array_equal(reloaded, data)
+    file_size_mb = os.path.getsize(path) / 1e6
+    return {
+        "write": size_mb / min(write_times),
+        "read": size_mb / min(read_times),
+        "file": file_size_mb,
+        "ratio": size_mb / file_size_mb,
+    }
+
+
+def main(args: argparse.Namespace) -> None:
+    datasets = {
+        "instance map": make_instance_map(args.image_size, args.nr_instances),
+        "features": make_features(args.nr_instances, args.nr_features),
+    }
+    out_dir = tempfile.mkdtemp()
+    try:
+        for name, data in datasets.items():
+            print(f"\n{name}: shape={data.shape}, dtype={data.dtype}, {data.nbytes / 1e6:.1f} MB")
+            print(f"{'codec':<16}{'write MB/s':>12}{'read MB/s':>12}{'file MB':>10}{'ratio':>8}")
+            for codec, options in CODECS.items():
+                res = benchmark(data, options, out_dir, args.repeats)
+                print(
+                    f"{codec:<16}{res['write']:>12.1f}{res['read']:>12.1f}"
+                    f"{res['file']:>10.2f}{res['ratio']:>8.1f}"
+                )
+    finally:
+        shutil.rmtree(out_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--image_size", type=int, default=4096)
+    parser.add_argument("--nr_instances", type=int, default=20000)
+    parser.add_argument("--nr_features", type=int, default=512)
+    parser.add_argument("--repeats", type=int, default=3)
+    main(parser.parse_args())
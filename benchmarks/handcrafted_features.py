@@ -0,0 +1,56 @@
+"""Benchmark the bulk against the per-region extraction of handcrafted features for growing nucleus counts
+
+Usage:
+    python benchmarks/handcrafted_features.py --nr_nuclei 1000 5000 20000
+"""
+import argparse
+import time
+import warnings
+
+import numpy as np
+
+from histocartography.preprocessing import HandcraftedFeatureExtractor
+
+
+def make_inputs(nr_nuclei: int, seed: int = 0):
+    """Generate an RGB image and an instance map with non-overlapping elliptic nuclei on a grid"""
+    rng = np.random.default_rng(seed)
+    cell = 24
+    grid = int(np.ceil(np.sqrt(nr_nuclei)))
+    size = grid * cell
+    instance_map = np.zeros((size, size), dtype=np.int32)
+    yy, xx = np.mgrid[-cell // 2:cell // 2, -cell // 2:cell // 2]
+    for label in range(1, nr_nuclei + 1):
+        a, b = rng.uniform(4, cell // 2 - 2, size=2)
+        theta = rng.uniform(0, np.pi)
+        u = xx * np.cos(theta) + yy * np.sin(theta)
+        v = -xx * np.sin(theta) + yy * np.cos(theta)
+        y, x = divmod(label - 1, grid)
+        window = instance_map[y * cell:(y + 1) * cell, x * cell:(x + 1) * cell]
+        window[(u / a) ** 2 + (v / b) ** 2 <= 1] = label
+    image = rng.integers(0, 256, size=(size, size, 3), dtype=np.uint8)
+    return image, instance_map
+
+
+def main(args: argparse.Namespace) -> None:
+    warnings.simplefilter("ignore")
+    print(f"{'nuclei':>8}{'per-region s':>14}{'bulk s':>10}{'speedup':>10}{'identical':>11}")
+    for nr_nuclei in args.nr_nuclei:
+        image, instance_map = make_inputs(nr_nuclei)
+        timings, features = dict(), dict()
+        for bulk in [False, True]:
+            extractor = HandcraftedFeatureExtractor(bulk=bulk)
+            start = time.perf_counter()
+            features[bulk] = extractor.process(image, instance_map).numpy()
+            timings[bulk] = time.perf_counter() - start
+        identical = np.array_equal(features[False], features[True], equal_nan=True)
+        print(
+            f"{nr_nuclei:>8}{timings[False]:>14.2f}{timings[True]:>10.2f}"
+            f"{timings[False] / timings[True]:>10.1f}{str(identical):>11}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--nr_nuclei", type=int, nargs="+", default=[1000, 5000, 20000])
+    main(parser.parse_args())
@@ -0,0 +1,70 @@
+"""Benchmark the tiled HoverNet post-processing against the whole-image post-processing for several numbers of workers
+
+Usage:
+    python benchmarks/hovernet_postprocessing.py --image_size 2048 4096 --n_jobs 1 2 4 8 --tile_size 1024
+"""
+import argparse
+import os
+import time
+
+import cv2
+import numpy as np
+
+from histocartography.preprocessing.nuclei_extraction import (
+    process_np_hv_channels,
+    process_np_hv_channels_tiled,
+)
+
+
+def make_inputs(image_size: int, seed: int = 0) -> np.ndarray:
+    """Simulate a HoverNet prediction of randomly placed, partly touching, elliptic nuclei"""
+    rng = np.random.default_rng(seed)
+    nuclei = np.zeros((image_size, image_size), dtype=np.int32)
+    nr_nuclei = image_size * image_size // 600
+    for label in range(1, nr_nuclei + 1):
+        y, x = rng.integers(0, image_size, size=2)
+        axes = (int(rng.integers(4, 10)), int(rng.integers(4, 10)))
+        cv2.ellipse(nuclei, (int(x), int(y)), axes, float(rng.uniform(0, 180)), 0, 360, label, -1)
+    rows, cols = np.nonzero(nuclei)
+    ids = nuclei[rows, cols]
+    areas = np.maximum(np.bincount(ids, minlength=nr_nuclei + 1), 1)
+    pred = np.zeros((image_size, image_size, 3), dtype=np.float32)
+    pred[:, :, 0] = cv2.GaussianBlur((nuclei > 0).astype(np.float32), (5, 5), 0)
+    pred[:, :, 0] += rng.normal(0, 0.1, size=(image_size, image_size))
+    # horizontal and vertical distances to the centroid of the nucleus
+    pred[rows, cols, 1] = np.clip((cols - np.bincount(ids, cols, nr_nuclei + 1)[ids] / areas[ids]) / 10, -1, 1)
+    pred[rows, cols, 2] = np.clip((rows - np.bincount(ids, rows, nr_nuclei + 1)[ids] / areas[ids]) / 10, -1, 1)
+    return pred
+
+
+def main(args: argparse.Namespace) -> None:
+    print(f"{'size':>6}{'nuclei':>8}{'whole s':>9}{'n_jobs':>8}{'tiled s':>9}{'speedup':>9}{'identical':>11}")
+    for image_size in args.image_size:
+        pred = make_inputs(image_size)
+        start = time.perf_counter()
+        reference = process_np_hv_channels(pred)
+        whole = time.perf_counter() - start
+        for n_jobs in args.n_jobs:
+            start = time.perf_counter()
+            instance_map = process_np_hv_channels_tiled(
+                pred, tile_size=args.tile_size, halo=args.halo, n_jobs=n_jobs
+            )
+            tiled = time.perf_counter() - start
+            print(
+                f"{image_size:>6}{len(np.unique(reference)) - 1:>8}{whole:>9.2f}{n_jobs:>8}{tiled:>9.2f}"
+                f"{whole / tiled:>9.1f}{str(np.array_equal(reference, instance_map)):>11}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--image_size", type=int, nargs="+", default=[2048, 4096])
+    parser.add_argument(
+        "--n_jobs",
+        type=int,
+        nargs="+",
+        default=sorted({2 ** i for i in range(os.cpu_count().bit_length())} | {os.cpu_count()}),
+    )
+    parser.add_argument("--tile_size", type=int, default=1024)
+    parser.add_argument("--halo", type=int, default=64)
+    main(parser.parse_args())
@@ -0,0 +1,72 @@
+"""Compare the reduced-precision HoverNet inference modes of the NucleiExtractor with fp32
+
+Usage:
+    python benchmarks/hovernet_precision.py --image_path image.png --precision bf16 int8
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from histocartography.metrics import AggregatedJaccardIndex
+from histocartography.preprocessing import NucleiExtractor
+
+
+def make_inputs(image_size: int, seed: int = 0) -> np.ndarray:
+    """Simulate an H&E image with randomly placed, dark, elliptic nuclei on a pink background"""
+    rng = np.random.default_rng(seed)
+    image = np.zeros((image_size, image_size, 3), dtype=np.uint8)
+    image[:] = (230, 190, 215)
+    for _ in range(image_size * image_size // 600):
+        y, x = rng.integers(0, image_size, size=2)
+        axes = (int(rng.integers(4, 10)), int(rng.integers(4, 10)))
+        cv2.ellipse(image, (int(x), int(y)), axes, float(rng.uniform(0, 180)), 0, 360, (90, 40, 130), -1)
+    return cv2.GaussianBlur(image, (3, 3), 0)
+
+
+def dice(prediction: np.ndarray, ground_truth: np.ndarray) -> float:
+    """Dice score of the nuclei foreground"""
+    prediction = prediction > 0
+    ground_truth = ground_truth > 0
+    total = prediction.sum() + ground_truth.sum()
+    return 2 * np.logical_and(prediction, ground_truth).sum() / total if total > 0 else 1.0
+
+
+def main(args: argparse.Namespace) -> None:
+    if args.image_path is not None:
+        image = np.array(Image.open(args.image_path).convert("RGB"))
+    else:
+        image = make_inputs(args.image_size)
+    aji = AggregatedJaccardIndex()
+
+    print(f"{'precision':>10}{'time s':>9}{'speedup':>9}{'nuclei':>8}{'dice':>8}{'aji':>8}")
+    reference = None
+    for precision in ["fp32"] + args.precision:
+        extractor = NucleiExtractor(
+            pretrained_data=args.pretrained_data,
+            model_path=args.model_path,
+            batch_size=args.batch_size,
+            precision=precision,
+        )
+        start = time.perf_counter()
+        instance_map, centroids = extractor.process(image.copy())
+        elapsed = time.perf_counter() - start
+        if reference is None:
+            reference, reference_time = instance_map, elapsed
+        print(
+            f"{precision:>10}{elapsed:>9.2f}{reference_time / elapsed:>9.1f}{len(centroids):>8}"
+            f"{dice(instance_map, reference):>8.3f}{aji([instance_map], [reference]):>8.3f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--image_path", type=str, default=None, help="Simulated image if not given")
+    parser.add_argument("--image_size", type=int, default=1024)
+    parser.add_argument("--pretrained_data", type=str, default="pannuke")
+    parser.add_argument("--model_path", type=str, default=None)
+    parser.add_argument("--batch_size", type=int, default=None)
+    parser.add_argument("--precision", type=str, nargs="+", default=["bf16", "int8"])
+    main(parser.parse_args())
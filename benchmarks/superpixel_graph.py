@@ -0,0 +1,234 @@
+"""Benchmark the color graph construction, region adjacency and merging of ColorMergedSuperpixelExtractor against the implementations they replaced
+
+Usage:
+    python benchmarks/superpixel_graph.py --image_size 512 1024 2048 --superpixel_size 1000 --threshold 0.1
+"""
+import argparse
+import time
+from typing import Any, Dict, Tuple
+
+import numpy as np
+from skimage import graph
+from skimage.segmentation import slic
+
+from histocartography.preprocessing import ColorMergedSuperpixelExtractor
+from histocartography.preprocessing.superpixel import COLOR_HISTOGRAM_BINS
+
+
+def make_inputs(image_size: int, superpixel_size: int, seed: int = 0):
+    """Generate a smooth random RGB image and its initial SLIC superpixels"""
+    rng = np.random.default_rng(seed)
+    coarse = rng.integers(0, 256, size=(image_size // 32 + 1, image_size // 32 + 1, 3))
+    image = np.kron(coarse, np.ones((32, 32, 1)))[:image_size, :image_size]
+    image = np.clip(image + rng.normal(0, 10, size=image.shape), 0, 255).astype(np.uint8)
+    superpixels = slic(
+        image,
+        n_segments=image_size * image_size // superpixel_size,
+        compactness=20,
+        start_label=1,
+    )
+    return image, superpixels
+
+
+def generate_graph_per_pixel(
+    extractor: ColorMergedSuperpixelExtractor, input_image: np.ndarray, superpixels: np.ndarray
+) -> graph.RAG:
+    """Original per-pixel implementation of ColorMergedSuperpixelExtractor._generate_graph, without the edge weights"""
+    g = graph.RAG(superpixels, connectivity=extractor.connectivity)
+    if 0 in g.nodes:
+        g.remove_node(n=0)
+    for n in g:
+        g.nodes[n].update({"labels": [n], "N": 0, "x": np.array([0, 0, 0]), "y": np.array([0, 0, 0])})
+    for index in np.ndindex(superpixels.shape):
+        current = superpixels[index]
+        if current == 0:
+            continue
+        g.nodes[current]["N"] += 1
+        g.nodes[current]["x"] += input_image[index]
+        g.nodes[current]["y"] = np.vstack((g.nodes[current]["y"], input_image[index]))
+    for n in g:
+        g.nodes[n]["mean"] = g.nodes[n]["x"] / g.nodes[n]["N"]
+        g.nodes[n]["mean"] = g.nodes[n]["mean"] / np.linalg.norm(g.nodes[n]["mean"])
+        g.nodes[n]["y"] = np.delete(g.nodes[n]["y"], 0, axis=0)
+        r = color_features_per_channel(g.nodes[n]["y"][:, 0])
+        g.nodes[n]["r"] = r / np.linalg.norm(r)
+        g.nodes[n]["g"] = g.nodes[n]["r"] / np.linalg.norm(
+            color_features_per_channel(g.nodes[n]["y"][:, 1]))
+        g.nodes[n]["b"] = g.nodes[n]["r"] / np.linalg.norm(
+            color_features_per_channel(g.nodes[n]["y"][:, 2]))
+    return g
+
+
+def color_features_per_channel(img_ch: np.ndarray) -> np.ndarray:
+    """Previous ColorMergedSuperpixelExtractor._color_features_per_channel, the color histogram of an image channel"""
+    hist, _ = np.histogram(img_ch, bins=COLOR_HISTOGRAM_BINS)
+    return hist
+
+
+def generate_graph_rag(
+    extractor: ColorMergedSuperpixelExtractor, input_image: np.ndarray, superpixels: np.ndarray
+) -> graph.RAG:
+    """Previous implementation of ColorMergedSuperpixelExtractor._generate_graph, with bulk color statistics"""
+    g = graph.RAG(superpixels, connectivity=extractor.connectivity)
+    if 0 in g.nodes:
+        g.remove_node(n=0)  # remove background node
+
+    counts, sums, histograms = extractor._color_statistics(input_image, superpixels)
+    labels = superpixels.ravel()
+    pixels = input_image.reshape(-1, input_image.shape[-1]).astype(np.int64)
+
+    # group the pixels of each superpixel in raster order
+    order = np.argsort(labels, kind="stable")
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    for n in g:
+        mean = sums[n] / counts[n]
+        r, g_hist, b = histograms[n]
+        r = r / np.linalg.norm(r)
+        g.nodes[n].update(
+            {
+                "labels": [n],
+                "N": counts[n],
+                "x": sums[n],
+                "y": pixels[order[offsets[n]:offsets[n + 1]]],
+                "mean": mean / np.linalg.norm(mean),
+                "r": r,
+                "g": r / np.linalg.norm(g_hist),
+                "b": r / np.linalg.norm(b),
+            }
+        )
+
+    for x, y, d in g.edges(data=True):
+        diff_mean = np.linalg.norm(g.nodes[x]["mean"] - g.nodes[y]["mean"]) / 2
+        diff_r = np.linalg.norm(g.nodes[x]["r"] - g.nodes[y]["r"]) / 2
+        diff_g = np.linalg.norm(g.nodes[x]["g"] - g.nodes[y]["g"]) / 2
+        diff_b = np.linalg.norm(g.nodes[x]["b"] - g.nodes[y]["b"]) / 2
+        diff_hist = (diff_r + diff_g + diff_b) / 3
+        d["weight"] = extractor.w_hist * diff_hist + extractor.w_mean * diff_mean
+    return g
+
+
+def merge_hierarchical_rag(
+    extractor: ColorMergedSuperpixelExtractor, input_image: np.ndarray, superpixels: np.ndarray
+) -> np.ndarray:
+    """Previous implementation of ColorMergedSuperpixelExtractor._merge_hierarchical with graph.merge_hierarchical"""
+
+    def weighting_function(g: graph.RAG, src: int, dst: int, n: int) -> Dict[str, Any]:
+        diff_mean = np.linalg.norm(g.nodes[dst]["mean"] - g.nodes[n]["mean"])
+        diff_r = np.linalg.norm(g.nodes[dst]["r"] - g.nodes[n]["r"]) / 2
+        diff_g = np.linalg.norm(g.nodes[dst]["g"] - g.nodes[n]["g"]) / 2
+        diff_b = np.linalg.norm(g.nodes[dst]["b"] - g.nodes[n]["b"]) / 2
+        diff_hist = (diff_r + diff_g + diff_b) / 3
+        return {"weight": extractor.w_hist * diff_hist + extractor.w_mean * diff_mean}
+
+    def merging_function(g: graph.RAG, src: int, dst: int) -> None:
+        g.nodes[dst]["x"] += g.nodes[src]["x"]
+        g.nodes[dst]["N"] += g.nodes[src]["N"]
+        g.nodes[dst]["mean"] = g.nodes[dst]["x"] / g.nodes[dst]["N"]
+        g.nodes[dst]["mean"] = g.nodes[dst]["mean"] / np.linalg.norm(g.nodes[dst]["mean"])
+        g.nodes[dst]["y"] = np.vstack((g.nodes[dst]["y"], g.nodes[src]["y"]))
+        g.nodes[dst]["r"] = color_features_per_channel(g.nodes[dst]["y"][:, 0])
+        g.nodes[dst]["g"] = color_features_per_channel(g.nodes[dst]["y"][:, 1])
+        g.nodes[dst]["b"] = color_features_per_channel(g.nodes[dst]["y"][:, 2])
+        g.nodes[dst]["r"] = g.nodes[dst]["r"] / np.linalg.norm(g.nodes[dst]["r"])
+        g.nodes[dst]["g"] = g.nodes[dst]["r"] / np.linalg.norm(g.nodes[dst]["g"])
+        g.nodes[dst]["b"] = g.nodes[dst]["r"] / np.linalg.norm(g.nodes[dst]["b"])
+
+    g = generate_graph_rag(extractor, input_image, superpixels)
+    return graph.merge_hierarchical(
+        superpixels,
+        g,
+        thresh=extractor.threshold,
+        rag_copy=False,
+        in_place_merge=True,
+        merge_func=merging_function,
+        weight_func=weighting_function,
+    )
+
+
+def region_adjacency_rag(
+    extractor: ColorMergedSuperpixelExtractor, superpixels: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Previous implementation of ColorMergedSuperpixelExtractor._region_adjacency, listing the nodes and edges of a graph.RAG"""
+    g = graph.RAG(superpixels, connectivity=extractor.connectivity)
+    if 0 in g.nodes:
+        g.remove_node(n=0)
+    nodes = np.array(list(g.nodes), dtype=np.int64)
+    edges = np.array(list(g.edges), dtype=np.int64).reshape(-1, 2)
+    return nodes, edges
+
+
+def same_adjacency(reference: Tuple[np.ndarray, np.ndarray], adjacency: Tuple[np.ndarray, np.ndarray]) -> bool:
+    """Check that two adjacencies have the same node order and the same oriented edges"""
+    return np.array_equal(reference[0], adjacency[0]) and set(map(tuple, reference[1].tolist())) == set(
+        map(tuple, adjacency[1].tolist())
+    )
+
+
+def same_nodes(g1: graph.RAG, g2: graph.RAG) -> bool:
+    """Check that two graphs hold the same color statistics for every node"""
+    if set(g1.nodes) != set(g2.nodes):
+        return False
+    for n in g1:
+        for key in ["N", "x", "y", "mean", "r", "g", "b"]:
+            if not np.array_equal(g1.nodes[n][key], g2.nodes[n][key]):
+                return False
+    return True
+
+
+def main(args: argparse.Namespace) -> None:
+    extractor = ColorMergedSuperpixelExtractor(
+        superpixel_size=args.superpixel_size, threshold=args.threshold
+    )
+    print("graph construction")
+    print(f"{'size':>6}{'superpixels':>13}{'per-pixel s':>13}{'bulk s':>9}{'speedup':>9}{'identical':>11}")
+    for image_size in args.image_size:
+        image, superpixels = make_inputs(image_size, args.superpixel_size)
+        start = time.perf_counter()
+        reference = generate_graph_per_pixel(extractor, image, superpixels)
+        per_pixel = time.perf_counter() - start
+        start = time.perf_counter()
+        g = generate_graph_rag(extractor, image, superpixels)
+        bulk = time.perf_counter() - start
+        print(
+            f"{image_size:>6}{len(g):>13}{per_pixel:>13.2f}{bulk:>9.2f}"
+            f"{per_pixel / bulk:>9.1f}{str(same_nodes(reference, g)):>11}"
+        )
+
+    print("\nregion adjacency")
+    print(f"{'size':>6}{'superpixels':>13}{'edges':>8}{'RAG s':>9}{'shifts s':>10}{'speedup':>9}{'identical':>11}")
+    for image_size in args.image_size:
+        image, superpixels = make_inputs(image_size, args.superpixel_size)
+        start = time.perf_counter()
+        reference = region_adjacency_rag(extractor, superpixels)
+        rag = time.perf_counter() - start
+        start = time.perf_counter()
+        adjacency = extractor._region_adjacency(superpixels)
+        shifts = time.perf_counter() - start
+        print(
+            f"{image_size:>6}{superpixels.max():>13}{len(adjacency[1]):>8}{rag:>9.2f}{shifts:>10.2f}"
+            f"{rag / shifts:>9.1f}{str(same_adjacency(reference, adjacency)):>11}"
+        )
+
+    print("\nhierarchical merging")
+    print(f"{'size':>6}{'superpixels':>13}{'merged':>8}{'RAG s':>9}{'arrays s':>10}{'speedup':>9}{'identical':>11}")
+    for image_size in args.image_size:
+        image, superpixels = make_inputs(image_size, args.superpixel_size)
+        start = time.perf_counter()
+        reference = merge_hierarchical_rag(extractor, image, superpixels)
+        rag = time.perf_counter() - start
+        start = time.perf_counter()
+        merged = extractor._merge_hierarchical(image, superpixels)
+        arrays = time.perf_counter() - start
+        print(
+            f"{image_size:>6}{superpixels.max():>13}{merged.max() + 1:>8}{rag:>9.2f}{arrays:>10.2f}"
+            f"{rag / arrays:>9.1f}{str(np.array_equal(reference, merged)):>11}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--image_size", type=int, nargs="+", default=[512, 1024, 2048])
+    parser.add_argument("--superpixel_size", type=int, default=1000)
+    parser.add_argument("--threshold", type=float, default=0.1)
+    main(parser.parse_args())
@@ -1,7 +1,9 @@
 from .metrics import IoU, MeanIoU
 from .metrics import Dice, MeanDice
+from .metrics import AggregatedJaccardIndex
 
 __all__ = [
+    'AggregatedJaccardIndex',
     'Dice',
     'IoU',
     'MeanIoU',
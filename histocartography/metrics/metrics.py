@@ -207,3 +207,78 @@ class MeanDice(Dice):
     @property
     def is_per_class(self):
         return False
+
+
+class AggregatedJaccardIndex(Metric):
+    """Aggregated Jaccard Index (AJI) of instance maps, as in Kumar et al., 2017"""
+
+    def __call__(
+        self,
+        prediction: Union[torch.Tensor, np.ndarray],
+        ground_truth: Union[torch.Tensor, np.ndarray],
+        **kwargs,
+    ) -> float:
+        """
+        Compute the AJI. Every ground truth instance is matched with the predicted instance of
+        highest IoU, and the intersections and unions of the matches are summed over all samples.
+        Unmatched predicted instances are added to the union.
+
+        Args:
+            prediction (Union[torch.Tensor, np.ndarray]): List of instance maps, 0 is background.
+            ground_truth (Union[torch.Tensor, np.ndarray]): List of ground truth instance maps, 0 is background.
+        """
+        assert len(ground_truth) == len(prediction)
+
+        intersection = 0
+        union = 0
+        for sample_gt, sample_pred in zip(ground_truth, prediction):
+            if isinstance(sample_gt, torch.Tensor):
+                sample_gt = sample_gt.detach().cpu().numpy()
+            if isinstance(sample_pred, torch.Tensor):
+                sample_pred = sample_pred.detach().cpu().numpy()
+            # relabel the instances consecutively, 0 stays background
+            gt_labels, sample_gt = np.unique(sample_gt, return_inverse=True)
+            pred_labels, sample_pred = np.unique(
+                sample_pred, return_inverse=True)
+            nr_gt = len(gt_labels) - (gt_labels[0] == 0)
+            nr_pred = len(pred_labels) - (pred_labels[0] == 0)
+            sample_gt = sample_gt.ravel() - (gt_labels[0] == 0)
+            sample_pred = sample_pred.ravel() - (pred_labels[0] == 0)
+
+            gt_areas = np.bincount(
+                sample_gt[sample_gt >= 0], minlength=nr_gt)
+            pred_areas = np.bincount(
+                sample_pred[sample_pred >= 0], minlength=nr_pred)
+            if nr_gt == 0 or nr_pred == 0:
+                union += gt_areas.sum() + pred_areas.sum()
+                continue
+
+            # overlap of every pair of instances
+            mask = (sample_gt >= 0) & (sample_pred >= 0)
+            pairs, overlaps = np.unique(
+                sample_gt[mask].astype(np.int64) * nr_pred + sample_pred[mask],
+                return_counts=True,
+            )
+            pair_gt, pair_pred = np.divmod(pairs, nr_pred)
+            pair_union = gt_areas[pair_gt] + pred_areas[pair_pred] - overlaps
+
+            # match with the highest IoU, ties go to the lowest label. Pairs are sorted so that the
+            # last pair of each gt instance wins
+            order = np.lexsort((-pair_pred, overlaps / pair_union, pair_gt))
+            best = np.zeros(nr_gt, dtype=np.int64) - 1
+            best[pair_gt[order]] = order
+            matched = best >= 0
+            intersection += overlaps[best[matched]].sum()
+            union += pair_union[best[matched]].sum() + gt_areas[~matched].sum()
+            used = np.zeros(nr_pred, dtype=bool)
+            used[pair_pred[best[matched]]] = True
+            union += pred_areas[~used].sum()
+        return float(intersection / union) if union > 0 else 1.0
+
+    @staticmethod
+    def is_better(value: Any, comparison: Any) -> bool:
+        return value >= comparison
+
+    @property
+    def logs_model(self):
+        return False
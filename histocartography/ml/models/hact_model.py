@@ -164,23 +164,52 @@ class HACTModel(BaseModel):
             num_layers=self.classification_params['num_layers']
         )
 
-    def _compute_assigned_feats(self, graph, feats, assignment):
+    def _compute_assigned_feats(self, graph, feats, assignment, tissue_graph):
         """
-        Use the assignment matrix to agg the feats
-        """
-        num_nodes_per_graph = graph.batch_num_nodes().tolist()
-        num_nodes_per_graph.insert(0, 0)
-        intervals = [sum(num_nodes_per_graph[:i + 1])
-                     for i in range(len(num_nodes_per_graph))]
+        Use the assignment to agg the feats of the cells into the tissue nodes,
+        with a single scatter sum over the whole batch.
 
-        ll_h_concat = []
-        for i in range(1, len(intervals)):
-            h_agg = torch.matmul(
-                assignment[i - 1], feats[intervals[i - 1]:intervals[i], :]
-            )
-            ll_h_concat.append(h_agg)
+        Args:
+            graph (Union[dgl.DGLGraph, dgl.batch]): Cell graph or Batch of cell graphs.
+            feats (torch.Tensor): Cell node features.
+            assignment (List[torch.Tensor]): Assignment of every graph of the batch. Either a
+                (dense or sparse) assignment matrix of shape (nr_tissue_nodes, nr_cell_nodes), or
+                a vector holding the index of the tissue node of every cell node.
+            tissue_graph (Union[dgl.DGLGraph, dgl.batch]): Tissue graph or Batch of tissue graphs.
 
-        return torch.cat(ll_h_concat, dim=0)
+        Returns:
+            torch.Tensor: Aggregated features of the tissue nodes.
+        """
+        # first node of every graph in the batch
+        cell_offsets = [0] + torch.cumsum(graph.batch_num_nodes(), dim=0).tolist()
+        tissue_offsets = [0] + torch.cumsum(tissue_graph.batch_num_nodes(), dim=0).tolist()
+        tissue_ids, cell_ids, weights = [], [], []
+        for a, cell_offset, tissue_offset in zip(assignment, cell_offsets, tissue_offsets):
+            if a.dim() == 1:
+                tissue_idx = a.long()
+                cell_idx = torch.arange(a.shape[0], device=a.device)
+                weight = None
+            elif a.is_sparse:
+                a = a.coalesce()
+                tissue_idx, cell_idx = a.indices()
+                weight = a.values()
+            else:
+                tissue_idx, cell_idx = torch.nonzero(a, as_tuple=True)
+                weight = a[tissue_idx, cell_idx]
+            tissue_ids.append(tissue_idx + tissue_offset)
+            cell_ids.append(cell_idx + cell_offset)
+            weights.append(weight)
+
+        src = feats[torch.cat(cell_ids).to(feats.device)]
+        if any(w is not None for w in weights):
+            weights = torch.cat([
+                w.to(feats.device, feats.dtype) if w is not None
+                else feats.new_ones(len(ids))
+                for w, ids in zip(weights, cell_ids)
+            ])
+            src = src * weights.unsqueeze(1)
+        h_agg = feats.new_zeros((tissue_graph.num_nodes(), feats.shape[1]))
+        return h_agg.index_add_(0, torch.cat(tissue_ids).to(feats.device), src)
 
     def forward(
         self,
@@ -194,7 +223,8 @@ class HACTModel(BaseModel):
         Args:
             cell_graph (Union[dgl.DGLGraph, dgl.batch]): Cell graph or Batch of cell graphs.
             tissue_graph (Union[dgl.DGLGraph, dgl.batch]): Tissue graph or Batch of tissue graphs.
-            assignment_matrix (torch.Tensor): List of assignment matrices
+            assignment_matrix (torch.Tensor): List of assignment matrices, or of vectors holding
+                                              the tissue node index of every cell node
 
         Returns:
             torch.Tensor: model output.
@@ -206,7 +236,7 @@ class HACTModel(BaseModel):
 
         # 2. Sum the low level features according to assignment matrix
         ll_h_concat = self._compute_assigned_feats(
-            cell_graph, ll_h, assignment_matrix)
+            cell_graph, ll_h, assignment_matrix, tissue_graph)
 
         tissue_graph.ndata[GNN_NODE_FEAT_IN] = torch.cat(
             (ll_h_concat, tissue_graph.ndata[GNN_NODE_FEAT_IN]), dim=1)
@@ -1,9 +1,14 @@
+import copy
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 import numpy as np
 
+# sub-modules of HoverNet quantized to int8, the output convolutions stay in float
+QUANTIZED_MODULES = ["encode", "decode_np", "decode_hv"]
+
 
 class HoverNet(nn.Module):
 
@@ -323,10 +328,9 @@ class DenseBlock(nn.Module):
             x = getattr(self, 'blk_' + str(i) + 'preact_bna')(l)
             x = getattr(self, 'blk_' + str(i) + 'conv1')(x)
             x = getattr(self, 'blk_' + str(i) + 'conv2')(x)
-            x_shape = list(x.shape)
-            l_shape = list(l.shape)
-            l = crop_op(l, (l_shape[2] - x_shape[2],
-                            l_shape[3] - x_shape[3]))
+            # shapes are indexed rather than unpacked, to keep the block traceable
+            l = crop_op(l, (l.shape[2] - x.shape[2],
+                            l.shape[3] - x.shape[3]))
             l = torch.cat([l, x], dim=1)
         l = self.blk_bna(l)
         return l
@@ -397,3 +401,47 @@ def crop_op(x, cropping):
     crop_r = cropping[1] - crop_l
     x = x[:, :, crop_t:-crop_b, crop_l:-crop_r]
     return x
+
+
+def prepare_quantization(model: nn.Module) -> nn.Module:
+    """
+    Copy of a HoverNet whose encoder and decoders observe their activations, to quantize their
+    convolutions to int8 (x86 backend). Calibrate it by running it on representative images,
+    then convert it with convert_quantization. Needs torch >= 1.13.
+    """
+    from torch.ao.quantization import MinMaxObserver, QConfig, QConfigMapping, get_default_qconfig
+    from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+    from torch.ao.quantization.quantize_fx import prepare_fx
+
+    model = copy.deepcopy(model).eval()
+    # min-max observers calibrate much faster than the default histogram observers
+    qconfig = get_default_qconfig("x86")
+    qconfig_mapping = QConfigMapping().set_global(
+        QConfig(activation=MinMaxObserver.with_args(reduce_range=True), weight=qconfig.weight))
+    # padding depends on the input shape, it stays in float. Classes are matched by name as the
+    # model may have been unpickled from another import path of this module
+    prepare_custom_config = PrepareCustomConfig().set_non_traceable_module_classes(
+        list({type(m) for m in model.modules() if type(m).__name__ == SamepaddingLayer.__name__}))
+
+    images = torch.zeros(1, 3, 256, 256)
+    with torch.no_grad():
+        d = model.encode(images)
+    d[0] = crop_op(d[0], (92, 92))
+    d[1] = crop_op(d[1], (36, 36))
+    for name in QUANTIZED_MODULES:
+        example_inputs = (images,) if name == "encode" else (d,)
+        setattr(model, name, prepare_fx(
+            getattr(model, name), qconfig_mapping, example_inputs,
+            prepare_custom_config=prepare_custom_config))
+    return model
+
+
+def convert_quantization(model: nn.Module) -> nn.Module:
+    """
+    Quantize a HoverNet prepared with prepare_quantization and calibrated, in place.
+    """
+    from torch.ao.quantization.quantize_fx import convert_fx
+
+    for name in QUANTIZED_MODULES:
+        setattr(model, name, convert_fx(getattr(model, name)))
+    return model
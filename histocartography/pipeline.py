@@ -1,30 +1,210 @@
 """Pipeline utilities"""
+import hashlib
+import io
+import json
 import logging
 import multiprocessing
 import os
+import pickle
+import shutil
 import sys
+import time
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from copy import deepcopy
 from functools import partial
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import h5py
+import numpy as np
 import pandas as pd
+import torch
 from tqdm.auto import tqdm
 
 from histocartography.utils import dynamic_import_from, signal_last
 
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+STORAGE_OPTIONS = ["files", "consolidated"]
+CONSOLIDATED_STORE_NAME = "outputs.h5"
+COMPRESSION_OPTIONS = [None, "none", "lzf", "gzip"]
+
+
+def get_dataset_options(
+    data: Any,
+    compression: Optional[str] = "gzip",
+    compression_level: Optional[int] = 9,
+    shuffle: bool = False,
+    chunks: Union[None, bool, Tuple[int, ...]] = None,
+) -> Dict[str, Any]:
+    """Builds the keyword arguments of h5py create_dataset for a given output
+
+    Args:
+        data (Any): Output to save
+        compression (Optional[str], optional): Compression filter, one of None or "none"
+            (uncompressed), "lzf" or "gzip". Defaults to "gzip".
+        compression_level (Optional[int], optional): Level of the gzip compression, from 0 to 9.
+            Ignored by the other filters. Defaults to 9.
+        shuffle (bool, optional): Whether to apply the byte shuffle filter before compression.
+            Defaults to False.
+        chunks (Union[None, bool, Tuple[int, ...]], optional): Chunk shape. When None, h5py picks
+            the chunk shape if a filter is used. A chunk shape is clipped to the shape of the
+            output and ignored for outputs of another dimensionality. Defaults to None.
+
+    Returns:
+        Dict[str, Any]: Keyword arguments of create_dataset
+    """
+    assert (
+        compression in COMPRESSION_OPTIONS
+    ), f"Unsupported compression {compression}. Options are {COMPRESSION_OPTIONS}"
+    shape = np.shape(data)
+    options: Dict[str, Any] = dict()
+    if len(shape) == 0 or np.prod(shape) == 0:
+        # scalar and empty datasets cannot be chunked
+        return options
+    if compression not in [None, "none"]:
+        options["compression"] = compression
+        if compression == "gzip":
+            options["compression_opts"] = compression_level
+    if shuffle:
+        options["shuffle"] = True
+    if isinstance(chunks, tuple):
+        if len(chunks) == len(shape):
+            options["chunks"] = tuple(
+                max(1, min(c, s)) for c, s in zip(chunks, shape)
+            )
+    elif chunks is not None:
+        options["chunks"] = chunks
+    return options
+
+
+class StepStore:
+    """Consolidated storage of the outputs of a pipeline step for all datapoints"""
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        """Create a store that keeps the outputs of all datapoints in a single chunked HDF5 file,
+           with one group per datapoint. Accesses are serialized with a lock file, such that
+           several processes can write to the same store. The lock uses fcntl on Unix and msvcrt
+           on Windows.
+
+        Args:
+            path (Union[str, Path]): Path of the HDF5 file
+        """
+        self.path = Path(path)
+        self.lock_path = self.path.with_name(f"{self.path.name}.lock")
+
+    @contextmanager
+    def _lock(self, exclusive: bool) -> Iterator[None]:
+        """Hold a lock on the store
+
+        Args:
+            exclusive (bool): Whether to hold an exclusive (writing) or a shared (reading) lock
+        """
+        with open(self.lock_path, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                return
+            # msvcrt only provides exclusive locks, so readers are serialized as well
+            lock_file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 attempts, keep waiting
+                    continue
+            try:
+                yield
+            finally:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def __contains__(self, output_name: str) -> bool:
+        """Check whether the output of a datapoint is stored
+
+        Args:
+            output_name (str): Unique identifier of the datapoint
+
+        Returns:
+            bool: Whether the output is stored
+        """
+        if not self.path.exists():
+            return False
+        with self._lock(exclusive=False), h5py.File(self.path, "r") as store:
+            return output_name in store
+
+    def keys(self) -> List[str]:
+        """Returns the identifiers of all stored datapoints
+
+        Returns:
+            List[str]: Identifiers of the stored datapoints
+        """
+        if not self.path.exists():
+            return []
+        with self._lock(exclusive=False), h5py.File(self.path, "r") as store:
+            return list(store.keys())
+
+    def read(self, step: "PipelineStep", output_name: str) -> Any:
+        """Read the output of a datapoint
+
+        Args:
+            step (PipelineStep): Step that computed the output
+            output_name (str): Unique identifier of the datapoint
+
+        Returns:
+            Any: Previously computed output of the step
+        """
+        with self._lock(exclusive=False), h5py.File(self.path, "r") as store:
+            return step._get_outputs(input_file=store[output_name])
+
+    def write(self, step: "PipelineStep", output_name: str, outputs: Any) -> None:
+        """Append the output of a datapoint to the store. Outputs that are already stored,
+           eg. by another process, are not overwritten.
+
+        Args:
+            step (PipelineStep): Step that computed the output
+            output_name (str): Unique identifier of the datapoint
+            outputs (Any): Computed step output
+        """
+        with self._lock(exclusive=True), h5py.File(self.path, "a") as store:
+            if output_name not in store:
+                step._set_outputs(
+                    output_file=store.create_group(output_name), outputs=outputs
+                )
+
 
 class PipelineStep(ABC):
     """Base pipelines step"""
 
+    # Whether the output of the step can be stored in a StageCache or a consolidated StepStore.
+    # Steps with side effects or whose output is cheaper to recompute than to read back opt out.
+    cacheable: bool = True
+    cache_file_ending: str = ".h5"
+    # Names of the attributes set after PipelineStep.__init__ that still change the output of the step.
+    # They are hashed into the cache key but, unlike the constructor parameters, do not name the output directory.
+    cache_parameters: Tuple[str, ...] = ()
+
     def __init__(
         self,
         save_path: Union[None, str, Path] = None,
         precompute: bool = True,
         link_path: Union[None, str, Path] = None,
         precompute_path: Union[None, str, Path] = None,
+        storage: str = "files",
+        compression: Optional[str] = "gzip",
+        compression_level: Optional[int] = 9,
+        shuffle: bool = False,
+        chunks: Union[None, bool, Tuple[int, ...]] = None,
     ) -> None:
         """Abstract class that helps with saving and loading precomputed results
 
@@ -39,19 +219,47 @@ class PipelineStep(ABC):
             precompute_path (Union[None, str, Path], optional): Path to save the output of
                 the precomputation to. If not specified it defaults to the output directory
                 of the step when save_path is not None. Defaults to None.
+            storage (str, optional): How the results are saved, either "files" for one file per
+                datapoint or "consolidated" for a single store per step that holds the results of
+                all datapoints. Defaults to "files".
+            compression (Optional[str], optional): Compression filter of the saved .h5 outputs,
+                one of None or "none" (uncompressed), "lzf" (fast) or "gzip". Defaults to "gzip".
+            compression_level (Optional[int], optional): Level of the gzip compression, from 0 to 9.
+                Defaults to 9.
+            shuffle (bool, optional): Whether to apply the byte shuffle filter before compression,
+                which usually improves the compression of integer maps and float features.
+                Defaults to False.
+            chunks (Union[None, bool, Tuple[int, ...]], optional): Chunk shape of the saved .h5 outputs.
+                When None, h5py picks the chunk shape if a filter is used. Defaults to None.
         """
         assert (
             save_path is not None or link_path is None
         ), "link_path only supported when save_path is not None"
+        assert (
+            storage in STORAGE_OPTIONS
+        ), f"Unsupported storage {storage}. Options are {STORAGE_OPTIONS}"
 
         name = self.__repr__()
+        self.cache_id = name
+        self.output_key = "default_key"
         self.save_path = save_path
+        self.storage = storage
+        self.dataset_options = dict(
+            compression=compression,
+            compression_level=compression_level,
+            shuffle=shuffle,
+            chunks=tuple(chunks) if isinstance(chunks, list) else chunks,
+        )
+        # fail early on invalid options
+        get_dataset_options(np.zeros(1), **self.dataset_options)
+        self.store: Optional[StepStore] = None
         if self.save_path is not None:
             self.output_dir = Path(self.save_path) / name
-            self.output_key = "default_key"
             self._mkdir()
             if precompute_path is None:
                 precompute_path = save_path
+            if self.storage == "consolidated" and self.cacheable:
+                self.store = StepStore(self.output_dir / CONSOLIDATED_STORE_NAME)
 
         if precompute:
             self.precompute(
@@ -131,7 +339,10 @@ class PipelineStep(ABC):
         Returns:
             Any: Result of the pipeline step
         """
-        if output_name is not None and self.save_path is not None:
+        if output_name is not None and self.store is not None:
+            return self._process_and_store(
+                *args, output_name=output_name, **kwargs)
+        elif output_name is not None and self.save_path is not None:
             return self._process_and_save(
                 *args, output_name=output_name, **kwargs)
         else:
@@ -182,10 +393,108 @@ class PipelineStep(ABC):
             output_file.create_dataset(
                 f"{self.output_key}_{i}",
                 data=output,
-                compression="gzip",
-                compression_opts=9,
+                **get_dataset_options(output, **self.dataset_options),
             )
 
+    def _process_and_store(
+        self, *args: Any, output_name: str, **kwargs: Any
+    ) -> Any:
+        """Process and append the output to the consolidated store of the step
+
+        Args:
+            output_name (str): Unique identifier of the the passed datapoint
+
+        Raises:
+            read_error (OSError): When the unable to read from the store
+            write_error (OSError): When the unable to write to the store
+        Returns:
+            Any: Result of the pipeline step
+        """
+        assert (
+            self.store is not None
+        ), "Can only store output if base_path was not None and storage is consolidated"
+        if output_name in self.store:
+            logging.info(
+                f"{self.__class__.__name__}: Output of {output_name} already exists, using it instead of recomputing"
+            )
+            try:
+                output = self.store.read(self, output_name)
+            except OSError as read_error:
+                print(f"\n\nCould not read {output_name} from {self.store.path}!\n\n")
+                raise read_error
+        else:
+            output = self._process(*args, **kwargs)
+            try:
+                self.store.write(self, output_name, output)
+            except OSError as write_error:
+                print(f"\n\nCould not write {output_name} to {self.store.path}!\n\n")
+                raise write_error
+        return output
+
+    def cache_key(self, input_digests: Iterable[str]) -> str:
+        """Content-addressed key of the output of the step for given inputs. It hashes the
+           class and the constructor parameters of the step and its cache_parameters together
+           with the digests of its inputs.
+
+        Args:
+            input_digests (Iterable[str]): Digests of the inputs of the step, in order
+
+        Returns:
+            str: Hexadecimal cache key
+        """
+        hasher = hashlib.sha256(self.cache_id.encode())
+        for name in self.cache_parameters:
+            hasher.update(f"{name}={getattr(self, name)!r}".encode())
+        for digest in input_digests:
+            hasher.update(digest.encode())
+        return hasher.hexdigest()
+
+    def _save_to_cache(self, path: Path, outputs: Union[Tuple, Any]) -> None:
+        """Save the step output to a given cache file
+
+        Args:
+            path (Path): Path of the cache file
+            outputs (Union[Tuple, Any]): Computed step output
+        """
+        with h5py.File(path, "w") as output_file:
+            self._set_outputs(output_file=output_file, outputs=outputs)
+
+    def _load_from_cache(self, path: Path) -> Union[Any, Tuple]:
+        """Load the step output from a given cache file
+
+        Args:
+            path (Path): Path of the cache file
+
+        Returns:
+            Union[Any, Tuple]: Previously computed output of the step
+        """
+        with h5py.File(path, "r") as input_file:
+            return self._get_outputs(input_file=input_file)
+
+    def _save_from_cache(self, path: Path, output_name: str, output: Any) -> None:
+        """Save an output loaded from or just written to a StageCache where process would have
+           saved it, such that the output directory is complete when caching is enabled.
+           Cache files are hard linked into the output directory when both use the same format.
+
+        Args:
+            path (Path): Path of the cache file
+            output_name (str): Unique identifier of the datapoint
+            output (Any): Output of the step
+        """
+        if self.store is not None:
+            self.store.write(self, output_name, output)
+        elif self.save_path is not None:
+            output_path = self.output_dir / f"{output_name}{self.cache_file_ending}"
+            if output_path.exists():
+                return
+            try:
+                os.link(path, output_path)
+            except FileExistsError:
+                pass
+            except OSError:
+                # eg. the cache is on another file system
+                shutil.copyfile(path, output_path)
+
     def _process_and_save(
         self, *args: Any, output_name: str, **kwargs: Any
     ) -> Any:
@@ -225,6 +534,164 @@ class PipelineStep(ABC):
         return output
 
 
+def compute_digest(value: Any) -> str:
+    """Computes a digest of a pipeline input. Files are identified by their path, size and
+       modification time, arrays and tensors by their content.
+
+    Args:
+        value (Any): Input value
+
+    Returns:
+        str: Hexadecimal digest
+    """
+    hasher = hashlib.sha256()
+    if isinstance(value, (str, Path)) and os.path.isfile(value):
+        stat = os.stat(value)
+        hasher.update(
+            f"file:{os.path.abspath(value)}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+        )
+    elif torch.is_tensor(value):
+        hasher.update(compute_digest(value.detach().cpu().numpy()).encode())
+    elif isinstance(value, np.ndarray) and value.dtype != object:
+        hasher.update(f"array:{value.dtype.str}:{value.shape}".encode())
+        hasher.update(np.ascontiguousarray(value).data)
+    elif isinstance(value, (tuple, list)):
+        hasher.update(f"sequence:{len(value)}".encode())
+        for item in value:
+            hasher.update(compute_digest(item).encode())
+    else:
+        hasher.update(pickle.dumps(value))
+    return hasher.hexdigest()
+
+
+class StageCache:
+    """Content-addressed cache of pipeline step outputs"""
+
+    MANIFEST_NAME = "manifest.jsonl"
+
+    def __init__(self, cache_path: Union[str, Path]) -> None:
+        """Create a cache that stores the output of each step under its cache key. All entries
+           are listed in an append-only manifest, such that checking for a hit does not require
+           to access the cached files. Several processes can share the same cache directory.
+
+        Args:
+            cache_path (Union[str, Path]): Directory of the cache
+        """
+        self.cache_path = Path(cache_path)
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = self.cache_path / self.MANIFEST_NAME
+        self.nr_hits = 0
+        self.nr_misses = 0
+        self._entries: Dict[str, Dict[str, Any]] = dict()
+        self._manifest_offset = 0
+        self._refresh()
+
+    def _refresh(self) -> None:
+        """Read the manifest entries appended since the last read, possibly by other processes"""
+        if not self.manifest_path.exists():
+            return
+        with open(self.manifest_path, "rb") as manifest:
+            manifest.seek(self._manifest_offset)
+            content = manifest.read()
+        # only consume complete lines, the last one might still be written
+        end = content.rfind(b"\n") + 1
+        for line in content[:end].splitlines():
+            if line.strip():
+                entry = json.loads(line)
+                self._entries[entry["key"]] = entry
+        self._manifest_offset += end
+
+    def __contains__(self, key: str) -> bool:
+        """Check whether an output is cached for a given key
+
+        Args:
+            key (str): Cache key
+
+        Returns:
+            bool: Whether the key is in the cache
+        """
+        if key not in self._entries:
+            self._refresh()
+        return key in self._entries
+
+    def __len__(self) -> int:
+        """Returns the number of cached outputs
+
+        Returns:
+            int: Number of cached outputs
+        """
+        self._refresh()
+        return len(self._entries)
+
+    def file_path(self, key: str) -> Path:
+        """Returns the path of the cached output for a given key
+
+        Args:
+            key (str): Cache key
+
+        Returns:
+            Path: Path of the cache file
+        """
+        return self.cache_path / self._entries[key]["file"]
+
+    def load(self, step: PipelineStep, key: str) -> Any:
+        """Load the cached output of a step
+
+        Args:
+            step (PipelineStep): Step that computed the output
+            key (str): Cache key
+
+        Returns:
+            Any: Cached output of the step
+        """
+        path = self.file_path(key)
+        try:
+            output = step._load_from_cache(path)
+        except OSError as read_error:
+            print(f"\n\nCould not read from {path}!\n\n")
+            raise read_error
+        self.nr_hits += 1
+        return output
+
+    def save(
+        self,
+        step: PipelineStep,
+        key: str,
+        output: Any,
+        output_name: Optional[str] = None,
+    ) -> None:
+        """Save the output of a step and register it in the manifest
+
+        Args:
+            step (PipelineStep): Step that computed the output
+            key (str): Cache key
+            output (Any): Output of the step
+            output_name (Optional[str], optional): Identifier of the datapoint, only used for
+                bookkeeping in the manifest. Defaults to None.
+        """
+        path = self.cache_path / key[:2] / f"{key}{step.cache_file_ending}"
+        path.parent.mkdir(exist_ok=True)
+        # write to a temporary file first, such that readers never see partial outputs
+        tmp_path = path.with_name(f"{os.getpid()}_{path.name}")
+        try:
+            step._save_to_cache(tmp_path, output)
+            os.replace(tmp_path, path)
+        except OSError as write_error:
+            print(f"\n\nCould not write to {path}!\n\n")
+            raise write_error
+        entry = {
+            "key": key,
+            "file": str(path.relative_to(self.cache_path)),
+            "step": step.__class__.__name__,
+            "output_name": output_name,
+        }
+        # appending a single line is atomic on Unix as long as it does not exceed the buffer
+        with io.open(self.manifest_path, mode="a") as manifest:
+            manifest.write(json.dumps(entry) + "\n")
+        self._entries[key] = entry
+        self.nr_misses += 1
+
+
 class PipelineRunner:
     def __init__(
         self,
@@ -234,6 +701,8 @@ class PipelineRunner:
         stages: Iterable[dict] = [],
         save_intermediate: bool = False,
         precompute: bool = True,
+        cache_path: Optional[str] = None,
+        storage: str = "files",
     ) -> None:
         """Create a pipeline runner for a given configuration
 
@@ -245,9 +714,18 @@ class PipelineRunner:
             stages (Iterable[dict], optional): Stages to complete. Defaults to [].
             save_intermediate (bool, optional): Whether to save the intermediate steps. Defaults to False.
             precompute (bool, optional): Whether to perform the precomputation steps. Defaults to True.
+            cache_path (Optional[str], optional): Path to a content-addressed stage cache. When set,
+                the output of every cacheable stage is stored in and reused from the cache under a key
+                derived from the stage parameters and its inputs, instead of the output directory
+                of the stage. Changing the parameters of a stage thus only recomputes this stage
+                and the stages depending on it. Defaults to None.
+            storage (str, optional): Default storage of the saved stage outputs, either "files"
+                for one file per datapoint or "consolidated" for a single store per stage.
+                Can be overwritten in the params of a stage. Defaults to "files".
         """
         self.inputs = [] if inputs is None else inputs
         self.outputs = [] if outputs is None else outputs
+        self.cache = StageCache(cache_path) if cache_path is not None else None
         self.stages: List[PipelineStep] = list()
         self.stage_configs = list()
         path = output_path
@@ -259,11 +737,13 @@ class PipelineRunner:
             stage_class = dynamic_import_from(
                 f"histocartography.{name}", config.pop("class")
             )
+            params = config.pop("params", {})
+            params.setdefault("storage", storage)
             pipeline_stage = partial(
                 stage_class,
                 save_path=path if requires_saving else None,
                 precompute=False,
-                **config.pop("params", {}),
+                **params,
             )
             self.stages.append(pipeline_stage())
             self.stage_configs.append(config)
@@ -314,16 +794,24 @@ class PipelineRunner:
 
         # Validate inputs
         assert (
-            output_name is None or self.final_path is not None
-        ), f"Saving is only possible when output_path has been passed to the constructor."
+            output_name is None or self.final_path is not None or self.cache is not None
+        ), f"Saving is only possible when output_path or cache_path has been passed to the constructor."
         for input_name in self.inputs:
             assert input_name in inputs, f"{input_name} not found in keyword arguments"
 
         # Compute pipelines steps
         variables = deepcopy(inputs)
+        if self.cache is not None:
+            digests = {k: compute_digest(v) for k, v in variables.items()}
         for stage, config in zip(self.stages, self.stage_configs):
             step_input = [variables[k] for k in config["inputs"]]
-            step_output = stage.process(*step_input, output_name=output_name)
+            if self.cache is not None:
+                step_key = stage.cache_key([digests[k] for k in config["inputs"]])
+                step_output = self._process_cached(
+                    stage, step_key, step_input, output_name=output_name
+                )
+            else:
+                step_output = stage.process(*step_input, output_name=output_name)
             if not isinstance(step_output, tuple):
                 step_output = tuple([step_output])
             assert len(step_output) == len(config.get("outputs", [])), (
@@ -331,8 +819,11 @@ class PipelineRunner:
                 f"Got {len(step_output)} outputs of type {list(map(type, step_output))},"
                 f"but expected {len(config.get('outputs', []))} outputs"
             )
-            for key, value in zip(config.get("outputs", []), step_output):
+            for i, (key, value) in enumerate(zip(config.get("outputs", []), step_output)):
                 variables[key] = value
+                if self.cache is not None:
+                    # outputs are identified by how they were derived, not by their content
+                    digests[key] = hashlib.sha256(f"{step_key}:{i}".encode()).hexdigest()
 
         # Handle output
         for output_name in self.outputs:
@@ -341,6 +832,91 @@ class PipelineRunner:
             ), f"{output_name} should be returned, but was never computed"
         return {k: variables[k] for k in self.outputs}
 
+    def _process_cached(
+        self,
+        stage: PipelineStep,
+        key: str,
+        step_input: List[Any],
+        output_name: Optional[str] = None,
+    ) -> Any:
+        """Load the output of a stage from the cache or compute and cache it. If the stage saves
+           its outputs, the output is also saved to the output directory of the stage.
+
+        Args:
+            stage (PipelineStep): Stage to run
+            key (str): Cache key of the stage output
+            step_input (List[Any]): Inputs of the stage
+            output_name (Optional[str], optional): Unique identifier of the datapoint. Defaults to None.
+
+        Returns:
+            Any: Output of the stage
+        """
+        assert self.cache is not None, "Caching requires cache_path to be passed to the constructor."
+        if not stage.cacheable:
+            return stage.process(*step_input, output_name=output_name)
+        if key in self.cache:
+            logging.info(
+                f"{stage.__class__.__name__}: Output of {output_name} found in cache, using it instead of recomputing"
+            )
+            output = self.cache.load(stage, key)
+        else:
+            output = stage._process(*step_input)
+            self.cache.save(stage, key, output, output_name=output_name)
+        if output_name is not None:
+            stage._save_from_cache(self.cache.file_path(key), output_name, output)
+        return output
+
+
+def _disable_multithreading() -> None:
+    """Limit the numerical libraries of a worker process to a single thread"""
+    os.environ["OPENBLAS_NUM_THREADS"] = "1"
+    os.environ["MKL_NUM_THREADS"] = "1"
+    os.environ["OMP_NUM_THREADS"] = "1"
+
+
+# Runner owned by a persistent worker process, built once by _initialize_worker
+_WORKER_PIPELINE: Optional[PipelineRunner] = None
+_WORKER_WARMUP_TIME: Optional[float] = None
+
+
+def _initialize_worker(batch_runner: "BatchPipelineRunner") -> None:
+    """Pool initializer that builds the pipeline runner of the current worker process once
+
+    Args:
+        batch_runner (BatchPipelineRunner): Batch runner holding the pipeline configuration
+    """
+    global _WORKER_PIPELINE, _WORKER_WARMUP_TIME
+    _disable_multithreading()
+    start = time.perf_counter()
+    _WORKER_PIPELINE = batch_runner._build_pipeline_runner()
+    _WORKER_WARMUP_TIME = time.perf_counter() - start
+
+
+def _persistent_worker_task(
+    data: Tuple[Any, pd.core.series.Series]
+) -> Tuple[Any, int, Optional[float], float]:
+    """Runs the task of a single persistent worker with its already built pipeline runner
+
+    Args:
+        data (Tuple[Any, pd.core.series.Series]): The index and row of the dataframe,
+                                                  as returned from df.iterrows()
+
+    Returns:
+        Tuple[Any, int, Optional[float], float]: Name of the item, process id of the worker,
+            warm-up time of the worker (only reported with the first item of each worker,
+            None otherwise) and processing time of the item in seconds
+    """
+    global _WORKER_WARMUP_TIME
+    assert (
+        _WORKER_PIPELINE is not None
+    ), "Worker was not initialized, use _initialize_worker as pool initializer"
+    name, row = data
+    start = time.perf_counter()
+    _WORKER_PIPELINE.run(output_name=name, **row)
+    item_time = time.perf_counter() - start
+    warmup_time, _WORKER_WARMUP_TIME = _WORKER_WARMUP_TIME, None
+    return name, os.getpid(), warmup_time, item_time
+
 
 class BatchPipelineRunner:
     def __init__(
@@ -348,6 +924,9 @@ class BatchPipelineRunner:
         pipeline_config: Dict[str, Any],
         save_path: Optional[str],
         save_intermediate: bool = False,
+        persistent_workers: bool = False,
+        cache_path: Optional[str] = None,
+        storage: str = "files",
     ) -> None:
         """Run Helper that runs the pipeline for multiple inputs with multiprocessing support
 
@@ -355,10 +934,22 @@ class BatchPipelineRunner:
             pipeline_config (Dict[str, Any]): Configuration of the pipeline
             save_path (Optional[str]): Path to save the outputs to
             save_intermediate (bool, optional): Whether to save intermediate outputs. Defaults to False.
+            persistent_workers (bool, optional): Whether each worker process builds its pipeline
+                runner (and loads the models of its stages) once and reuses it for all the items
+                it processes, instead of building it for every item. Defaults to False.
+            cache_path (Optional[str], optional): Path to a content-addressed stage cache shared by
+                all workers. See PipelineRunner. Defaults to None.
+            storage (str, optional): Default storage of the saved stage outputs. With "consolidated",
+                all workers append to a single store per stage. See PipelineRunner. Defaults to "files".
         """
         self.pipeline_config = pipeline_config
         self.save_path = save_path
         self.save_intermediate = save_intermediate
+        self.persistent_workers = persistent_workers
+        self.cache_path = cache_path
+        self.storage = storage
+        self.warmup_times: Dict[int, float] = dict()
+        self.item_times: Dict[Any, float] = dict()
 
     def _build_pipeline_runner(self) -> PipelineRunner:
         """Builds and returns a PipelineRunner with the correct configuration
@@ -371,6 +962,8 @@ class BatchPipelineRunner:
             output_path=self.save_path,
             save_intermediate=self.save_intermediate,
             precompute=False,
+            cache_path=self.cache_path,
+            storage=self.storage,
             **config,
         )
 
@@ -382,9 +975,7 @@ class BatchPipelineRunner:
                                                       as returned from df.iterrows()
         """
         # Disable multiprocessing
-        os.environ["OPENBLAS_NUM_THREADS"] = "1"
-        os.environ["MKL_NUM_THREADS"] = "1"
-        os.environ["OMP_NUM_THREADS"] = "1"
+        _disable_multithreading()
 
         name, row = data
         pipeline = self._build_pipeline_runner()
@@ -433,6 +1024,11 @@ class BatchPipelineRunner:
                 If True, make sure you have enough memory. Only supported
                 for single-core processing. Default to False.
 
+        The warm-up time of each worker (building its pipeline runner) is stored in
+        self.warmup_times, keyed by process id, separately from the processing time of each
+        item, stored in self.item_times. With multiple cores, both are only recorded when
+        persistent_workers is set.
+
         Returns:
             batched_out (Optional[Dict[str, Dict[str, Any]]]): If return_out is True, returns the processed output.
                 Otherwise returns None
@@ -442,17 +1038,42 @@ class BatchPipelineRunner:
         ), "Option to return output only supported with single-core processing."
 
         self.precompute()
+        self.warmup_times = dict()
+        self.item_times = dict()
         if cores == 1:
             batched_out = dict()
+            start = time.perf_counter()
             pipeline = self._build_pipeline_runner()
+            self.warmup_times[os.getpid()] = time.perf_counter() - start
             for name, row in tqdm(
                 metadata.iterrows(), total=len(metadata), file=sys.stdout
             ):
+                start = time.perf_counter()
                 out = pipeline.run(output_name=name, **row)
+                self.item_times[name] = time.perf_counter() - start
                 if return_out:
                     batched_out[name] = out
+            self._log_timings()
             if return_out:
                 return batched_out
+        elif self.persistent_workers:
+            worker_pool = multiprocessing.Pool(
+                cores, initializer=_initialize_worker, initargs=(self,)
+            )
+            for name, pid, warmup_time, item_time in tqdm(
+                worker_pool.imap_unordered(
+                    _persistent_worker_task,
+                    metadata.iterrows(),
+                ),
+                total=len(metadata),
+                file=sys.stdout,
+            ):
+                if warmup_time is not None:
+                    self.warmup_times[pid] = warmup_time
+                self.item_times[name] = item_time
+            worker_pool.close()
+            worker_pool.join()
+            self._log_timings()
         else:
             worker_pool = multiprocessing.Pool(cores)
             for _ in tqdm(
@@ -467,3 +1088,20 @@ class BatchPipelineRunner:
             worker_pool.close()
             worker_pool.join()
         return None
+
+    def _log_timings(self) -> None:
+        """Log the warm-up time of the workers separately from the processing time of the items"""
+        if len(self.warmup_times) > 0:
+            warmup_times = list(self.warmup_times.values())
+            logging.info(
+                f"Worker warm-up: {len(warmup_times)} worker(s), "
+                f"{sum(warmup_times) / len(warmup_times):.3f}s on average, "
+                f"{max(warmup_times):.3f}s at most"
+            )
+        if len(self.item_times) > 0:
+            item_times = list(self.item_times.values())
+            logging.info(
+                f"Item processing: {len(item_times)} item(s), "
+                f"{sum(item_times) / len(item_times):.3f}s on average, "
+                f"{max(item_times):.3f}s at most"
+            )
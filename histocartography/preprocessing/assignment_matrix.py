@@ -2,6 +2,8 @@
 
 import logging
 from pathlib import Path
+from typing import Tuple
+
 import pandas as pd
 
 import numpy as np
@@ -13,6 +15,16 @@ class AssignmnentMatrixBuilder(PipelineStep):
     Assigning low-level instances to high-level instances using instance maps.
     """
 
+    def __init__(self, sparse: bool = False, **kwargs) -> None:
+        """
+        Args:
+            sparse (bool, optional): Whether to return the assignment as a compact vector holding the
+                                     index of the high-level instance of every low-level instance,
+                                     instead of a dense one-hot matrix. Defaults to False.
+        """
+        self.sparse = sparse
+        super().__init__(**kwargs)
+
     def _process(
         self, low_level_centroids: np.ndarray, high_level_map: np.ndarray
     ) -> np.ndarray:
@@ -21,15 +33,19 @@ class AssignmnentMatrixBuilder(PipelineStep):
             low_level_centroids (np.array): Extracted instance centroids in low-level
             high_level_map (np.array): Extracted high-level instance map
         Returns:
-            np.ndarray: Constructed assignment
+            np.ndarray: Constructed assignment, of shape (nr_low_level, nr_high_level) or (nr_low_level,)
+                        if sparse
         """
-        return self._build_assignment_matrix(
+        assignment, nr_high_level = self._build_assignment_index(
             low_level_centroids, high_level_map)
+        if self.sparse:
+            return assignment
+        return self._build_assignment_matrix(assignment, nr_high_level)
 
-    def _build_assignment_matrix(
+    def _build_assignment_index(
             self, low_level_centroids: np.ndarray, high_level_map: np.ndarray
-    ) -> np.ndarray:
-        """Construct assignment between inter-level instances"""
+    ) -> Tuple[np.ndarray, int]:
+        """Construct the index of the high-level instance of every low-level instance"""
         low_level_centroids = low_level_centroids.astype(int)
         high_instance_ids = np.sort(
             pd.unique(np.ravel(high_level_map))).astype(int)
@@ -41,14 +57,18 @@ class AssignmnentMatrixBuilder(PipelineStep):
         low_to_high = high_level_map[
             low_level_centroids[:, 1],
             low_level_centroids[:, 0]
-        ].astype(int)
-
-        assignment_matrix = np.zeros(
-            (
-                low_level_centroids.shape[0],
-                len(high_instance_ids)
-            )
-        )
-        # relevant instances in high_level_map begins from id=1
-        assignment_matrix[np.arange(low_to_high.size), low_to_high - 1] = 1
+        ].astype(np.int64)
+
+        # relevant instances in high_level_map begins from id=1, the background wraps around
+        # to the last instance as in the dense assignment matrix
+        assignment = low_to_high - 1
+        assignment[assignment < 0] += len(high_instance_ids)
+        return assignment, len(high_instance_ids)
+
+    def _build_assignment_matrix(
+            self, assignment: np.ndarray, nr_high_level: int
+    ) -> np.ndarray:
+        """Construct the one-hot assignment matrix between inter-level instances"""
+        assignment_matrix = np.zeros((assignment.size, nr_high_level))
+        assignment_matrix[np.arange(assignment.size), assignment] = 1
         return assignment_matrix
@@ -2,12 +2,13 @@
 
 import copy
 import math
+import os
 import warnings
 from abc import abstractmethod
 from pathlib import Path
 from collections import OrderedDict
-from copy import deepcopy
-from typing import Any, Callable, List, Optional, Tuple, Union
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import cv2
 import numpy as np
@@ -21,13 +22,26 @@ from skimage.feature import graycomatrix, graycoprops
 from skimage.filters.rank import entropy as Entropy
 from skimage.measure import regionprops
 from skimage.morphology import disk
-from sklearn.metrics.pairwise import euclidean_distances
 from torch import nn
 from torch.utils.data import DataLoader, Dataset
 from torchvision import transforms
 from tqdm.auto import tqdm
 
 from pipeline import PipelineStep
+from .region_features import (
+    FEATURE_PROVIDERS,
+    compute_convex_hull_perimeter,
+    compute_region_features,
+    crowdedness,
+)
+from preprocessing.utils import (
+    PARALLEL_BACKENDS,
+    RegionIndex,
+    export_model,
+    get_cached_model,
+    get_worker_pool,
+    load_model,
+)
 
 
 class FeatureExtractor(PipelineStep):
@@ -148,6 +162,35 @@ class FeatureExtractor(PipelineStep):
 class HandcraftedFeatureExtractor(FeatureExtractor):
     """Helper class to extract handcrafted features from instance maps"""
 
+    def __init__(
+        self,
+        bulk: bool = True,
+        n_jobs: int = 1,
+        parallel_backend: str = "processes",
+        **kwargs,
+    ) -> None:
+        """
+        Create a handcrafted feature extractor.
+
+        Args:
+            bulk (bool): If the features of all regions are computed at once with label-indexed
+                         reductions instead of region by region. Both give the same features.
+                         Defaults to True.
+            n_jobs (int): Number of workers that extract the features of horizontal bands of the
+                          instance map in parallel. -1 uses all cores. Defaults to 1.
+            parallel_backend (str): Worker pool used if n_jobs > 1, either "processes" or "threads".
+                                    Falls back to threads inside daemonic processes, eg. the
+                                    workers of a BatchPipelineRunner. Defaults to "processes".
+        """
+        assert parallel_backend in PARALLEL_BACKENDS, (
+            f"Unsupported parallel backend {parallel_backend}. "
+            f"Options are {PARALLEL_BACKENDS}"
+        )
+        super().__init__(**kwargs)
+        self.bulk = bulk
+        self.n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        self.parallel_backend = parallel_backend
+
     @staticmethod
     def _color_features_per_channel(
             img_rgb_ch,
@@ -173,7 +216,10 @@ class HandcraftedFeatureExtractor(FeatureExtractor):
         return feats_
 
     def _extract_features(
-        self, input_image: np.ndarray, instance_map: np.ndarray
+        self,
+        input_image: np.ndarray,
+        instance_map: np.ndarray,
+        feature_names: Optional[List[str]] = None,
     ) -> torch.Tensor:
         """
         Extract handcrafted features from the input_image in the defined instance_map regions.
@@ -182,6 +228,10 @@ class HandcraftedFeatureExtractor(FeatureExtractor):
             input_image (np.array): Original RGB Image.
             instance_map (np.array): Extracted instance_map. Different regions have different int values,
                                      the background is defined to have value 0 and is ignored.
+            feature_names (List[str]): Names of the features to extract, in this order. Only these
+                                       features and the ones they depend on are computed.
+                                       If None, all HANDCRAFTED_FEATURES_NAMES are extracted.
+                                       Defaults to None.
 
         Returns:
             torch.Tensor: Extracted shape, color and texture features:
@@ -192,21 +242,77 @@ class HandcraftedFeatureExtractor(FeatureExtractor):
                           Crowdedness: mean_crowdedness, std_crowdedness
 
         """
+        names = (
+            list(HANDCRAFTED_FEATURES_NAMES.keys())
+            if feature_names is None else feature_names
+        )
+        if self.n_jobs > 1:
+            features = self._extract_region_features_parallel(
+                input_image, instance_map, names)
+        else:
+            features = self._compute_features(
+                input_image, instance_map, names, self.bulk)
+
+        node_feat = np.stack(
+            [features[name] for name in names], axis=1).astype(np.float64)
+        return torch.Tensor(node_feat)
+
+    @staticmethod
+    def _compute_features(
+        input_image: np.ndarray,
+        instance_map: np.ndarray,
+        names: List[str],
+        bulk: bool,
+    ) -> Dict[str, np.ndarray]:
+        """
+        Compute the requested features and the features they depend on.
+
+        Args:
+            input_image (np.array): Original RGB Image.
+            instance_map (np.array): Extracted instance_map.
+            names (List[str]): Names of the features to compute.
+            bulk (bool): If the features of all regions are computed at once.
+
+        Returns:
+            Dict[str, np.ndarray]: Computed features per instance, ordered by label.
+        """
+        if bulk:
+            return compute_region_features(
+                RegionIndex.of(instance_map), input_image, names)
+        node_feat, centroids = HandcraftedFeatureExtractor._extract_region_features(
+            input_image, instance_map)
+        features = {
+            name: node_feat[:, i]
+            for name, i in HANDCRAFTED_FEATURES_NAMES.items()
+            if i < node_feat.shape[1]
+        }
+        features["centroid"] = centroids
+        return compute_region_features(None, input_image, names, features)
+
+    @staticmethod
+    def _extract_region_features(
+        input_image: np.ndarray, instance_map: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Extract the shape and texture features region by region.
+
+        Args:
+            input_image (np.array): Original RGB Image.
+            instance_map (np.array): Extracted instance_map.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Shape and texture features of shape [nr_instances, 22]
+                                           and centroids of the instances, ordered by label.
+        """
         node_feat = []
 
         img_gray = cv2.cvtColor(input_image, cv2.COLOR_RGB2GRAY)
-        img_square = np.square(input_image)
 
         # For each instance
         regions = regionprops(instance_map)
+        centroids = np.array([r.centroid for r in regions]).reshape(-1, 2)
 
-        # pre-extract centroids to compute crowdedness
-        centroids = [r.centroid for r in regions]
-        all_mean_crowdedness, all_std_crowdedness = self._compute_crowdedness(
-            centroids)
-
-        for region_id, region in enumerate(regions):
-
+        for region in regions:
             sp_mask = instance_map[region['bbox'][0]:region['bbox'][2], region['bbox'][1]:region['bbox'][3]] == region['label'] 
             sp_gray = img_gray[region['bbox'][0]:region['bbox'][2], region['bbox'][1]:region['bbox'][3]] * sp_mask
 
@@ -223,7 +329,7 @@ class HandcraftedFeatureExtractor(FeatureExtractor):
             orientation = region["orientation"]
             perimeter = region["perimeter"]
             solidity = region["solidity"]
-            convex_hull_perimeter = self._compute_convex_hull_perimeter(sp_mask)
+            convex_hull_perimeter = compute_convex_hull_perimeter(sp_mask)
             roughness = convex_hull_perimeter / perimeter
             shape_factor = 4 * np.pi * area / convex_hull_perimeter ** 2
             ellipticity = minor_axis_length / major_axis_length
@@ -249,19 +355,19 @@ class HandcraftedFeatureExtractor(FeatureExtractor):
             ]
 
             # GLCM texture features (gray color space) [5 features]
-            glcm = greycomatrix(sp_gray, [1], [0])
+            glcm = graycomatrix(sp_gray, [1], [0])
             # Filter out the first row and column
             filt_glcm = glcm[1:, 1:, :, :]
 
-            glcm_contrast = greycoprops(filt_glcm, prop="contrast")
+            glcm_contrast = graycoprops(filt_glcm, prop="contrast")
             glcm_contrast = glcm_contrast[0, 0]
-            glcm_dissimilarity = greycoprops(filt_glcm, prop="dissimilarity")
+            glcm_dissimilarity = graycoprops(filt_glcm, prop="dissimilarity")
             glcm_dissimilarity = glcm_dissimilarity[0, 0]
-            glcm_homogeneity = greycoprops(filt_glcm, prop="homogeneity")
+            glcm_homogeneity = graycoprops(filt_glcm, prop="homogeneity")
             glcm_homogeneity = glcm_homogeneity[0, 0]
-            glcm_energy = greycoprops(filt_glcm, prop="energy")
+            glcm_energy = graycoprops(filt_glcm, prop="energy")
             glcm_energy = glcm_energy[0, 0]
-            glcm_ASM = greycoprops(filt_glcm, prop="ASM")
+            glcm_ASM = graycoprops(filt_glcm, prop="ASM")
             glcm_ASM = glcm_ASM[0, 0]
             glcm_dispersion = np.std(filt_glcm)
 
@@ -274,48 +380,102 @@ class HandcraftedFeatureExtractor(FeatureExtractor):
                 glcm_dispersion,
             ]
 
-            feats_crowdedness = [
-                all_mean_crowdedness[region_id],
-                all_std_crowdedness[region_id],
-            ]
-
-            sp_feats = feats_shape + feats_texture + feats_crowdedness
+            sp_feats = feats_shape + feats_texture
             features = np.hstack(sp_feats)
             node_feat.append(features)
 
-        node_feat = np.vstack(node_feat)
-        return torch.Tensor(node_feat)
+        node_feat = np.vstack(node_feat) if node_feat else np.empty((0, 22))
+        return node_feat, centroids
 
     @staticmethod
-    def _compute_crowdedness(centroids, k=10):
-        n_centroids = len(centroids)
-        if n_centroids < 3:
-            mean_crow = np.array([[0]] * n_centroids)
-            std_crow = np.array([[0]] * n_centroids)
-            return mean_crow, std_crow
-        if n_centroids < k:
-            k = n_centroids - 2
-        dist = euclidean_distances(centroids, centroids)
-        idx = np.argpartition(dist, kth=k + 1, axis=-1)
-        x = np.take_along_axis(dist, idx, axis=-1)[:, : k + 1]
-        std_crowd = np.reshape(np.std(x, axis=1), newshape=(-1, 1))
-        mean_crow = np.reshape(np.mean(x, axis=1), newshape=(-1, 1))
-        return mean_crow, std_crowd
+    def _compute_crowdedness(centroids, k=10, index=None):
+        """Compute the mean and standard deviation of the distances of each centroid to its k
+        nearest centroids (including itself) with a KD-tree.
+
+        Args:
+            centroids (np.ndarray): Centroids of the instances.
+            k (int): Number of neighbors. Defaults to 10.
+            index (NeighborIndex): Neighbor index of the centroids to reuse. Defaults to None.
+        """
+        mean_crow, std_crowd = crowdedness(centroids, k=k, index=index)
+        return np.reshape(mean_crow, (-1, 1)), np.reshape(std_crowd, (-1, 1))
+
+    def _extract_region_features_parallel(
+        self, input_image: np.ndarray, instance_map: np.ndarray, names: List[str]
+    ) -> Dict[str, np.ndarray]:
+        """
+        Extract the features of horizontal bands of the instance map in a pool of n_jobs workers.
+        Each band holds the instances whose bounding box starts in it, and the results are
+        gathered in the order of the labels. Crowdedness is computed on the whole instance map.
+
+        Args:
+            input_image (np.array): Original RGB Image.
+            instance_map (np.array): Extracted instance_map.
+            names (List[str]): Names of the features to extract.
+
+        Returns:
+            Dict[str, np.ndarray]: Extracted features per instance, ordered by label.
+        """
+        pixels = RegionIndex.of(instance_map)
+        features = compute_region_features(pixels, input_image, ["area"])
+        band_names = [
+            name for name in names
+            if FEATURE_PROVIDERS.get(name) not in ["area", "crowdedness"]
+        ]
+        if pixels.nr_instances == 0 or len(band_names) == 0:
+            return compute_region_features(pixels, input_image, names, features)
+        area = features["area"]
+
+        # bands with a similar number of instance pixels, several per worker to balance the load
+        starts = np.array([s[0].start for s in pixels.slices], dtype=np.int64)
+        order = np.argsort(starts, kind="stable")
+        cumulative_area = np.cumsum(area[order])
+        nr_chunks = min(pixels.nr_instances, 4 * self.n_jobs)
+        bounds = np.searchsorted(
+            cumulative_area,
+            np.linspace(0, cumulative_area[-1], nr_chunks + 1)[1:-1],
+        )
+        chunks = [c for c in np.split(order, bounds) if len(c) > 0]
+
+        tasks = []
+        for chunk in chunks:
+            top = starts[chunk].min()
+            bottom = max(pixels.slices[i][0].stop for i in chunk)
+            band = pixels.index_map[top:bottom]
+            in_chunk = np.zeros(pixels.nr_instances + 1, dtype=bool)
+            in_chunk[chunk + 1] = True
+            tasks.append(
+                (
+                    input_image[top:bottom],
+                    np.where(in_chunk[band], instance_map[top:bottom], 0),
+                    band_names,
+                    self.bulk,
+                )
+            )
+
+        with get_worker_pool(min(self.n_jobs, len(tasks)), self.parallel_backend) as pool:
+            results = pool.starmap(_extract_region_features_task, tasks)
+
+        node_feat = np.empty((pixels.nr_instances, len(band_names)), dtype=np.float64)
+        for chunk, band_feat in zip(chunks, results):
+            # instances of a band are ordered by label, as the instances of the whole map
+            node_feat[np.sort(chunk)] = band_feat
+        for i, name in enumerate(band_names):
+            features[name] = node_feat[:, i]
+        return compute_region_features(pixels, input_image, names, features)
 
     def _compute_convex_hull_perimeter(self, sp_mask):
         """Compute the perimeter of the convex hull induced by the input mask."""
-        if cv2.__version__[0] == "3":
-            _, contours, _ = cv2.findContours(
-                np.uint8(sp_mask), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE
-            )
-        elif cv2.__version__[0] == "4":
-            contours, _ = cv2.findContours(
-                np.uint8(sp_mask), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE
-            )
-        hull = cv2.convexHull(contours[0])
-        convex_hull_perimeter = cv2.arcLength(hull, True)
+        return compute_convex_hull_perimeter(sp_mask)
+
 
-        return convex_hull_perimeter
+def _extract_region_features_task(
+    input_image: np.ndarray, instance_map: np.ndarray, names: List[str], bulk: bool
+) -> np.ndarray:
+    """Worker task of HandcraftedFeatureExtractor._extract_region_features_parallel"""
+    features = HandcraftedFeatureExtractor._compute_features(
+        input_image, instance_map, names, bulk)
+    return np.stack([features[name] for name in names], axis=1)
 
 
 class PatchFeatureExtractor:
@@ -332,24 +492,35 @@ class PatchFeatureExtractor:
         Create a patch feature extracter of a given architecture and put it on GPU if available.
 
         Args:
-            architecture (str): String of architecture. According to torchvision.models syntax.
+            architecture (str): String of architecture. According to torchvision.models syntax,
+                                or path of a .pth model, possibly a TorchScript artifact saved by export.
             device (torch.device): Torch Device.
             patch_size (int): Desired size of patch.
             extraction_layer (Optional[str]): Name of the network module from where the features are extracted.
         """
         self.device = device
+        self.patch_size = patch_size
 
-        if architecture.startswith("s3://mlflow"):
-            model = self._get_mlflow_model(url=architecture)
-        elif architecture.endswith(".pth"):
-            model = self._get_local_model(path=architecture)
-        else:
-            model = self._get_torchvision_model(architecture).to(self.device)
-
-        self._validate_model(model)
-        self.model = self._remove_layers(model, extraction_layer)
-        self.num_features = self._get_num_features(model, patch_size)
-        self.model.eval()
+        def load():
+            if architecture.startswith("s3://mlflow"):
+                model = self._get_mlflow_model(url=architecture)
+            elif architecture.endswith(".pth"):
+                model = self._get_local_model(path=architecture)
+            else:
+                model = self._get_torchvision_model(architecture).to(self.device)
+
+            if not isinstance(model, torch.jit.ScriptModule):
+                # traced models are exported without their unused layers
+                self._validate_model(model)
+                model = self._remove_layers(model, extraction_layer)
+            model.eval()
+            return model
+
+        # the model is loaded once per process and shared by the extractors asking for it
+        self.model = get_cached_model(
+            (architecture, extraction_layer, str(self.device)), load)
+        with torch.no_grad():
+            self.num_features = self._get_num_features(self.model, patch_size)
 
     @staticmethod
     def _validate_model(model: nn.Module) -> None:
@@ -385,7 +556,7 @@ class PatchFeatureExtractor:
 
     def _get_local_model(self, path: str) -> nn.Module:
         """
-        Load a model from a local path.
+        Load a model, or a TorchScript artifact saved by export, from a local path.
 
         Args:
             path (str): Path to the model.
@@ -393,7 +564,7 @@ class PatchFeatureExtractor:
         Returns:
             nn.Module: A PyTorch model.
         """
-        model = torch.load(path, map_location=self.device)
+        model = load_model(path, map_location=self.device)
         return model
 
     def _get_mlflow_model(self, url: str) -> nn.Module:
@@ -459,6 +630,36 @@ class PatchFeatureExtractor:
                 model.features = _remove_modules(model.features, extraction_layer)
         return model
 
+    def export(self, path: str) -> None:
+        """
+        Save the embedding model as a traced TorchScript artifact, to be loaded as architecture.
+
+        Args:
+            path (str): Path of the artifact. Must end with .pth.
+        """
+        assert path.endswith(".pth"), "Local models are loaded from .pth files"
+        export_model(
+            self.model,
+            torch.zeros(1, 3, self.patch_size, self.patch_size, device=self.device),
+            path,
+        )
+
+    def embed_augmentations(self, patches: torch.Tensor, augmentations: List[Callable]) -> torch.Tensor:
+        """
+        Computes the embeddings of the augmentations of a batch of normalized patches in a single forward pass.
+
+        Args:
+            patches (torch.Tensor): Normalized patches of shape [nr_patches, 3, H, W].
+            augmentations (List[Callable]): Augmentations of batches of patches.
+
+        Returns:
+            torch.Tensor: Embeddings of shape [nr_patches, nr_augmentations, nr_features].
+        """
+        patches = patches.to(self.device)
+        embeddings = self(torch.cat([augmentation(patches) for augmentation in augmentations]))
+        embeddings = embeddings.reshape(len(augmentations), len(patches), -1)
+        return embeddings.transpose(0, 1)
+
     def __call__(self, patch: torch.Tensor) -> torch.Tensor:
         """
         Computes the embedding of a normalized image input.
@@ -490,6 +691,7 @@ class InstanceMapPatchDataset(Dataset):
         std: Optional[List[float]] = None,
         transform: Optional[Callable] = None,
         with_instance_masking: Optional[bool] = False,
+        batched: bool = False,
     ) -> None:
         """
         Create a dataset for a given image and extracted instance map with desired patches
@@ -507,9 +709,14 @@ class InstanceMapPatchDataset(Dataset):
             std (list[float], optional): Channel-wise std for image normalization.
             transform (Callable): Transform to apply. Defaults to None.
             with_instance_masking (bool): If pixels outside instance should be masked. Defaults to False.
+            batched (bool): If True, items are patch indices that the collate method gathers and transforms
+                            batch-wise on tensors, with transform applied to batches of values in [0, 255] of shape
+                            (B, 3, H, W). Otherwise items are transformed one by one through PIL images.
+                            Defaults to False.
         """
         self.image = image
         self.instance_map = instance_map
+        self.regions = RegionIndex.of(instance_map)
         self.patch_size = patch_size
         self.with_instance_masking = with_instance_masking
         self.fill_value = fill_value
@@ -535,12 +742,9 @@ class InstanceMapPatchDataset(Dataset):
         )
         self.patch_size_2 = int(self.patch_size // 2)
         self.threshold = int(self.patch_size * self.patch_size * 0.25)
-        self.properties = regionprops(self.instance_map)
         self.warning_threshold = 0.75
-        self.patch_coordinates = []
-        self.patch_region_count = []
-        self.patch_instance_ids = []
-        self.patch_overlap = []
+        self.batched = batched
+        self.transform = transform
 
         basic_transforms = [transforms.ToPILImage()]
         if self.resize_size is not None:
@@ -555,28 +759,6 @@ class InstanceMapPatchDataset(Dataset):
         self._precompute()
         self._warning()
 
-    def _add_patch(self, center_x: int, center_y: int, instance_index: int, region_count: int) -> None:
-        """
-        Extract and include patch information.
-
-        Args:
-            center_x (int): Centroid x-coordinate of the patch wrt. the instance map.
-            center_y (int): Centroid y-coordinate of the patch wrt. the instance map.
-            instance_index (int): Instance index to which the patch belongs.
-            region_count (int): Region count indicates the location of the patch wrt. the list of patch coords.
-        """
-        mask = self.instance_map[
-            center_y - self.patch_size_2: center_y + self.patch_size_2,
-            center_x - self.patch_size_2: center_x + self.patch_size_2
-        ]
-        overlap = np.sum(mask == instance_index)
-        if overlap > self.threshold:
-            loc = [center_x - self.patch_size_2, center_y - self.patch_size_2]
-            self.patch_coordinates.append(loc)
-            self.patch_region_count.append(region_count)
-            self.patch_instance_ids.append(instance_index)
-            self.patch_overlap.append(overlap)
-
     def _get_patch(self, loc: list, region_id: int = None) -> np.ndarray:
         """
         Extract patch from image.
@@ -599,53 +781,54 @@ class InstanceMapPatchDataset(Dataset):
         return patch
 
     def _precompute(self):
-        """Precompute instance-wise patch information for all instances in the input image."""
-        for region_count, region in enumerate(self.properties):
-
-            # Extract centroid
-            center_y, center_x = region.centroid
-            center_x = int(round(center_x))
-            center_y = int(round(center_y))
-
-            # Extract bounding box
-            min_y, min_x, max_y, max_x = region.bbox
-
-            # Extract patch information around the centroid patch 
-            # quadrant 1 (includes centroid patch)
-            y_ = copy.deepcopy(center_y)
-            while y_ >= min_y:
-                x_ = copy.deepcopy(center_x)
-                while x_ >= min_x:
-                    self._add_patch(x_, y_, region.label, region_count)
-                    x_ -= self.stride
-                y_ -= self.stride
-
-            # quadrant 4
-            y_ = copy.deepcopy(center_y)
-            while y_ >= min_y:
-                x_ = copy.deepcopy(center_x) + self.stride
-                while x_ <= max_x:
-                    self._add_patch(x_, y_, region.label, region_count)
-                    x_ += self.stride
-                y_ -= self.stride
-
-            # quadrant 2
-            y_ = copy.deepcopy(center_y) + self.stride
-            while y_ <= max_y:
-                x_ = copy.deepcopy(center_x)
-                while x_ >= min_x:
-                    self._add_patch(x_, y_, region.label, region_count)
-                    x_ -= self.stride
-                y_ += self.stride
-
-            # quadrant 3
-            y_ = copy.deepcopy(center_y) + self.stride
-            while y_ <= max_y:
-                x_ = copy.deepcopy(center_x) + self.stride
-                while x_ <= max_x:
-                    self._add_patch(x_, y_, region.label, region_count)
-                    x_ += self.stride
-                y_ += self.stride
+        """Precompute instance-wise patch information for all instances in the input image.
+           Candidate patches are centered on a grid of step stride anchored at the centroid and spanning
+           the bounding box of the instance, enumerated quadrant by quadrant. A patch is kept if more
+           than a quarter of it belongs to the instance.
+        """
+        # centroids and bounding boxes in the padded instance map
+        centroids = np.round(self.regions.centroids + self.patch_size).astype(int)
+        bboxes = self.regions.bboxes + self.patch_size
+        size = 2 * self.patch_size_2
+        coordinates, region_counts, instance_ids, overlaps = [], [], [], []
+        for region_count, label in enumerate(self.regions.labels.tolist()):
+            center_y, center_x = centroids[region_count]
+            min_y, min_x, max_y, max_x = bboxes[region_count]
+
+            # patch centers of the quadrants 1 (includes centroid patch), 4, 2 and 3
+            ys_down = np.arange(center_y, min_y - 1, -self.stride)
+            ys_up = np.arange(center_y + self.stride, max_y + 1, self.stride)
+            xs_down = np.arange(center_x, min_x - 1, -self.stride)
+            xs_up = np.arange(center_x + self.stride, max_x + 1, self.stride)
+            grids = [
+                np.meshgrid(ys, xs, indexing="ij")
+                for ys, xs in [(ys_down, xs_down), (ys_down, xs_up), (ys_up, xs_down), (ys_up, xs_up)]
+            ]
+            top = np.concatenate([y.ravel() for y, _ in grids]) - self.patch_size_2
+            left = np.concatenate([x.ravel() for _, x in grids]) - self.patch_size_2
+
+            # overlap of the patches with the instance from a summed-area table around it
+            crop_y = min_y - self.patch_size_2
+            crop_x = min_x - self.patch_size_2
+            mask = self.instance_map[crop_y:max_y + self.patch_size_2, crop_x:max_x + self.patch_size_2] == label
+            table = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int64)
+            table[1:, 1:] = mask.cumsum(axis=0).cumsum(axis=1)
+            y0, x0 = top - crop_y, left - crop_x
+            overlap = (
+                table[y0 + size, x0 + size] - table[y0, x0 + size]
+                - table[y0 + size, x0] + table[y0, x0]
+            )
+
+            keep = overlap > self.threshold
+            coordinates.append(np.stack([left[keep], top[keep]], axis=1))
+            region_counts.extend([region_count] * int(keep.sum()))
+            instance_ids.extend([label] * int(keep.sum()))
+            overlaps.append(overlap[keep])
+
+        self.patch_coordinates = np.concatenate(coordinates + [np.empty((0, 2), dtype=int)])
+        self.patch_region_count = region_counts
+        self.patch_instance_ids = instance_ids
+        self.patch_overlap = np.concatenate(overlaps + [np.empty(0, dtype=int)])
 
     def _warning(self):
         """Check patch coverage statistics to identify if provided patch size includes too much background."""
@@ -657,7 +840,7 @@ class InstanceMapPatchDataset(Dataset):
             warnings.warn(
                 "Suggestion: Reduce patch size to include relevant context.")
 
-    def __getitem__(self, index: int) -> Tuple[torch.Tensor, int]:
+    def __getitem__(self, index: int) -> Tuple[int, Union[torch.Tensor, int]]:
         """
         Loads an image for a given patch index.
 
@@ -665,8 +848,10 @@ class InstanceMapPatchDataset(Dataset):
             index (int): Patch index.
 
         Returns:
-            Tuple[int, torch.Tensor]: instance_index, image as tensor.
+            Tuple[int, Union[torch.Tensor, int]]: instance_index, image as tensor or patch index if batched.
         """
+        if self.batched:
+            return self.patch_region_count[index], index
         patch = self._get_patch(
             self.patch_coordinates[index],
             self.patch_instance_ids[index]
@@ -674,6 +859,36 @@ class InstanceMapPatchDataset(Dataset):
         patch = self.dataset_transform(patch)
         return self.patch_region_count[index], patch
 
+    def collate(self, batch: List[Tuple[int, Union[torch.Tensor, int]]]) -> Tuple[List[int], torch.Tensor]:
+        """
+        Collate function of the items, which gathers and transforms the patches batch-wise if batched.
+
+        Args:
+            batch (List[Tuple[int, Union[torch.Tensor, int]]]): Items of the dataset.
+
+        Returns:
+            Tuple[List[int], torch.Tensor]: instance_indices, images as tensor.
+        """
+        instance_indices = [item[0] for item in batch]
+        if not self.batched:
+            return instance_indices, torch.stack([item[1] for item in batch])
+
+        indices = np.array([item[1] for item in batch], dtype=int)
+        min_x, min_y = self.patch_coordinates[indices].T
+        # strided views of all windows, gathered in a single copy
+        windows = np.lib.stride_tricks.sliding_window_view(
+            self.image, (self.patch_size, self.patch_size), axis=(0, 1))
+        patches = windows[min_y, min_x]  # B, 3, H, W
+        if self.with_instance_masking:
+            instance_windows = np.lib.stride_tricks.sliding_window_view(
+                self.instance_map, (self.patch_size, self.patch_size))
+            instance_ids = np.array(self.patch_instance_ids)[indices]
+            instance_mask = instance_windows[min_y, min_x] != instance_ids[:, None, None]
+            patches = np.where(instance_mask[:, None], np.uint8(self.fill_value), patches)
+        patches = _transform_patch_batch(
+            torch.from_numpy(patches), self.resize_size, self.transform, self.mean, self.std)
+        return instance_indices, patches
+
     def __len__(self) -> int:
         """
         Returns the length of the dataset.
@@ -757,18 +972,12 @@ class DeepFeatureExtractor(FeatureExtractor):
         if self.num_workers in [0, 1]:
             torch.set_num_threads(1)
 
-    def _collate_patches(self, batch):
-        """Patch collate function"""
-        instance_indices = [item[0] for item in batch]
-        patches = [item[1] for item in batch]
-        patches = torch.stack(patches)
-        return instance_indices, patches
-
     def _extract_features(
         self,
         input_image: np.ndarray,
         instance_map: np.ndarray,
-        transform: Optional[Callable] = None
+        transform: Optional[Callable] = None,
+        augmentations: Optional[List[Callable]] = None
     ) -> torch.Tensor:
         """
         Extract features for a given RGB image and its extracted instance_map.
@@ -777,9 +986,13 @@ class DeepFeatureExtractor(FeatureExtractor):
             input_image (np.ndarray): RGB input image.
             instance_map (np.ndarray): Extracted instance_map.
             transform (Callable): Transform to apply. Defaults to None.
+            augmentations (Optional[List[Callable]]): Augmentations applied to the transformed batches
+                of patches, see _build_batch_augmentations. Defaults to None.
         Returns:
-            torch.Tensor: Extracted features of shape [nr_instances, nr_features]
+            torch.Tensor: Extracted features of shape [nr_instances, nr_features], or
+                [nr_instances, nr_augmentations, nr_features] with augmentations.
         """
+        nr_augmentations = 1 if augmentations is None else len(augmentations)
         if self.downsample_factor != 1:
             input_image = self._downsample(input_image, self.downsample_factor)
             instance_map = self._downsample(
@@ -796,37 +1009,41 @@ class DeepFeatureExtractor(FeatureExtractor):
             std=self.normalizer_std,
             transform=transform,
             with_instance_masking=self.with_instance_masking,
+            batched=True,
         )
         image_loader = DataLoader(
             image_dataset,
             shuffle=False,
             batch_size=self.batch_size,
             num_workers=self.num_workers,
-            collate_fn=self._collate_patches
+            collate_fn=image_dataset.collate
         )
-        features = torch.empty(
+        # sum and number of the patch embeddings of every instance
+        features = torch.zeros(
             size=(
-                len(image_dataset.properties),
-                self.patch_feature_extractor.num_features,
+                image_dataset.regions.nr_instances,
+                nr_augmentations * self.patch_feature_extractor.num_features,
             ),
             dtype=torch.float32,
             device=self.device,
         )
-        embeddings = dict()
+        counts = torch.zeros(
+            image_dataset.regions.nr_instances, dtype=torch.float32, device=self.device)
         for instance_indices, patches in tqdm(
             image_loader, total=len(image_loader), disable=not self.verbose
         ):
-            emb = self.patch_feature_extractor(patches)
-            for j, key in enumerate(instance_indices):
-                if key in embeddings:
-                    embeddings[key][0] += emb[j]
-                    embeddings[key][1] += 1
-                else:
-                    embeddings[key] = [emb[j], 1]
-
-        for k, v in embeddings.items():
-            features[k, :] = v[0] / v[1]
-
+            if augmentations is None:
+                emb = self.patch_feature_extractor(patches)
+            else:
+                emb = self.patch_feature_extractor.embed_augmentations(patches, augmentations)
+            instance_indices = torch.as_tensor(instance_indices, device=self.device)
+            features.index_add_(0, instance_indices, emb.reshape(len(instance_indices), -1).float())
+            counts.index_add_(0, instance_indices, torch.ones(len(instance_indices), device=self.device))
+
+        # instances without patches keep zero features
+        features /= counts.clamp(min=1).unsqueeze(1)
+        if augmentations is not None:
+            features = features.reshape(len(features), nr_augmentations, -1)
         return features.cpu().detach()
 
 
@@ -857,8 +1074,9 @@ class AugmentedDeepFeatureExtractor(DeepFeatureExtractor):
             fill_value=self.fill_value,
             output_size=(self.patch_size, self.patch_size),
         )
+        self.batch_augmentations = _build_batch_augmentations(rotations=rotations, flips=flips)
 
-    def _extract_features(
+    def _extract_features(  # type: ignore[override]
         self,
         input_image: np.ndarray,
         instance_map: np.ndarray,
@@ -866,6 +1084,8 @@ class AugmentedDeepFeatureExtractor(DeepFeatureExtractor):
     ) -> torch.Tensor:
         """
         Extract features for a given RGB image and its extracted instance_map for all augmentations.
+        If the rotations are multiples of 90 degrees, the patches are read once and their augmentations
+        are embedded in stacked batches. Otherwise the patches are read once per augmentation.
 
         Args:
             input_image (np.ndarray): RGB input image.
@@ -875,6 +1095,9 @@ class AugmentedDeepFeatureExtractor(DeepFeatureExtractor):
         Returns:
             torch.Tensor: Extracted features of shape [nr_instances, nr_augmentations, nr_features].
         """
+        if self.batch_augmentations is not None:
+            return super()._extract_features(
+                input_image, instance_map, augmentations=self.batch_augmentations)
 
         all_features = list()
         for transform in self.transforms:
@@ -897,6 +1120,7 @@ class GridPatchDataset(Dataset):
         mean: Optional[List[float]] = None,
         std: Optional[List[float]] = None,
         transform: Optional[Callable] = None,
+        batched: bool = False,
     ) -> None:
         """
         Create a dataset for a given image and extracted instance maps with desired patches
@@ -911,8 +1135,16 @@ class GridPatchDataset(Dataset):
             mean (list[float], optional): Channel-wise mean for image normalization.
             std (list[float], optional): Channel-wise std for image normalization.
             transform (list[transforms], optional): List of transformations for input image.
+            batched (bool): If True, items are patch indices that the collate method gathers and transforms
+                            batch-wise on tensors, with transform applied to batches of values in [0, 255] of shape
+                            (B, 3, H, W). Otherwise items are transformed one by one through PIL images.
+                            Defaults to False.
         """
         super().__init__()
+        self.batched = batched
+        self.transform = transform
+        self.mean = mean
+        self.std = std
         basic_transforms = [transforms.ToPILImage()]
         self.resize_size = resize_size
         if self.resize_size is not None:
@@ -955,12 +1187,30 @@ class GridPatchDataset(Dataset):
             index (int): Patch index.
 
         Returns:
-            Tuple[int, torch.Tensor]: Patch index, image as tensor.
+            Tuple[int, torch.Tensor]: Patch index, image as tensor. Only the patch index if batched.
         """
+        if self.batched:
+            return index
         patch = self.dataset_transform(
             self.patches[index].numpy().transpose([1, 2, 0]))
         return index, patch
 
+    def collate(self, batch: List[Union[Tuple[int, torch.Tensor], int]]) -> Tuple[List[int], torch.Tensor]:
+        """
+        Collate function of the items, which gathers and transforms the patches batch-wise if batched.
+
+        Args:
+            batch (List[Union[Tuple[int, torch.Tensor], int]]): Items of the dataset.
+
+        Returns:
+            Tuple[List[int], torch.Tensor]: Patch indices, images as tensor.
+        """
+        if not self.batched:
+            return [item[0] for item in batch], torch.stack([item[1] for item in batch])
+        patches = _transform_patch_batch(
+            self.patches[batch], self.resize_size, self.transform, self.mean, self.std)
+        return list(batch), patches
+
     def __len__(self) -> int:
         return len(self.patches)
 
@@ -1002,7 +1252,10 @@ class MaskedGridPatchDataset(GridPatchDataset):
 
         Returns:
             Tuple[int, torch.Tensor, torch.Tensor]: Patch index, image as tensor, mask as tensor.
+                                                    Only the patch index if batched.
         """
+        if self.batched:
+            return index
         image_patch = self.dataset_transform(self.patches[index].numpy().transpose([1, 2, 0]))
         if self.mask_transform is not None:
             # after resizing, the mask should still be binary and of type uint8
@@ -1012,6 +1265,42 @@ class MaskedGridPatchDataset(GridPatchDataset):
             mask_patch = self.mask_patches[index]
         return index, image_patch, mask_patch
 
+    def tissue_fractions(self) -> np.ndarray:
+        """
+        Fraction of tissue in each mask patch, at the resolution of the mask.
+
+        Returns:
+            np.ndarray: Tissue fractions of the patches.
+        """
+        mask_patches = self.mask_patches.flatten(start_dim=1)
+        return ((mask_patches == 1).sum(dim=1) / mask_patches.shape[1]).numpy()
+
+    def collate(  # type: ignore[override]
+        self, batch: List[Union[Tuple[int, torch.Tensor, torch.Tensor], int]]
+    ) -> Tuple[List[int], torch.Tensor, torch.Tensor]:
+        """
+        Collate function of the items, which gathers and transforms the patches batch-wise if batched.
+
+        Args:
+            batch (List[Union[Tuple[int, torch.Tensor, torch.Tensor], int]]): Items of the dataset.
+
+        Returns:
+            Tuple[List[int], torch.Tensor, torch.Tensor]: Patch indices, images as tensor, masks as tensor.
+        """
+        if not self.batched:
+            return (
+                [item[0] for item in batch],
+                torch.stack([item[1] for item in batch]),
+                torch.stack([item[2] for item in batch]),
+            )
+        indices, image_patches = super().collate(batch)
+        mask_patches = self.mask_patches[batch]
+        if self.resize_size is not None:
+            # after resizing, the mask should still be binary and of type uint8
+            mask_patches = _transform_patch_batch(255 * mask_patches, self.resize_size)
+            mask_patches = torch.round(mask_patches).type(torch.uint8)
+        return indices, image_patches, mask_patches
+
 
 class GridDeepFeatureExtractor(FeatureExtractor):
     def __init__(
@@ -1085,20 +1374,16 @@ class GridDeepFeatureExtractor(FeatureExtractor):
         if self.num_workers in [0, 1]:
             torch.set_num_threads(1)
 
-    def _collate_patches(self, batch):
-        """Patch collate function"""
-        indices = [item[0] for item in batch]
-        patches = [item[1] for item in batch]
-        patches = torch.stack(patches)
-        return indices, patches
-
     def _process(  # type: ignore[override]
         self, input_image: np.ndarray
     ) -> torch.Tensor:
         return self._extract_features(input_image)
 
     def _extract_features(  # type: ignore[override]
-        self, input_image: np.ndarray, transform: Optional[Callable] = None
+        self,
+        input_image: np.ndarray,
+        transform: Optional[Callable] = None,
+        augmentations: Optional[List[Callable]] = None,
     ) -> torch.Tensor:
         """
         Extract features for a given RGB image in patches.
@@ -1106,10 +1391,14 @@ class GridDeepFeatureExtractor(FeatureExtractor):
         Args:
             input_image (np.ndarray): RGB input image.
             transform (Callable): Transform to apply. Defaults to None.
+            augmentations (Optional[List[Callable]]): Augmentations applied to the transformed batches
+                of patches, see _build_batch_augmentations. Defaults to None.
 
         Returns:
-            torch.Tensor: Extracted features of shape [image.shape[0] // size * image.shape[1] // size, nr_features].
+            torch.Tensor: Extracted features of shape [image.shape[0] // size * image.shape[1] // size, nr_features],
+                or [nr_rows, nr_cols, nr_augmentations, nr_features] with augmentations.
         """
+        nr_augmentations = 1 if augmentations is None else len(augmentations)
         if self.downsample_factor != 1:
             input_image = self._downsample(input_image, self.downsample_factor)
 
@@ -1121,31 +1410,36 @@ class GridDeepFeatureExtractor(FeatureExtractor):
             mean=self.normalizer_mean,
             std=self.normalizer_std,
             transform=transform,
+            batched=True,
         )
         patch_loader = DataLoader(
             patch_dataset,
             shuffle=False,
             batch_size=self.batch_size,
             num_workers=self.num_workers,
-            collate_fn=self._collate_patches
+            collate_fn=patch_dataset.collate
         )
         features = torch.empty(
             size=(
                 len(patch_dataset),
-                self.patch_feature_extractor.num_features),
+                nr_augmentations * self.patch_feature_extractor.num_features),
             dtype=torch.float32,
             device=self.device,
         )
         for i, patches in tqdm(
             patch_loader, total=len(patch_loader), disable=not self.verbose
         ):
-            embeddings = self.patch_feature_extractor(patches)
+            if augmentations is None:
+                embeddings = self.patch_feature_extractor(patches)
+            else:
+                embeddings = self.patch_feature_extractor.embed_augmentations(
+                    patches, augmentations).reshape(len(patches), -1)
             features[i, :] = embeddings
-        return (
-            features.cpu()
-            .detach()
-            .reshape(patch_dataset.outshape[0], patch_dataset.outshape[1], -1)
-        )
+        features = features.cpu().detach()
+        if augmentations is not None:
+            return features.reshape(
+                patch_dataset.outshape[0], patch_dataset.outshape[1], nr_augmentations, -1)
+        return features.reshape(patch_dataset.outshape[0], patch_dataset.outshape[1], -1)
 
 
 class GridAugmentedDeepFeatureExtractor(GridDeepFeatureExtractor):
@@ -1173,12 +1467,15 @@ class GridAugmentedDeepFeatureExtractor(GridDeepFeatureExtractor):
             fill_value=self.fill_value,
             output_size=(self.patch_size, self.patch_size),
         )
+        self.batch_augmentations = _build_batch_augmentations(rotations=rotations, flips=flips)
 
     def _extract_features(  # type: ignore[override]
         self, input_image: np.ndarray
     ) -> torch.Tensor:
         """
         Extract features for a given RGB image and its extracted instance_map for all augmentations.
+        If the rotations are multiples of 90 degrees, the patches are read once and their augmentations
+        are embedded in stacked batches. Otherwise the patches are read once per augmentation.
 
         Args:
             input_image (np.ndarray): RGB input image.
@@ -1186,6 +1483,9 @@ class GridAugmentedDeepFeatureExtractor(GridDeepFeatureExtractor):
         Returns:
             torch.Tensor: Extracted features of shape [nr_rows, nr_cols, nr_augmentations, nr_features].
         """
+        if self.batch_augmentations is not None:
+            return super()._extract_features(input_image, augmentations=self.batch_augmentations)
+
         all_features = list()
         for transform in self.transforms:
             features = super()._extract_features(input_image, transform=transform)
@@ -1210,15 +1510,6 @@ class MaskedGridDeepFeatureExtractor(GridDeepFeatureExtractor):
         super().__init__(**kwargs)
         self.tissue_thresh = tissue_thresh
 
-    def _collate_patches(self, batch):
-        """Patch collate function"""
-        indices = [item[0] for item in batch]
-        patches = [item[1] for item in batch]
-        mask_patches = [item[2] for item in batch]
-        patches = torch.stack(patches)
-        mask_patches = torch.stack(mask_patches)
-        return indices, patches, mask_patches
-
     def _process(  # type: ignore[override]
         self, input_image: np.ndarray, mask: np.ndarray
     ) -> Tuple[pd.DataFrame, pd.DataFrame]:
@@ -1242,77 +1533,42 @@ class MaskedGridDeepFeatureExtractor(GridDeepFeatureExtractor):
             mask = self._downsample(mask, self.downsample_factor)
         mask = np.expand_dims(mask, axis=2)
 
-        # create dataloader for image and corresponding mask patches
+        # create dataset for image and corresponding mask patches
         masked_patch_dataset = MaskedGridPatchDataset(image=input_image,
                                                       mask=mask,
                                                       resize_size=self.resize_size,
                                                       patch_size=self.patch_size,
                                                       stride=self.stride,
                                                       mean=self.normalizer_mean,
-                                                      std=self.normalizer_std)
+                                                      std=self.normalizer_std,
+                                                      batched=True)
+
+        # record valid and invalid patches (sufficient area of tissue compared to background)
+        index_filter = masked_patch_dataset.tissue_fractions() >= self.tissue_thresh
+
+        # extract features of the valid patches only, invalid patches keep zero features
         patch_loader = DataLoader(masked_patch_dataset,
-                                  shuffle=False,
+                                  sampler=np.flatnonzero(index_filter).tolist(),
                                   batch_size=self.batch_size,
                                   num_workers=self.num_workers,
-                                  collate_fn=self._collate_patches)
-
-        # create dictionaries where the keys are the patch indices
-        all_index_filter = OrderedDict(
-            {(h, w): None for h in range(masked_patch_dataset.outshape[0])
-                for w in range(masked_patch_dataset.outshape[1])}
-        )
-        all_features = deepcopy(all_index_filter)
-
-        # extract features of all patches and record which patches are (in)valid
-        indices = list(all_features.keys())
-        offset = 0
-        for _, img_patches, mask_patches in tqdm(patch_loader,
-                                                 total=len(patch_loader),
-                                                 disable=not self.verbose):
-            index_filter, features = self._validate_and_extract_features(img_patches, mask_patches)
-            if len(img_patches) == 1:
-                features = features.unsqueeze(dim=0)
-            for i in range(len(index_filter)):
-                all_index_filter[indices[offset+i]] = index_filter[i]
-                all_features[indices[offset+i]] = features[i].cpu().detach().numpy()
-            offset += len(index_filter)
+                                  collate_fn=partial(GridPatchDataset.collate, masked_patch_dataset))
+        features = np.zeros(
+            (len(masked_patch_dataset), self.patch_feature_extractor.num_features), dtype=np.float32)
+        for indices, img_patches in tqdm(patch_loader,
+                                         total=len(patch_loader),
+                                         disable=not self.verbose):
+            embeddings = self.patch_feature_extractor(img_patches)
+            features[indices] = embeddings.reshape(len(indices), -1).cpu().detach().numpy()
 
         # convert to pandas dataframes to allow storing as .h5 files
-        all_index_filter = pd.DataFrame(all_index_filter, index=['is_valid'])
-        all_features = pd.DataFrame(np.transpose(np.stack(list(all_features.values()))),
-                                    columns=list(all_features.keys()))
+        patch_indices = [(h, w) for h in range(masked_patch_dataset.outshape[0])
+                         for w in range(masked_patch_dataset.outshape[1])]
+        all_index_filter = pd.DataFrame(OrderedDict(zip(patch_indices, index_filter.tolist())),
+                                        index=['is_valid'])
+        all_features = pd.DataFrame(np.transpose(features), columns=patch_indices)
 
         return all_index_filter, all_features
 
-    def _validate_and_extract_features(
-        self,
-        img_patches: torch.Tensor,
-        mask_patches: torch.Tensor,
-    ) -> Tuple[List[bool], torch.Tensor]:
-        """
-        Record which image patches are valid and which ones are not.
-        Extract features from the given image patches.
-
-        Args:
-            img_patches (torch.Tensor): Batch of image patches.
-            mask_patches (torch.Tensor): Batch of mask patches.
-
-        Returns:
-            Tuple[List[bool], torch.Tensor]: Boolean filter for (in)valid patches, extracted patch features.
-        """
-        # record valid and invalid patches (sufficient area of tissue compared to background)
-        index_filter = []
-        for mask_p in mask_patches:
-            tissue_fraction = (mask_p == 1).sum() / torch.numel(mask_p)
-            if tissue_fraction >= self.tissue_thresh:
-                index_filter.append(True)
-            else:
-                index_filter.append(False)
-
-        # extract features of all patches
-        features = self.patch_feature_extractor(img_patches)
-        return index_filter, features
-
 def _build_augmentations(
     rotations: Optional[List[int]] = None,
     flips: Optional[List[Any]] = None,
@@ -1366,6 +1622,39 @@ def _build_augmentations(
             augmentaions.append(transforms.Compose(t))
     return augmentaions
 
+
+def _build_batch_augmentations(
+    rotations: Optional[List[int]] = None,
+    flips: Optional[List[Any]] = None,
+) -> Optional[List[Callable]]:
+    """Returns the augmentations of _build_augmentations as tensor ops on batches of shape (B, C, H, W),
+       in the same order, if they are all lossless, ie. the rotations are multiples of 90 degrees.
+       They then commute with resizing and normalization, and can be applied to transformed patches.
+
+    Args:
+        rotations (Optional[List[int]], optional): List of rotation angles. Defaults to None.
+        flips (Optional[List[Any]], optional): List of flips. Options are no rotation "n",
+            horizontal flip "h" and vertical flip "v". Defaults to None.
+
+    Returns:
+        Optional[List[Callable]]: List of callable augmentation functions, None if a rotation is
+            not a multiple of 90 degrees
+    """
+    if rotations is None:
+        rotations = [0]
+    if flips is None:
+        flips = ["n"]
+    if any(angle % 90 != 0 for angle in rotations):
+        return None
+    flip_dims = {"n": [], "h": [-1], "v": [-2]}
+    augmentations = list()
+    for angle in rotations:
+        for flip in flips:
+            augmentations.append(
+                lambda x, k=(angle // 90) % 4, dims=flip_dims[flip]: torch.rot90(x, k=k, dims=(-2, -1)).flip(dims)
+            )
+    return augmentations
+
 def _remove_modules(model: nn.Module, last_layer: str) -> nn.Module:
     """
     Remove all modules in the model that come after a given layer.
@@ -1383,6 +1672,42 @@ def _remove_modules(model: nn.Module, last_layer: str) -> nn.Module:
         setattr(model, mod, nn.Sequential())
     return model
 
+def _transform_patch_batch(
+    patches: torch.Tensor,
+    resize_size: Optional[int] = None,
+    transform: Optional[Callable] = None,
+    mean: Optional[List[float]] = None,
+    std: Optional[List[float]] = None,
+) -> torch.Tensor:
+    """Batched counterpart of ToPILImage, Resize, transform, ToTensor and Normalize
+
+    Args:
+        patches (torch.Tensor): Patches of shape (B, C, H, W) in uint8
+        resize_size (Optional[int], optional): Resized size of the patches. Defaults to None.
+        transform (Optional[Callable], optional): Transform applied to the batch, of values in [0, 255].
+                                                  Defaults to None.
+        mean (Optional[List[float]], optional): Channel-wise mean for normalization. Defaults to None.
+        std (Optional[List[float]], optional): Channel-wise std for normalization. Defaults to None.
+
+    Returns:
+        torch.Tensor: Patches of shape (B, C, resize_size, resize_size) in float32
+    """
+    patches = patches.contiguous().float()
+    if resize_size is not None:
+        # bilinear with antialiasing as PIL, rounded as the uint8 output of PIL
+        patches = transforms.functional.resize(patches, [resize_size, resize_size], antialias=True)
+        patches = patches.round_()
+    if transform is not None:
+        patches = transform(patches)
+    if mean is None or std is None:
+        return patches.div_(255)
+    # scaling to [0, 1] and normalization in a single pass
+    scale = 1 / (255 * torch.as_tensor(std, dtype=torch.float32)).view(-1, 1, 1)
+    shift = -torch.as_tensor(mean, dtype=torch.float32).view(-1, 1, 1) / torch.as_tensor(
+        std, dtype=torch.float32).view(-1, 1, 1)
+    return torch.addcmul(shift, patches, scale)
+
+
 def _get_pad_size(size: int, patch_size: int, stride: int) -> Tuple[int, int]:
     """Computes the necessary top and bottom padding size to evenly devide an input size into patches with a given stride
 
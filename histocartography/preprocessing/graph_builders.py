@@ -5,18 +5,15 @@ from abc import abstractmethod
 from pathlib import Path
 from typing import Any, Optional, Tuple, Union
 
-import cv2
 import dgl
+import h5py
 import networkx as nx
 import numpy as np
-import pandas as pd
 import torch
 from dgl.data.utils import load_graphs, save_graphs
-from skimage.measure import regionprops
-from sklearn.neighbors import kneighbors_graph
 
-from pipeline import PipelineStep
-from preprocessing.utils import fast_histogram
+from pipeline import PipelineStep, get_dataset_options
+from preprocessing.utils import NeighborIndex, RegionIndex, boundary_label_pairs
 
 
 LABEL = "label"
@@ -50,6 +47,8 @@ class BaseGraphBuilder(PipelineStep):
     Base interface class for graph building.
     """
 
+    cache_file_ending = ".bin"
+
     def __init__(
             self,
             nr_annotation_classes: int = 5,
@@ -144,6 +143,65 @@ class BaseGraphBuilder(PipelineStep):
             save_graphs(str(output_path), [graph])
         return graph
 
+    def _set_outputs(self, output_file: h5py.Group, outputs: dgl.DGLGraph) -> None:
+        """Save the graph as edge list, node data and edge data to a given h5 group
+        Args:
+            output_file (h5py.Group): Group to write to
+            outputs (dgl.DGLGraph): Constructed graph
+        """
+        src, dst = outputs.edges()
+        edges = np.stack([src.numpy(), dst.numpy()])
+        output_file.attrs["num_nodes"] = outputs.number_of_nodes()
+        output_file.create_dataset(
+            "edges",
+            data=edges,
+            **get_dataset_options(edges, **self.dataset_options),
+        )
+        for prefix, data in [("ndata", outputs.ndata), ("edata", outputs.edata)]:
+            for k, v in data.items():
+                v = v.cpu().numpy()
+                output_file.create_dataset(
+                    f"{prefix}/{k}",
+                    data=v,
+                    **get_dataset_options(v, **self.dataset_options),
+                )
+
+    def _get_outputs(self, input_file: h5py.Group) -> dgl.DGLGraph:
+        """Rebuild the graph from a given h5 group
+        Args:
+            input_file (h5py.Group): Group to load from
+        Returns:
+            dgl.DGLGraph: Previously constructed graph
+        """
+        edges = input_file["edges"][()]
+        graph = dgl.DGLGraph()
+        graph.add_nodes(int(input_file.attrs["num_nodes"]))
+        graph.add_edges(edges[0], edges[1])
+        for prefix, data in [("ndata", graph.ndata), ("edata", graph.edata)]:
+            if prefix in input_file:
+                for k, v in input_file[prefix].items():
+                    data[k] = torch.from_numpy(v[()])
+        return graph
+
+    def _save_to_cache(self, path: Path, outputs: dgl.DGLGraph) -> None:
+        """Save the graph to a given cache file
+        Args:
+            path (Path): Path of the cache file
+            outputs (dgl.DGLGraph): Constructed graph
+        """
+        save_graphs(str(path), [outputs])
+
+    def _load_from_cache(self, path: Path) -> dgl.DGLGraph:
+        """Load the graph from a given cache file
+        Args:
+            path (Path): Path of the cache file
+        Returns:
+            dgl.DGLGraph: Previously constructed graph
+        """
+        graphs, _ = load_graphs(str(path))
+        assert len(graphs) == 1
+        return graphs[0]
+
     def _get_node_centroids(
             self, instance_map: np.ndarray
     ) -> np.ndarray:
@@ -153,15 +211,8 @@ class BaseGraphBuilder(PipelineStep):
         Returns:
             centroids (np.ndarray): Node centroids
         """
-        regions = regionprops(instance_map)
-        centroids = np.empty((len(regions), 2))
-        for i, region in enumerate(regions):
-            center_y, center_x = region.centroid  # (y, x)
-            center_x = int(round(center_x))
-            center_y = int(round(center_y))
-            centroids[i, 0] = center_x
-            centroids[i, 1] = center_y
-        return centroids
+        centroids = RegionIndex.of(instance_map).centroids  # (y, x)
+        return np.round(centroids[:, ::-1])
 
     def _set_node_centroids(
             self,
@@ -294,22 +345,29 @@ class RAGGraphBuilder(BaseGraphBuilder):
         assert (
             self.nr_annotation_classes < 256
         ), "Cannot handle that many classes with 8-bits"
-        regions = regionprops(instance_map)
-        labels = torch.empty(len(regions), dtype=torch.uint8)
-
-        for region_label in np.arange(1, len(regions) + 1):
-            histogram = fast_histogram(
-                annotation[instance_map == region_label],
-                nr_values=self.nr_annotation_classes
-            )
-            mask = np.ones(len(histogram), np.bool)
-            mask[self.annotation_background_class] = 0
-            if histogram[mask].sum() == 0:
-                assignment = self.annotation_background_class
-            else:
-                histogram[self.annotation_background_class] = 0
-                assignment = np.argmax(histogram)
-            labels[region_label - 1] = int(assignment)
+        nr_instances = RegionIndex.of(instance_map).nr_instances
+        nr_classes = self.nr_annotation_classes
+
+        # joint (instance, class) histogram in one pass over the pixels
+        instance_map = instance_map.astype(np.int64).ravel()
+        annotation = annotation.astype(np.int64).ravel()
+        valid = (instance_map >= 1) & (instance_map <= nr_instances) & \
+            (annotation >= 0) & (annotation < nr_classes)
+        histograms = np.bincount(
+            (instance_map[valid] - 1) * nr_classes + annotation[valid],
+            minlength=nr_instances * nr_classes
+        ).reshape(nr_instances, nr_classes)
+
+        mask = np.ones(nr_classes, bool)
+        mask[self.annotation_background_class] = 0
+        is_background = histograms[:, mask].sum(axis=1) == 0
+        histograms[:, self.annotation_background_class] = 0
+        assignments = np.where(
+            is_background,
+            self.annotation_background_class,
+            np.argmax(histograms, axis=1)
+        )
+        labels = torch.from_numpy(assignments.astype(np.uint8))
         graph.ndata[LABEL] = labels
 
     def _build_topology(
@@ -319,23 +377,19 @@ class RAGGraphBuilder(BaseGraphBuilder):
             graph: dgl.DGLGraph
     ) -> None:
         """Create the graph topology from the instance connectivty in the instance_map"""
-        regions = regionprops(instance_map)
-        instance_ids = torch.empty(len(regions), dtype=torch.uint8)
-
-        kernel = np.ones((self.kernel_size, self.kernel_size), np.uint8)
-        adjacency = np.zeros(shape=(len(instance_ids), len(instance_ids)))
-
-        for instance_id in np.arange(1, len(instance_ids) + 1):
-            mask = (instance_map == instance_id).astype(np.uint8)
-            dilation = cv2.dilate(mask, kernel, iterations=1)
-            boundary = dilation - mask
-            idx = pd.unique(instance_map[boundary.astype(bool)])
-            instance_id -= 1  # because instance_map id starts from 1
-            idx -= 1  # because instance_map id starts from 1
-            adjacency[instance_id, idx] = 1
-
-        edge_list = np.nonzero(adjacency)
-        graph.add_edges(list(edge_list[0]), list(edge_list[1]))
+        nr_instances = RegionIndex.of(instance_map).nr_instances
+
+        # instances are connected to the instances reached by dilating them with the kernel
+        src, dst = boundary_label_pairs(instance_map, self.kernel_size)
+        keep = (src >= 1) & (src <= nr_instances)
+        src, dst = src[keep] - 1, dst[keep] - 1  # because instance_map id starts from 1
+        # background (-1) wraps around to the last instance, as in the dense adjacency
+        dst[dst < 0] += nr_instances
+        edges = np.unique(src * nr_instances + dst)
+        graph.add_edges(
+            torch.from_numpy(edges // nr_instances),
+            torch.from_numpy(edges % nr_instances)
+        )
 
         for _ in range(self.hops - 1):
             graph = two_hop_neighborhood(graph)
@@ -364,8 +418,8 @@ class KNNGraphBuilder(BaseGraphBuilder):
             annotation: np.ndarray,
             graph: dgl.DGLGraph) -> None:
         """Set the node labels of the graphs using annotation"""
-        regions = regionprops(instance_map)
-        assert annotation.shape[0] == len(regions), \
+        nr_instances = RegionIndex.of(instance_map).nr_instances
+        assert annotation.shape[0] == nr_instances, \
             "Number of annotations do not match number of nodes"
         graph.ndata[LABEL] = torch.FloatTensor(annotation.astype(float))
 
@@ -378,50 +432,47 @@ class KNNGraphBuilder(BaseGraphBuilder):
         """Build topology using (thresholded) kNN"""
 
         # build kNN adjacency
-        adj = kneighbors_graph(
-            centroids,
-            self.k,
-            mode="distance",
-            include_self=False,
-            metric="euclidean").toarray()
-
-        # filter edges that are too far (ie larger than thresh)
+        distances, neighbors = NeighborIndex(centroids).query(
+            self.k, include_self=False)
+        src = np.repeat(np.arange(len(centroids)), neighbors.shape[1])
+        dst = neighbors.ravel()
+        distances = distances.ravel()
+
+        # filter edges that are too far (ie larger than thresh) and between duplicate centroids
+        keep = distances > 0
         if self.thresh is not None:
-            adj[adj > self.thresh] = 0
-
-        edge_list = np.nonzero(adj)
-        graph.add_edges(list(edge_list[0]), list(edge_list[1]))
+            keep &= distances <= self.thresh
+        order = np.lexsort((dst[keep], src[keep]))
+        graph.add_edges(
+            torch.from_numpy(src[keep][order]),
+            torch.from_numpy(dst[keep][order]))
         distaince_info = self.build_position(instance_map,graph)
         graph.ndata[POSITION] = distaince_info
 
     def build_position(self,
                         instance_map: np.ndarray,
                         graph: dgl.DGLGraph):
-        image_size = (instance_map.shape[1], instance_map.shape[0])  # (x, y)
-        centroids = graph.ndata[CENTROID]
         """
         create a distance_info: [norm_x_cent,norm_y_cent,norm_x_mean_dist,norm_y_mean_dist]
         dist is the distance to other nodes it has connection to 
         """
+        image_size = (instance_map.shape[1], instance_map.shape[0])  # (x, y)
+        centroids = graph.ndata[CENTROID]
         normalized_centroids = torch.empty_like(centroids)  # (x, y)
         normalized_centroids[:, 0] = centroids[:, 0] / image_size[0]
         normalized_centroids[:, 1] = centroids[:, 1] / image_size[1]
-        list_node = graph.nodes()
         distance_info = torch.zeros((graph.num_nodes(), 4))
         distance_info[:,0] = normalized_centroids[:, 0]
         distance_info[:,1] = normalized_centroids[:, 1]
-        average_distances = torch.zeros((graph.num_nodes(), 2))
-        for node in list_node:
-
-            neighbors = graph.successors(node)
 
-            node_centroid = graph.ndata[CENTROID][node]
-            neighbor_centroids = graph.ndata[CENTROID][neighbors]
-            distances = neighbor_centroids - node_centroid
+        # average x and y distances to the successors of every node, reduced over the edges
+        src, dst = graph.edges()
+        distances = (centroids[dst] - centroids[src]).abs()
+        nr_successors = torch.bincount(src, minlength=graph.num_nodes())
+        average_distances = torch.zeros((graph.num_nodes(), 2)).index_add_(
+            0, src, distances) / nr_successors.unsqueeze(1)
 
-            #Calculate the average distances with Min Max Normalisation
-            average_distances[node, 0] = distances[:, 0].abs().mean()  # Average x distance
-            average_distances[node, 1] = distances[:, 1].abs().mean()  # Average y distance
+        #Calculate the average distances with Min Max Normalisation
         min_distance = average_distances.min(dim=0)[0]  # Minimum distance for x and y
         max_distance = average_distances.max(dim=0)[0]  # Maximum distance for x and y
         normalized_distances = (average_distances - min_distance) / (max_distance - min_distance)   
@@ -12,6 +12,8 @@ from utils.io import h5_to_numpy
 
 
 class FileLoader(PipelineStep):
+    cacheable = False
+
     def mkdir(self) -> Path:
         """Create path to output files"""
         assert (
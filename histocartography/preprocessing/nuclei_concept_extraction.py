@@ -12,7 +12,13 @@ class NucleiConceptExtractor(PipelineStep):
     Extract nuclei-level measurable concepts.
     """
 
-    def __init__(self, concept_names=None, **kwargs) -> None:
+    def __init__(
+        self,
+        concept_names=None,
+        n_jobs: int = 1,
+        parallel_backend: str = "processes",
+        **kwargs
+    ) -> None:
         """Nuclei Concept Extractor constructor.
 
         Args:
@@ -20,6 +26,10 @@ class NucleiConceptExtractor(PipelineStep):
                                  If set to None, extract all the concepts.
                                  Otherwise, extract all the listed concepts
                                 separated with commas, eg. 'area,perimeter,eccentricity'.
+            n_jobs (int): Number of workers of the handcrafted feature extraction.
+                          -1 uses all cores. Defaults to 1.
+            parallel_backend (str): Worker pool used if n_jobs > 1, either "processes" or "threads".
+                                    Defaults to "processes".
         """
         super().__init__(**kwargs)
 
@@ -27,7 +37,9 @@ class NucleiConceptExtractor(PipelineStep):
             self.concept_names = concept_names.split(",")
         else:
             self.concept_names = concept_names
-        self.hc_feature_extractor = HandcraftedFeatureExtractor()
+        self.hc_feature_extractor = HandcraftedFeatureExtractor(
+            n_jobs=n_jobs, parallel_backend=parallel_backend
+        )
 
     def _process(  # type: ignore[override]
         self, input_image: np.ndarray, instance_map: np.ndarray
@@ -43,15 +55,15 @@ class NucleiConceptExtractor(PipelineStep):
             np.ndarray: nuclei concept
         """
 
-        nuclei_concepts = self.hc_feature_extractor.process(input_image, instance_map)
-
+        # only the requested concepts and the features they depend on are computed
         if self.concept_names is not None:
-            indices_to_keep = [
-                HANDCRAFTED_FEATURES_NAMES[c] for c in self.concept_names
-            ]
-            nuclei_concepts = nuclei_concepts.index_select(
-                1, torch.LongTensor(indices_to_keep)
-            )
+            for c in self.concept_names:
+                assert c in HANDCRAFTED_FEATURES_NAMES, (
+                    f"Unknown concept {c}. Options are {list(HANDCRAFTED_FEATURES_NAMES.keys())}"
+                )
+        nuclei_concepts = self.hc_feature_extractor._extract_features(
+            input_image, instance_map, feature_names=self.concept_names
+        )
 
         # convert to numpy array
         nuclei_concepts = nuclei_concepts.cpu().detach().numpy()
@@ -1,8 +1,10 @@
 """Detect and Classify nuclei from an image with the HoverNet model."""
 
+import logging
+import math
 import os
 from pathlib import Path
-from typing import Tuple, Union
+from typing import List, Tuple, Union
 
 import cv2
 import numpy as np
@@ -11,9 +13,6 @@ from PIL import Image
 import os
 from typing import Optional
 
-from skimage.measure import regionprops
-from skimage.morphology import remove_small_objects
-from skimage.measure import regionprops
 from skimage.morphology import remove_small_objects
 from skimage.segmentation import watershed
 
@@ -24,8 +23,17 @@ from torch.utils.data import DataLoader, Dataset
 from torchvision import transforms
 from tqdm import tqdm
 
+from ml.models.hovernet import convert_quantization, prepare_quantization
 from pipeline import PipelineStep
-from utils.image import extract_patches_from_image
+from preprocessing.utils import (
+    PARALLEL_BACKENDS,
+    RegionIndex,
+    export_model,
+    get_cached_model,
+    get_worker_pool,
+    load_model,
+)
+from utils.image import WIN_SIZE, get_patch_coords, get_tissue_fractions, pad_image
 from utils import download_box_link
 
 DATASET_TO_BOX_URL = {
@@ -37,16 +45,33 @@ CHECKPOINT_PATH = "../../checkpoints"
 
 GPU_DEFAULT_BATCH_SIZE = 16
 CPU_DEFAULT_BATCH_SIZE = 2
+TILE_OVERLAP = 128
+POSTPROCESSING_TILE_SIZE = 1024
+POSTPROCESSING_HALO = 64
+HALO_MARGIN = 16
+SOBEL_KSIZE = 21
+INSTANCE_MAP_DTYPE = "uint16"
+PRECISIONS = ["fp32", "bf16", "int8"]
+INT8_CALIBRATION_WINDOWS = 8
 
 
 class NucleiExtractor(PipelineStep):
     """Nuclei extraction"""
 
+    cache_parameters = ("tile_size", "tile_overlap", "min_tissue_fraction", "precision")
+
     def __init__(
         self,
         pretrained_data: str = "pannuke",
         model_path: str = None,
         batch_size: int = None,
+        tile_size: Optional[int] = None,
+        tile_overlap: int = TILE_OVERLAP,
+        min_tissue_fraction: float = 0.0,
+        precision: str = "fp32",
+        calibration_images: Optional[List[np.ndarray]] = None,
+        n_jobs: int = 1,
+        parallel_backend: str = "processes",
         **kwargs,
     ) -> None:
         """Create a nuclei extractor
@@ -54,13 +79,49 @@ class NucleiExtractor(PipelineStep):
         Args:
             pretrained_data (str): Load checkpoint pretrained on some data. Options are 'pannuke' or 'monusac'. Default to 'pannuke'.
             model_path (str): Path to a pre-trained model. If none, the checkpoint specified in pretrained_data will be used. Default to None.
+                              Models are loaded once per process and shared by the extractors, and can be
+                              pickled modules or TorchScript artifacts saved by export.
             batch_size (int, optional): Batch size. Defaults to None.
+            tile_size (int, optional): Process the image in tiles of tile_size x tile_size pixels, which bounds
+                                       the memory used for prediction and post-processing regardless of the
+                                       image size. If None, the whole image is processed at once. Defaults to None.
+            tile_overlap (int, optional): Context added on each side of a tile, in pixels. It should be larger
+                                          than the diameter of a nucleus. Defaults to 128.
+            min_tissue_fraction (float, optional): If a tissue mask is given, windows whose output holds a smaller
+                                                   fraction of tissue are not run through the model and are
+                                                   predicted as background. Defaults to 0, no window is skipped.
+            precision (str, optional): Inference precision. Options are "fp32", "bf16" for bfloat16 autocast,
+                                       and "int8" for static int8 quantization of the encoder and decoders on
+                                       CPU. Reduced precisions use a channels-last layout. Defaults to "fp32".
+            calibration_images (Optional[List[np.ndarray]], optional): RGB images whose windows calibrate the
+                                       int8 quantization. The model is quantized once and reused for every
+                                       image. If None, it is calibrated on the first processed image.
+                                       Defaults to None.
+            n_jobs (int, optional): Number of workers that post-process tiles of the predictions in parallel,
+                                    with the same output as a single worker. -1 uses all cores. Defaults to 1.
+            parallel_backend (str, optional): Worker pool used if n_jobs > 1, either "processes" or "threads".
+                                              Defaults to "processes".
         """
+        assert precision in PRECISIONS, (
+            f"Unsupported precision {precision}. Options are {PRECISIONS}"
+        )
+        assert parallel_backend in PARALLEL_BACKENDS, (
+            f"Unsupported parallel backend {parallel_backend}. "
+            f"Options are {PARALLEL_BACKENDS}"
+        )
         self.pretrained_data = pretrained_data
         super().__init__(**kwargs)
 
         # set class attributes
-        cuda = torch.cuda.is_available()
+        self.precision = precision
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.min_tissue_fraction = min_tissue_fraction
+        self.n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        self.parallel_backend = parallel_backend
+        self.calibration_images = calibration_images
+        # quantized operators run on CPU
+        cuda = torch.cuda.is_available() and precision != "int8"
         self.device = torch.device("cuda:0" if cuda else "cpu")
         if batch_size is None:
             # bs set to 16 if GPU, otherwise 2.
@@ -80,13 +141,33 @@ class NucleiExtractor(PipelineStep):
             # download_box_link(DATASET_TO_BOX_URL[pretrained_data], model_path)
 
         self._load_model_from_path(model_path)
-        self.model = self.model.to(self.device)
-        self.model.eval()
+        assert self.precision != "int8" or not isinstance(self.model, torch.jit.ScriptModule), (
+            "int8 quantization needs the model definition, load a pickled model instead of a traced one"
+        )
+        self._quantized_model = None
 
     def _load_model_from_path(self, model_path):
-        """Load nuclei extraction model from provided model path."""
-        print(f"model_path is {model_path}")
-        self.model = torch.load(model_path)
+        """Load nuclei extraction model from provided model path, once per process and device."""
+        memory_format = torch.contiguous_format if self.precision == "fp32" else torch.channels_last
+
+        def load():
+            print(f"model_path is {model_path}")
+            model = load_model(model_path, map_location=self.device)
+            model = model.to(self.device, memory_format=memory_format)
+            model.eval()
+            return model
+
+        self.model = get_cached_model(
+            (os.path.abspath(model_path), str(self.device), str(memory_format)), load)
+
+    def export(self, path: Union[str, Path]) -> None:
+        """Save the model as a traced TorchScript artifact, to be loaded through model_path
+
+        Args:
+            path (Union[str, Path]): Path of the artifact
+        """
+        export_model(
+            self.model, torch.zeros(1, 3, *WIN_SIZE, device=self.device), path)
 
     def _process(  # type: ignore[override]
         self,
@@ -119,7 +200,84 @@ class NucleiExtractor(PipelineStep):
         if tissue_mask is not None:
             input_image[tissue_mask == 0] = (255, 255, 255)
 
-        image_dataset = ImageToPatchDataset(input_image)
+        if self.precision == "int8":
+            model = self._quantize(input_image, tissue_mask)
+        else:
+            model = self.model
+
+        if self.tile_size is None:
+            pred_map, nr_skipped = self._predict(model, input_image, tissue_mask)
+            # post process instance map
+            instance_map = process_instance(
+                pred_map, n_jobs=self.n_jobs, parallel_backend=self.parallel_backend)
+            # extract the centroid location in the instance map
+            centroids = RegionIndex.of(instance_map).centroids  # row, col
+        else:
+            instance_map, centroids, nr_skipped = self._extract_nuclei_tiled(
+                model, input_image, tissue_mask)
+        if tissue_mask is not None and self.min_tissue_fraction > 0:
+            logging.info(
+                "Skipped %s windows with a tissue fraction below %s",
+                nr_skipped,
+                self.min_tissue_fraction)
+        instance_centroids = np.round(centroids[:, ::-1])
+        return instance_map, instance_centroids
+
+    def _quantize(
+        self,
+        input_image: np.ndarray,
+        tissue_mask: Optional[np.ndarray] = None,
+    ) -> torch.nn.Module:
+        """Model quantized to int8, calibrated once on windows sampled evenly over the calibration_images,
+           or else over the first input_image, and reused for the next images
+
+        Args:
+            input_image (np.array): Original RGB image
+            tissue_mask (Optional[np.ndarray]): Tissue mask used to skip windows with little tissue. Defaults to None.
+
+        Returns:
+            torch.nn.Module: Quantized model
+        """
+        if self._quantized_model is not None:
+            return self._quantized_model
+        if self.calibration_images is not None:
+            image_datasets = [ImageToPatchDataset(image) for image in self.calibration_images]
+        else:
+            image_datasets = [ImageToPatchDataset(input_image, tissue_mask, self.min_tissue_fraction)]
+        image_datasets = [image_dataset for image_dataset in image_datasets if len(image_dataset) > 0]
+        if len(image_datasets) == 0:
+            # nothing to calibrate on yet
+            return self.model
+
+        model = prepare_quantization(self.model)
+        with torch.no_grad():
+            for image_dataset in image_datasets:
+                indices = np.unique(np.linspace(
+                    0, len(image_dataset) - 1, INT8_CALIBRATION_WINDOWS).round().astype(int))
+                for batch in np.array_split(indices, math.ceil(len(indices) / self.batch_size)):
+                    image_batch = torch.stack([image_dataset[i][1] for i in batch])
+                    model(image_batch.contiguous(memory_format=torch.channels_last))
+        self._quantized_model = convert_quantization(model)
+        return self._quantized_model
+
+    def _predict(
+        self,
+        model: torch.nn.Module,
+        input_image: np.ndarray,
+        tissue_mask: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, int]:
+        """Run the model over sliding windows of the input_image
+
+        Args:
+            model (torch.nn.Module): Model to run, self.model or its quantized copy
+            input_image (np.array): Original RGB image
+            tissue_mask (Optional[np.ndarray]): Tissue mask used to skip windows with little tissue. Defaults to None.
+
+        Returns:
+            Tuple[np.ndarray, int]: Prediction map of shape (H, W, 3), number of skipped windows
+        """
+        image_dataset = ImageToPatchDataset(
+            input_image, tissue_mask, self.min_tissue_fraction)
 
         def collate(batch):
             coords = [x[0] for x in batch]
@@ -136,13 +294,24 @@ class NucleiExtractor(PipelineStep):
             dtype=torch.float32,
             device=self.device,
         )
+        # skipped windows are predicted as background
+        for left, bottom, right, top in image_dataset.skipped_coords:
+            pred_map[bottom:top, left:right, :] = 0
 
         for coords, image_batch in tqdm(
-            image_loader, desc="Patch-level nuclei detection"
+            image_loader,
+            desc="Patch-level nuclei detection",
+            disable=self.tile_size is not None,
         ):
             image_batch = image_batch.to(self.device)
-            with torch.no_grad():
-                out = self.model(image_batch).cpu()
+            if self.precision != "fp32":
+                image_batch = image_batch.contiguous(memory_format=torch.channels_last)
+            with torch.no_grad(), torch.autocast(
+                device_type=self.device.type,
+                dtype=torch.bfloat16,
+                enabled=self.precision == "bf16",
+            ):
+                out = model(image_batch).float().cpu()
                 for i in range(out.shape[0]):
                     left = coords[i][0]  # left, bottom, right, top
                     bottom = coords[i][1]
@@ -153,27 +322,84 @@ class NucleiExtractor(PipelineStep):
         # crop to original image size
         pred_map = pred_map.cpu().detach().numpy()
         pred_map = pred_map[: image_dataset.im_h, : image_dataset.im_w, :]
+        return pred_map, len(image_dataset.skipped_coords)
 
-        # post process instance map
-        instance_map = process_instance(pred_map)
-        #print(f"---------------Nuclei Extraction---------------")
-        #print(f"Instance map {instance_map.shape}")
-        # extract the centroid location in the instance map
-        regions = regionprops(instance_map)
-       # print(f"and length region {len(regions)}")
-        instance_centroids = np.empty((len(regions), 2))
-
-        #print(f"Instance centroids have shape {instance_centroids.shape}  shape instance: {instance_map.shape}")
-
-        for i, region in enumerate(regions):
-            center_y, center_x = region.centroid  # row, col
-            #print(f"     centroid r,c {(center_y,center_x)}")
-            center_x = int(round(center_x))
-            center_y = int(round(center_y))
-            instance_centroids[i, 0] = center_x
-            instance_centroids[i, 1] = center_y
-        #print(f"---------------Nuclei Extraction---------------")
-        return instance_map, instance_centroids
+    def _extract_nuclei_tiled(
+        self,
+        model: torch.nn.Module,
+        input_image: np.ndarray,
+        tissue_mask: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray, int]:
+        """Extract nuclei tile by tile and stitch them across tile borders. Every tile is predicted and
+           post-processed with tile_overlap pixels of context on each side. A tile keeps the nuclei whose
+           centroid lies inside it, and writes them on the pixels not claimed by a previous tile. Nuclei
+           crossing a border are thus taken whole from a single tile, and duplicates of a nucleus already
+           taken by a neighbouring tile are dropped.
+
+        Args:
+            model (torch.nn.Module): Model to run, self.model or its quantized copy
+            input_image (np.array): Original RGB image
+            tissue_mask (Optional[np.ndarray]): Tissue mask used to skip windows with little tissue. Defaults to None.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, int]: instance_map, instance centroids (row, col), number of skipped windows.
+                                              The instance map is uint16 like the untiled output, or int32
+                                              if there are more nuclei than uint16 labels.
+        """
+        im_h, im_w = input_image.shape[:2]
+        instance_map = np.zeros((im_h, im_w), dtype=np.int32)
+        centroids = [np.empty((0, 2))]
+        nr_instances = 0
+        nr_skipped = 0
+
+        tiles = [(row, col) for row in range(0, im_h, self.tile_size)
+                 for col in range(0, im_w, self.tile_size)]
+        for row, col in tqdm(tiles, desc="Tile-level nuclei detection"):
+            top = max(row - self.tile_overlap, 0)
+            left = max(col - self.tile_overlap, 0)
+            bottom = min(row + self.tile_size + self.tile_overlap, im_h)
+            right = min(col + self.tile_size + self.tile_overlap, im_w)
+            pred_map, nr_tile_skipped = self._predict(
+                model,
+                input_image[top:bottom, left:right],
+                None if tissue_mask is None else tissue_mask[top:bottom, left:right])
+            nr_skipped += nr_tile_skipped
+            regions = RegionIndex(process_instance(
+                pred_map,
+                output_dtype="int32",
+                n_jobs=self.n_jobs,
+                parallel_backend=self.parallel_backend))
+            if regions.nr_instances == 0:
+                continue
+
+            # keep the nuclei centered in the tile that are mostly unclaimed
+            tile_centroids = regions.centroids + (top, left)
+            keep = np.all(
+                (tile_centroids >= (row, col))
+                & (tile_centroids < (row + self.tile_size, col + self.tile_size)),
+                axis=1,
+            )
+            tile_map = instance_map[top:bottom, left:right]
+            free = tile_map[regions.rows, regions.cols] == 0
+            keep &= 2 * regions.sum(free) > regions.areas
+
+            # write them with new labels on the free pixels
+            new_labels = np.zeros(regions.nr_instances, dtype=np.int32)
+            new_labels[keep] = np.arange(nr_instances + 1, nr_instances + keep.sum() + 1)
+            write = free & keep[regions.ids]
+            rows, cols, ids = regions.rows[write], regions.cols[write], regions.ids[write]
+            tile_map[rows, cols] = new_labels[ids]
+            areas = np.bincount(ids, minlength=regions.nr_instances)[keep]
+            centroids.append(np.stack([
+                np.bincount(ids, weights=rows, minlength=regions.nr_instances)[keep] / areas + top,
+                np.bincount(ids, weights=cols, minlength=regions.nr_instances)[keep] / areas + left,
+            ], axis=1))
+            nr_instances += keep.sum()
+
+        # same dtype as the untiled output, as long as the labels fit in it
+        if nr_instances <= np.iinfo(INSTANCE_MAP_DTYPE).max:
+            instance_map = instance_map.astype(INSTANCE_MAP_DTYPE)
+        return instance_map, np.concatenate(centroids), nr_skipped
 
     def precompute(
         self,
@@ -196,12 +422,17 @@ class ImageToPatchDataset(Dataset):
     def __init__(
         self,
         image: np.ndarray,
+        tissue_mask: Optional[np.ndarray] = None,
+        min_tissue_fraction: float = 0.0,
     ) -> None:
         """Create a dataset for a given image and extracted instance maps with desired patches.
            Patches have shape of (3, 256, 256) as defined by HoverNet model.
 
         Args:
             image (np.ndarray): RGB input image
+            tissue_mask (Optional[np.ndarray]): Tissue mask of the image. Defaults to None.
+            min_tissue_fraction (float): Windows whose output holds a smaller fraction of tissue are left
+                                         out of the dataset, in skipped_coords. Defaults to 0.
         """
         self.image = image
         self.dataset_transform = transforms.Compose(
@@ -211,12 +442,17 @@ class ImageToPatchDataset(Dataset):
         )
         self.im_h = image.shape[0]
         self.im_w = image.shape[1]
-        self.all_patches, self.coords = extract_patches_from_image(
-            image, self.im_h, self.im_w
-        )
-        self.nr_patches = len(self.all_patches)
-        self.max_y_coord = max([coord[-2] for coord in self.coords])
-        self.max_x_coord = max([coord[-1] for coord in self.coords])
+        # windows are sliced from the padded image on access
+        self.padded_image, last_h, last_w = pad_image(image, self.im_h, self.im_w)
+        self.coords = get_patch_coords(last_h, last_w)
+        self.skipped_coords = []
+        if tissue_mask is not None and min_tissue_fraction > 0:
+            keep = get_tissue_fractions(tissue_mask, last_h, last_w) >= min_tissue_fraction
+            self.skipped_coords = [c for c, k in zip(self.coords, keep) if not k]
+            self.coords = [c for c, k in zip(self.coords, keep) if k]
+        self.nr_patches = len(self.coords)
+        self.max_y_coord = last_w
+        self.max_x_coord = last_h
 
     def __getitem__(self, index: int) -> Tuple[int, torch.Tensor]:
         """Loads an image for a given instance maps index
@@ -227,8 +463,9 @@ class ImageToPatchDataset(Dataset):
         Returns:
             Tuple[int, torch.Tensor]: index, image as tensor
         """
-        patch = self.all_patches[index]
         coord = self.coords[index]
+        left, bottom = coord[0], coord[1]
+        patch = self.padded_image[bottom:bottom + WIN_SIZE[0], left:left + WIN_SIZE[1]]
         transformed_image = self.dataset_transform(Image.fromarray(patch))
         return coord, transformed_image
 
@@ -255,40 +492,144 @@ def process_np_hv_channels(pred: np.ndarray) -> np.ndarray:
     """
 
     # post-process probability map
-    proba_map = np.copy(pred[:, :, 0])  # extract proba maps
-    proba_map[proba_map >= 0.5] = 1
-    proba_map[proba_map < 0.5] = 0
-    proba_map = measurements.label(proba_map)[0]
-    proba_map = remove_small_objects(proba_map, min_size=10)
-    proba_map[proba_map > 0] = 1
-
-    h_dir = pred[:, :, 1]  # extract horizontal map
-    v_dir = pred[:, :, 2]  # extract vertical map
+    proba_map = _binarize_probability_map(pred[:, :, 0])
 
     # normalizing
-    h_dir = cv2.normalize(
-        h_dir,
-        None,
-        alpha=0,
-        beta=1,
-        norm_type=cv2.NORM_MINMAX,
-        dtype=cv2.CV_32F)
-    v_dir = cv2.normalize(
-        v_dir,
-        None,
-        alpha=0,
-        beta=1,
-        norm_type=cv2.NORM_MINMAX,
-        dtype=cv2.CV_32F)
+    h_dir = _normalize(pred[:, :, 1])  # extract horizontal map
+    v_dir = _normalize(pred[:, :, 2])  # extract vertical map
 
     # apply sobel filtering
-    sobelh = cv2.Sobel(h_dir, cv2.CV_64F, 1, 0, ksize=21)
-    sobelv = cv2.Sobel(v_dir, cv2.CV_64F, 0, 1, ksize=21)
+    sobelh, sobelv = _sobel_hv(h_dir, v_dir)
+
+    dist, marker = _markers(proba_map, sobelh, sobelv)
+    marker = remove_small_objects(marker, min_size=10)
+
+    pred_inst = watershed(dist, marker, mask=proba_map, watershed_line=False)
+
+    return pred_inst
+
 
-    sobelh = 1 - (cv2.normalize(sobelh, None, alpha=0, beta=1,
-                                norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F))
-    sobelv = 1 - (cv2.normalize(sobelv, None, alpha=0, beta=1,
-                                norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F))
+def process_np_hv_channels_tiled(
+    pred: np.ndarray,
+    tile_size: int = POSTPROCESSING_TILE_SIZE,
+    halo: int = POSTPROCESSING_HALO,
+    n_jobs: int = 1,
+    parallel_backend: str = "processes",
+) -> np.ndarray:
+    """
+    Process Nuclei Prediction with XY Coordinate Map tile by tile, with the same output as
+    process_np_hv_channels. The probability map is thresholded and the maps are min-max
+    normalised on the whole image. Filtering, markers and watershed run on tiles with a halo
+    of context, in a pool of n_jobs workers. Each tile returns the nuclei and markers whose
+    first pixel lies in it, and the markers are numbered in raster order of their first pixel,
+    as in the whole image. Tiles with a nucleus or marker close to the border of their halo
+    are processed again with a twice larger halo.
+
+    Args:
+        pred (np.ndarray): HoverNet model output, see process_np_hv_channels
+        tile_size (int, optional): Size of the tiles. Defaults to 1024.
+        halo (int, optional): Context added on each side of a tile. Defaults to 64.
+        n_jobs (int, optional): Number of workers. Defaults to 1.
+        parallel_backend (str, optional): Worker pool used if n_jobs > 1, either "processes"
+                                          or "threads". Defaults to "processes".
+    Returns:
+         pred_instance (np.ndarray): instance map
+    """
+    proba_map = _binarize_probability_map(pred[:, :, 0])
+    h_dir = _normalize(pred[:, :, 1])
+    v_dir = _normalize(pred[:, :, 2])
+    shape = proba_map.shape
+    tiles = [
+        (row, col, min(row + tile_size, shape[0]), min(col + tile_size, shape[1]))
+        for row in range(0, shape[0], tile_size)
+        for col in range(0, shape[1], tile_size)
+    ]
+    tile_halos = [SOBEL_KSIZE // 2] * len(tiles)
+
+    def run(task, pending, *args):
+        # run task on the pending tiles, cropped with their halo
+        tasks = []
+        for i in pending:
+            crop = _crop_box(tiles[i], tile_halos[i], shape)
+            region = (slice(crop[0], crop[2]), slice(crop[1], crop[3]))
+            tasks.append((proba_map[region], h_dir[region], v_dir[region], crop, tiles[i], shape) + args)
+        if n_jobs > 1 and len(tasks) > 1:
+            with get_worker_pool(min(n_jobs, len(tasks)), parallel_backend) as pool:
+                return pool.starmap(task, tasks)
+        return [task(*task_args) for task_args in tasks]
+
+    # the sobel maps are normalised with their range on the whole image
+    ranges = np.array(run(_sobel_range_task, range(len(tiles))))
+    sobel_ranges = (
+        (ranges[:, 0].min(), ranges[:, 1].max()),
+        (ranges[:, 2].min(), ranges[:, 3].max()),
+    )
+
+    tile_halos = [halo] * len(tiles)
+    results = [None] * len(tiles)
+    pending = list(range(len(tiles)))
+    while len(pending) > 0:
+        for i, result in zip(pending, run(_watershed_task, pending, sobel_ranges)):
+            results[i] = result
+            tile_halos[i] *= 2
+        pending = [i for i in pending if results[i] is None]
+
+    # number the markers in raster order of their first pixel, as measurements.label
+    marker_starts = np.sort(np.concatenate([result[0] for result in results]))
+    pred_inst = np.zeros(shape[0] * shape[1], dtype=np.int32)
+    for _, pixels, starts in results:
+        pred_inst[pixels] = np.searchsorted(marker_starts, starts) + 1
+    return pred_inst.reshape(shape)
+
+
+def _binarize_probability_map(proba: np.ndarray) -> np.ndarray:
+    """Threshold the nuclei probability map and remove the small objects"""
+    proba_map = np.copy(proba)
+    proba_map[proba_map >= 0.5] = 1
+    proba_map[proba_map < 0.5] = 0
+    proba_map = measurements.label(proba_map)[0]
+    proba_map = remove_small_objects(proba_map, min_size=10)
+    proba_map[proba_map > 0] = 1
+    return proba_map
+
+
+def _normalize(
+    x: np.ndarray, value_range: Optional[Tuple[float, float]] = None
+) -> np.ndarray:
+    """Min-max normalisation of a map to [0, 1] in float32, over value_range instead of the range of the map if given.
+    Values outside of value_range are clipped."""
+    if value_range is None:
+        return cv2.normalize(
+            x,
+            None,
+            alpha=0,
+            beta=1,
+            norm_type=cv2.NORM_MINMAX,
+            dtype=cv2.CV_32F)
+    # append the extremes of the range, so that cv2 scales the values exactly as in a map with this range
+    extended = np.concatenate([
+        np.clip(x.ravel(), *value_range),
+        np.asarray(value_range, dtype=x.dtype),
+    ])
+    return _normalize(extended[:, None])[:-2, 0].reshape(x.shape)
+
+
+def _sobel_hv(h_dir: np.ndarray, v_dir: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Horizontal gradient of the X-map and vertical gradient of the Y-map"""
+    sobelh = cv2.Sobel(h_dir, cv2.CV_64F, 1, 0, ksize=SOBEL_KSIZE)
+    sobelv = cv2.Sobel(v_dir, cv2.CV_64F, 0, 1, ksize=SOBEL_KSIZE)
+    return sobelh, sobelv
+
+
+def _markers(
+    proba_map: np.ndarray,
+    sobelh: np.ndarray,
+    sobelv: np.ndarray,
+    sobel_ranges: Tuple[Optional[Tuple[float, float]], Optional[Tuple[float, float]]] = (None, None),
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Energy landscape and labelled markers of the watershed, including the small markers"""
+    sobelh = 1 - _normalize(sobelh, sobel_ranges[0])
+    sobelv = 1 - _normalize(sobelv, sobel_ranges[1])
 
     # binarize
     overall = np.maximum(sobelh, sobelv)
@@ -306,28 +647,127 @@ def process_np_hv_channels(pred: np.ndarray) -> np.ndarray:
     kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
     marker = cv2.morphologyEx(marker, cv2.MORPH_OPEN, kernel)
     marker = measurements.label(marker)[0]
-    marker = remove_small_objects(marker, min_size=10)
+    return dist, marker
+
+
+def _crop_box(
+    tile: Tuple[int, int, int, int], halo: int, shape: Tuple[int, int]
+) -> Tuple[int, int, int, int]:
+    """Box (top, left, bottom, right) of a tile extended by a halo and clipped to the image"""
+    return (
+        max(tile[0] - halo, 0),
+        max(tile[1] - halo, 0),
+        min(tile[2] + halo, shape[0]),
+        min(tile[3] + halo, shape[1]),
+    )
+
+
+def _first_pixels(
+    labels: np.ndarray, crop: Tuple[int, int, int, int], shape: Tuple[int, int]
+) -> np.ndarray:
+    """Raster index in the image of the first pixel of every label of a crop, -1 for the background"""
+    first = np.unique(labels.ravel(), return_index=True)[1]
+    rows, cols = np.divmod(first, labels.shape[1])
+    starts = (rows + crop[0]) * shape[1] + cols + crop[1]
+    starts[0] = -1
+    return starts
+
+
+def _sobel_range_task(
+    proba_map: np.ndarray,
+    h_dir: np.ndarray,
+    v_dir: np.ndarray,
+    crop: Tuple[int, int, int, int],
+    tile: Tuple[int, int, int, int],
+    shape: Tuple[int, int],
+) -> Tuple[float, float, float, float]:
+    """Worker task of process_np_hv_channels_tiled, range of the sobel maps in a tile"""
+    sobelh, sobelv = _sobel_hv(h_dir, v_dir)
+    core = (slice(tile[0] - crop[0], tile[2] - crop[0]),
+            slice(tile[1] - crop[1], tile[3] - crop[1]))
+    return sobelh[core].min(), sobelh[core].max(), sobelv[core].min(), sobelv[core].max()
+
+
+def _watershed_task(
+    proba_map: np.ndarray,
+    h_dir: np.ndarray,
+    v_dir: np.ndarray,
+    crop: Tuple[int, int, int, int],
+    tile: Tuple[int, int, int, int],
+    shape: Tuple[int, int],
+    sobel_ranges: Tuple[Tuple[float, float], Tuple[float, float]],
+) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Worker task of process_np_hv_channels_tiled, watershed of a tile
 
-    pred_inst = watershed(dist, marker, mask=proba_map, watershed_line=False)
-
-    return pred_inst
+    Returns:
+        Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]: Raster index of the first pixel of the markers
+            starting in the tile, raster index of the pixels of the nuclei starting in the tile, and raster
+            index of the first pixel of their marker. None if one of these markers or nuclei, or a marker
+            flooding them, comes within HALO_MARGIN of the border of the halo.
+    """
+    sobelh, sobelv = _sobel_hv(h_dir, v_dir)
+    dist, markers = _markers(proba_map, sobelh, sobelv, sobel_ranges)
+    pred_inst = watershed(
+        dist,
+        remove_small_objects(markers, min_size=10),
+        mask=proba_map,
+        watershed_line=False)
+    nuclei = measurements.label(proba_map)[0]
+
+    # markers and nuclei are owned by the tile holding their first pixel
+    def owned(starts):
+        rows, cols = np.divmod(starts, shape[1])
+        return (starts >= 0) & (rows >= tile[0]) & (rows < tile[2]) & (cols >= tile[1]) & (cols < tile[3])
+
+    marker_starts = _first_pixels(markers, crop, shape)
+    owned_markers = owned(marker_starts)
+    owned_nuclei = owned(_first_pixels(nuclei, crop, shape))
+    pixels = owned_nuclei[nuclei] & (pred_inst > 0)
+    flooding_markers = np.zeros_like(owned_markers)
+    flooding_markers[pred_inst[pixels]] = True
+
+    # they are computed as in the whole image if they stay away from the border of the halo
+    height, width = proba_map.shape
+    border = np.ones((height, width), dtype=bool)
+    border[
+        (HALO_MARGIN if crop[0] > 0 else 0):height - (HALO_MARGIN if crop[2] < shape[0] else 0),
+        (HALO_MARGIN if crop[1] > 0 else 0):width - (HALO_MARGIN if crop[3] < shape[1] else 0),
+    ] = False
+    if np.any((owned_markers | flooding_markers)[markers[border]]) or np.any(owned_nuclei[nuclei[border]]):
+        return None
+
+    rows, cols = np.nonzero(pixels)
+    return (
+        marker_starts[owned_markers],
+        (rows + crop[0]) * shape[1] + cols + crop[1],
+        marker_starts[pred_inst[pixels]],
+    )
 
 
 def process_instance(
         pred_map: np.ndarray,
-        output_dtype: str = "uint16") -> np.ndarray:
+        output_dtype: str = INSTANCE_MAP_DTYPE,
+        n_jobs: int = 1,
+        parallel_backend: str = "processes") -> np.ndarray:
     """
     Post processing script for image tiles
 
     Args:
         pred_map (np.ndarray): commbined output of np and hv branches
         output_dtype (str): data type of output
+        n_jobs (int): number of workers. If larger than 1, tiles are post-processed in parallel
+                      with process_np_hv_channels_tiled, with the same output
+        parallel_backend (str): worker pool, either "processes" or "threads"
 
     Returns:
         pred_inst (np.ndarray): pixel-wise nuclear instance segmentation prediction
     """
 
     pred_inst = np.squeeze(pred_map)
-    pred_inst = process_np_hv_channels(pred_inst)
+    if n_jobs > 1:
+        pred_inst = process_np_hv_channels_tiled(
+            pred_inst, n_jobs=n_jobs, parallel_backend=parallel_backend)
+    else:
+        pred_inst = process_np_hv_channels(pred_inst)
     pred_inst = pred_inst.astype(output_dtype)
     return pred_inst
\ No newline at end of file
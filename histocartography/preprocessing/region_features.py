@@ -0,0 +1,460 @@
+"""Bulk computation of region properties for all instances of an instance map at once"""
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from scipy import ndimage
+from skimage.measure import grid_points_in_poly, moments, moments_central
+
+from preprocessing.utils import NeighborIndex, RegionIndex
+
+# weights of the border pixel configurations used by skimage.measure.perimeter
+PERIMETER_WEIGHTS = np.zeros(50, dtype=np.float64)
+PERIMETER_WEIGHTS[[5, 7, 15, 17, 25, 27]] = 1
+PERIMETER_WEIGHTS[[21, 33]] = np.sqrt(2)
+PERIMETER_WEIGHTS[[13, 23]] = (1 + np.sqrt(2)) / 2
+# coefficients of the 2x2 pixel configurations for the Euler number with 8-connectivity (Ohser et al.),
+# as used by skimage.measure.euler_number
+EULER_COEFS = np.array([0, 0, 0, 0, 0, 0, -1, 0, 1, 0, 0, 0, 0, 0, -1, 0])
+GLCM_LEVELS = 256
+# midpoints of the pixel edges, which span the convex hull of a set of pixels
+HULL_OFFSETS = np.array([[0, 0.5], [0, -0.5], [0.5, 0], [-0.5, 0]])
+
+
+def _shifted(array: np.ndarray, dy: int, dx: int) -> np.ndarray:
+    """View of a 1-padded array shifted by (dy, dx) and cropped to the unpadded shape"""
+    height, width = array.shape[0] - 2, array.shape[1] - 2
+    return array[1 + dy: 1 + dy + height, 1 + dx: 1 + dx + width]
+
+
+def area_features(pixels: RegionIndex) -> Dict[str, np.ndarray]:
+    """Computes the area and bounding box based properties of all instances.
+    Follows the definitions of skimage.measure.regionprops.
+
+    Args:
+        pixels (RegionIndex): Region index of the instance map
+
+    Returns:
+        Dict[str, np.ndarray]: Properties per instance: area, centroid, equivalent_diameter
+                               and extent
+    """
+    area = pixels.areas.astype(np.float64)
+    bbox_area = np.prod(
+        pixels.bboxes[:, 2:] - pixels.bboxes[:, :2], axis=1).astype(np.float64)
+    return {
+        "area": area,
+        "centroid": pixels.centroids,
+        "equivalent_diameter": (4 * area / np.pi) ** 0.5,
+        "extent": area / bbox_area,
+    }
+
+
+def inertia_features(pixels: RegionIndex, area: np.ndarray) -> Dict[str, np.ndarray]:
+    """Computes the central moment based properties of all instances.
+    Follows the definitions of skimage.measure.regionprops, with the eigen decomposition of the
+    inertia tensors batched over all instances.
+
+    Args:
+        pixels (RegionIndex): Region index of the instance map
+        area (np.ndarray): Area per instance
+
+    Returns:
+        Dict[str, np.ndarray]: Properties per instance: eccentricity, major_axis_length,
+                               minor_axis_length and orientation
+    """
+    n = pixels.nr_instances
+    # central moments are computed per instance on its bounding box crop, as the orientation
+    # of symmetric instances depends on the rounding of mu11
+    mu20 = np.empty(n, dtype=np.float64)
+    mu02 = np.empty(n, dtype=np.float64)
+    mu11 = np.empty(n, dtype=np.float64)
+    for i in range(n):
+        image = pixels.image(i).astype(np.uint8)
+        raw = moments(image, 3)
+        mu = moments_central(image, (raw[1, 0] / raw[0, 0], raw[0, 1] / raw[0, 0]), 3)
+        mu20[i], mu02[i], mu11[i] = mu[2, 0], mu[0, 2], mu[1, 1]
+    sum_mu = mu20 + mu02
+    inertia_tensor = np.empty((n, 2, 2), dtype=np.float64)
+    inertia_tensor[:, 0, 0] = (sum_mu - mu20) / area
+    inertia_tensor[:, 1, 1] = (sum_mu - mu02) / area
+    inertia_tensor[:, 0, 1] = inertia_tensor[:, 1, 0] = -mu11 / area
+
+    eigvals = np.clip(np.linalg.eigvalsh(inertia_tensor), 0, None)
+    l1, l2 = eigvals[:, 1], eigvals[:, 0]
+    eccentricity = np.zeros(n, dtype=np.float64)
+    nonzero = l1 != 0
+    eccentricity[nonzero] = np.sqrt(1 - l2[nonzero] / l1[nonzero])
+
+    a, b, c = inertia_tensor[:, 0, 0], inertia_tensor[:, 0, 1], inertia_tensor[:, 1, 1]
+    orientation = 0.5 * np.arctan2(-2 * b, c - a)
+    degenerate = (a - c) == 0
+    orientation[degenerate] = np.where(b[degenerate] < 0, np.pi / 4.0, -np.pi / 4.0)
+
+    return {
+        "eccentricity": eccentricity,
+        "major_axis_length": 4 * np.sqrt(l1),
+        "minor_axis_length": 4 * np.sqrt(l2),
+        "orientation": orientation,
+    }
+
+
+def perimeter(pixels: RegionIndex) -> np.ndarray:
+    """Computes the perimeter of all instances following skimage.measure.perimeter with a
+    4-connected neighborhood, evaluated on shifted copies of the index map instead of per instance.
+
+    Args:
+        pixels (RegionIndex): Region index of the instance map
+
+    Returns:
+        np.ndarray: Perimeter per instance
+    """
+    padded = np.pad(pixels.index_map, 1)
+    foreground = pixels.index_map > 0
+    eroded = foreground.copy()
+    for dy, dx in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+        eroded &= _shifted(padded, dy, dx) == pixels.index_map
+    border_map = np.where(foreground & ~eroded, pixels.index_map, 0)
+
+    # code of each border pixel: 1 + 2 * (4-neighbors) + 10 * (diagonal neighbors) on the border
+    padded_border = np.pad(border_map, 1)
+    code = (border_map > 0).astype(np.int64)
+    for dy, dx, weight in [
+        (-1, 0, 2), (1, 0, 2), (0, -1, 2), (0, 1, 2),
+        (-1, -1, 10), (-1, 1, 10), (1, -1, 10), (1, 1, 10),
+    ]:
+        code += weight * ((_shifted(padded_border, dy, dx) == border_map) & (border_map > 0))
+    border_rows, border_cols = np.nonzero(border_map)
+    ids = border_map[border_rows, border_cols] - 1
+    histogram = np.bincount(
+        ids * 50 + code[border_rows, border_cols],
+        minlength=pixels.nr_instances * 50,
+    ).reshape(pixels.nr_instances, 50)
+    return np.array([h @ PERIMETER_WEIGHTS for h in histogram], dtype=np.float64)
+
+
+def euler_number(pixels: RegionIndex) -> np.ndarray:
+    """Computes the Euler number (8-connectivity) of all instances following
+    skimage.measure.euler_number with one pass over all 2x2 pixel configurations of the index map.
+
+    Args:
+        pixels (RegionIndex): Region index of the instance map
+
+    Returns:
+        np.ndarray: Euler number per instance
+    """
+    padded = np.pad(pixels.index_map, 1)
+    corners = [
+        padded[:-1, :-1].ravel(),
+        padded[:-1, 1:].ravel(),
+        padded[1:, :-1].ravel(),
+        padded[1:, 1:].ravel(),
+    ]
+    weights = [8, 2, 4, 1]
+    euler = np.zeros(pixels.nr_instances, dtype=np.int64)
+    for i, label in enumerate(corners):
+        # count each instance once per configuration
+        first = label > 0
+        for previous in corners[:i]:
+            first &= previous != label
+        label = label[first]
+        code = np.zeros(len(label), dtype=np.int64)
+        for corner, weight in zip(corners, weights):
+            code += weight * (corner[first] == label)
+        euler += np.bincount(
+            label - 1, weights=EULER_COEFS[code], minlength=pixels.nr_instances
+        ).astype(np.int64)
+    return euler
+
+
+def convex_hull_features(pixels: RegionIndex) -> Dict[str, np.ndarray]:
+    """Computes the convex hull based properties of all instances.
+    These are computed per instance on its bounding box crop.
+
+    Args:
+        pixels (RegionIndex): Region index of the instance map
+
+    Returns:
+        Dict[str, np.ndarray]: Properties per instance: convex_area and convex_hull_perimeter
+    """
+    convex_area = np.empty(pixels.nr_instances, dtype=np.float64)
+    convex_hull_perimeter = np.empty(pixels.nr_instances, dtype=np.float64)
+    for i in range(pixels.nr_instances):
+        image = pixels.image(i)
+        convex_area[i] = convex_hull_area(image)
+        convex_hull_perimeter[i] = compute_convex_hull_perimeter(image)
+    return {
+        "convex_area": convex_area,
+        "convex_hull_perimeter": convex_hull_perimeter,
+    }
+
+
+def filled_area(pixels: RegionIndex) -> np.ndarray:
+    """Computes the area of all instances with filled holes, per instance on its bounding box crop.
+
+    Args:
+        pixels (RegionIndex): Region index of the instance map
+
+    Returns:
+        np.ndarray: Filled area per instance
+    """
+    structure = np.ones((3, 3))
+    return np.array(
+        [
+            np.sum(ndimage.binary_fill_holes(pixels.image(i), structure))
+            for i in range(pixels.nr_instances)
+        ],
+        dtype=np.float64,
+    )
+
+
+def convex_hull_area(image: np.ndarray) -> float:
+    """Number of pixels in the convex hull of a binary image, as in
+    skimage.morphology.convex_hull_image. The hull of the pixel edge midpoints is computed with
+    OpenCV instead of Qhull, which avoids most of the per call overhead, and rasterized the same way.
+
+    Args:
+        image (np.ndarray): Binary image
+
+    Returns:
+        float: Area of the convex hull
+    """
+    coords = np.argwhere(image)
+    coords = (coords[:, np.newaxis, :] + HULL_OFFSETS).reshape(-1, 2)
+    vertices = cv2.convexHull(coords.astype(np.float32)).reshape(-1, 2)
+    labels = grid_points_in_poly(image.shape, vertices.astype(np.float64), binarize=False)
+    return float(np.sum(labels >= 1))
+
+
+def compute_convex_hull_perimeter(mask: np.ndarray) -> float:
+    """Compute the perimeter of the convex hull induced by the input mask."""
+    contours, _ = cv2.findContours(
+        np.uint8(mask), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE
+    )[-2:]
+    hull = cv2.convexHull(contours[0])
+    return cv2.arcLength(hull, True)
+
+
+def glcm_features(pixels: RegionIndex, gray_image: np.ndarray) -> Dict[str, np.ndarray]:
+    """Computes the texture properties of the grey-level co-occurance matrix (distance 1, angle 0,
+    256 levels) of all instances, excluding the co-occurences with grey level 0.
+    The co-occurences of all instances are accumulated at once and keyed by instance.
+
+    Args:
+        pixels (RegionIndex): Region index of the instance map
+        gray_image (np.ndarray): Grey-level image of type uint8
+
+    Returns:
+        Dict[str, np.ndarray]: Properties per instance: glcm_contrast, glcm_dissimilarity,
+                               glcm_homogeneity, glcm_energy, glcm_ASM and glcm_dispersion
+    """
+    n = pixels.nr_instances
+    index_map = pixels.index_map
+    left, right = gray_image[:, :-1], gray_image[:, 1:]
+    valid = (index_map[:, :-1] > 0) & (index_map[:, :-1] == index_map[:, 1:])
+    valid &= (left > 0) & (right > 0)
+    ids = index_map[:, :-1][valid].astype(np.int64) - 1
+    i = left[valid].astype(np.int64)
+    j = right[valid].astype(np.int64)
+
+    # sparse co-occurence matrices: one entry per non-empty (instance, i, j) cell
+    cells, counts = np.unique(
+        (ids * GLCM_LEVELS + i) * GLCM_LEVELS + j, return_counts=True
+    )
+    cell_ids = cells // (GLCM_LEVELS * GLCM_LEVELS)
+    diff = (cells // GLCM_LEVELS) % GLCM_LEVELS - cells % GLCM_LEVELS
+    totals = np.bincount(cell_ids, weights=counts, minlength=n)
+    p = counts / np.where(totals == 0, 1, totals)[cell_ids]
+
+    def _sum(values: np.ndarray) -> np.ndarray:
+        return np.bincount(cell_ids, weights=values, minlength=n)
+
+    asm = _sum(p ** 2)
+    nr_cells = (GLCM_LEVELS - 1) ** 2
+    mean = totals / nr_cells
+    nr_empty = nr_cells - np.bincount(cell_ids, minlength=n)
+    variance = (_sum((counts - mean[cell_ids]) ** 2) + nr_empty * mean ** 2) / nr_cells
+    return {
+        "glcm_contrast": _sum(p * diff ** 2),
+        "glcm_dissimilarity": _sum(p * np.abs(diff)),
+        "glcm_homogeneity": _sum(p / (1.0 + diff ** 2)),
+        "glcm_energy": np.sqrt(asm),
+        "glcm_ASM": asm,
+        "glcm_dispersion": np.sqrt(variance),
+    }
+
+
+def crowdedness(
+    centroids: np.ndarray, k: int = 10, index: Optional[NeighborIndex] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Computes the mean and standard deviation of the distances of each centroid to its k nearest
+    centroids (including itself) with a KD-tree.
+
+    Args:
+        centroids (np.ndarray): Centroids of the instances
+        k (int, optional): Number of neighbors. Reduced to nr_centroids - 2 for fewer centroids.
+            Defaults to 10.
+        index (Optional[NeighborIndex], optional): Neighbor index of the centroids to reuse.
+            Defaults to None.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Mean and standard deviation of the distances per instance
+    """
+    n_centroids = len(centroids)
+    if n_centroids < 3:
+        return np.zeros(n_centroids), np.zeros(n_centroids)
+    if n_centroids < k:
+        k = n_centroids - 2
+    if index is None:
+        index = NeighborIndex(centroids)
+    distances, _ = index.query(k + 1)
+    return np.mean(distances, axis=1), np.std(distances, axis=1)
+
+
+class FeatureGroup:
+    """Named group of features computed together from the labelled pixels, the RGB image and
+    previously computed features
+    """
+
+    def __init__(
+        self,
+        function: Callable[[RegionIndex, np.ndarray, Dict[str, np.ndarray]], Dict[str, np.ndarray]],
+        outputs: List[str],
+        dependencies: Optional[List[str]] = None,
+    ) -> None:
+        """
+        Args:
+            function (Callable): Computes the outputs from the labelled pixels, the RGB image and
+                a dictionary that holds at least the dependencies
+            outputs (List[str]): Names of the computed features
+            dependencies (Optional[List[str]], optional): Names of the features this group needs.
+                Defaults to None.
+        """
+        self.function = function
+        self.outputs = outputs
+        self.dependencies = dependencies if dependencies is not None else []
+
+
+def _glcm_group(pixels, image, features):
+    return glcm_features(pixels, cv2.cvtColor(image, cv2.COLOR_RGB2GRAY))
+
+
+def _crowdedness_group(pixels, image, features):
+    mean_crowdedness, std_crowdedness = crowdedness(features["centroid"])
+    return {"mean_crowdedness": mean_crowdedness, "std_crowdedness": std_crowdedness}
+
+
+FEATURE_GROUPS = {
+    "area": FeatureGroup(
+        lambda pixels, image, features: area_features(pixels),
+        ["area", "centroid", "equivalent_diameter", "extent"],
+    ),
+    "inertia": FeatureGroup(
+        lambda pixels, image, features: inertia_features(pixels, features["area"]),
+        ["eccentricity", "major_axis_length", "minor_axis_length", "orientation"],
+        ["area"],
+    ),
+    "convex_hull": FeatureGroup(
+        lambda pixels, image, features: convex_hull_features(pixels),
+        ["convex_area", "convex_hull_perimeter"],
+    ),
+    "filled_area": FeatureGroup(
+        lambda pixels, image, features: {"filled_area": filled_area(pixels)},
+        ["filled_area"],
+    ),
+    "perimeter": FeatureGroup(
+        lambda pixels, image, features: {"perimeter": perimeter(pixels)},
+        ["perimeter"],
+    ),
+    "euler_number": FeatureGroup(
+        lambda pixels, image, features: {"euler_number": euler_number(pixels)},
+        ["euler_number"],
+    ),
+    "solidity": FeatureGroup(
+        lambda pixels, image, features: {
+            "solidity": features["area"] / features["convex_area"]},
+        ["solidity"],
+        ["area", "convex_area"],
+    ),
+    "roughness": FeatureGroup(
+        lambda pixels, image, features: {
+            "roughness": features["convex_hull_perimeter"] / features["perimeter"]},
+        ["roughness"],
+        ["convex_hull_perimeter", "perimeter"],
+    ),
+    "shape_factor": FeatureGroup(
+        lambda pixels, image, features: {
+            "shape_factor": 4 * np.pi * features["area"] / features["convex_hull_perimeter"] ** 2},
+        ["shape_factor"],
+        ["area", "convex_hull_perimeter"],
+    ),
+    "ellipticity": FeatureGroup(
+        lambda pixels, image, features: {
+            "ellipticity": features["minor_axis_length"] / features["major_axis_length"]},
+        ["ellipticity"],
+        ["minor_axis_length", "major_axis_length"],
+    ),
+    "roundness": FeatureGroup(
+        lambda pixels, image, features: {
+            "roundness": (4 * np.pi * features["area"]) / (features["perimeter"] ** 2)},
+        ["roundness"],
+        ["area", "perimeter"],
+    ),
+    "glcm": FeatureGroup(
+        _glcm_group,
+        [
+            "glcm_contrast",
+            "glcm_dissimilarity",
+            "glcm_homogeneity",
+            "glcm_energy",
+            "glcm_ASM",
+            "glcm_dispersion",
+        ],
+    ),
+    "crowdedness": FeatureGroup(
+        _crowdedness_group,
+        ["mean_crowdedness", "std_crowdedness"],
+        ["centroid"],
+    ),
+}
+FEATURE_PROVIDERS = {
+    output: name for name, group in FEATURE_GROUPS.items() for output in group.outputs
+}
+
+
+def compute_region_features(
+    pixels: RegionIndex,
+    image: np.ndarray,
+    names: List[str],
+    features: Optional[Dict[str, np.ndarray]] = None,
+) -> Dict[str, np.ndarray]:
+    """Computes the requested features of all instances, only running the feature groups that
+    provide them and their dependencies.
+
+    Args:
+        pixels (RegionIndex): Region index of the instance map
+        image (np.ndarray): RGB image
+        names (List[str]): Names of the requested features
+        features (Optional[Dict[str, np.ndarray]], optional): Already computed features, which
+            are not computed again. Defaults to None.
+
+    Returns:
+        Dict[str, np.ndarray]: Computed features per instance, including the dependencies
+    """
+    features = dict() if features is None else features
+
+    def _compute(name: str) -> None:
+        if name in features:
+            return
+        assert name in FEATURE_PROVIDERS, (
+            f"Unknown feature {name}. Options are {list(FEATURE_PROVIDERS.keys())}"
+        )
+        group = FEATURE_GROUPS[FEATURE_PROVIDERS[name]]
+        for dependency in group.dependencies:
+            _compute(dependency)
+        for output, values in group.function(pixels, image, features).items():
+            features.setdefault(output, values)
+
+    for name in names:
+        _compute(name)
+    return features
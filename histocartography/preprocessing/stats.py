@@ -12,6 +12,8 @@ from pipeline import PipelineStep
 
 
 class StatsComputer(PipelineStep):
+    cacheable = False
+
     def mkdir(self) -> Path:
         """Create path to output files"""
         assert (
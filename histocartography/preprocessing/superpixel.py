@@ -1,21 +1,29 @@
 """This module handles everything related to superpixels"""
 
+import heapq
 import logging
 import math
 import sys
 from abc import abstractmethod
 from pathlib import Path
-from typing import Any, Dict, Optional, Union
+from typing import Any, Optional, Tuple, Union
 
 import cv2
 import h5py
 import numpy as np
+from scipy import ndimage
 from skimage.color.colorconv import rgb2hed
-from skimage import graph
 from skimage.segmentation import slic
 
 from pipeline import PipelineStep
 
+COLOR_HISTOGRAM_BINS = np.arange(0, 257, 64)
+
+
+def _row_norms(x: np.ndarray) -> np.ndarray:
+    """Euclidean norm of each row, computed as a dot product like np.linalg.norm of a single row"""
+    return np.sqrt(np.matmul(x[:, None, :], x[:, :, None])[:, 0, 0])
+
 
 class SuperpixelExtractor(PipelineStep):
     """Helper class to extract superpixels from images"""
@@ -278,16 +286,8 @@ class MergedSuperpixelExtractor(SuperpixelExtractor):
             initial_superpixels = superpixels
 
         # Merge superpixels within tissue region
-        g = self._generate_graph(input_image, initial_superpixels)
-        merged_superpixels = graph.merge_hierarchical(
-            initial_superpixels,
-            g,
-            thresh=self.threshold,
-            rag_copy=False,
-            in_place_merge=True,
-            merge_func=self._merging_function,
-            weight_func=self._weighting_function,
-        )
+        merged_superpixels = self._merge_hierarchical(
+            input_image, initial_superpixels)
         merged_superpixels += 1  # Handle regionprops that ignores all values of 0
         mask = np.zeros_like(initial_superpixels)
         mask[initial_superpixels != 0] = 1
@@ -295,20 +295,67 @@ class MergedSuperpixelExtractor(SuperpixelExtractor):
         return merged_superpixels
 
     @abstractmethod
-    def _generate_graph(
+    def _merge_hierarchical(
         self, input_image: np.ndarray, superpixels: np.ndarray
-    ) -> graph.RAG:
-        """Generate a graph based on the input image and initial superpixel segmentation."""
-
-    @abstractmethod
-    def _weighting_function(
-        self, graph: graph.RAG, src: int, dst: int, n: int
-    ) -> Dict[str, Any]:
-        """Handle merging of nodes of a region boundary region adjacency graph."""
+    ) -> np.ndarray:
+        """Greedily merge the most similar adjacent superpixels until no edge weight is below the threshold
+        Args:
+            input_image (np.ndarray): Input image
+            superpixels (np.ndarray): Initial superpixel instance map
+        Returns:
+            np.ndarray: Merged superpixel map, with labels starting at 0
+        """
 
-    @abstractmethod
-    def _merging_function(self, graph: graph.RAG, src: int, dst: int) -> None:
-        """Call back called before merging 2 nodes."""
+    def _region_adjacency(
+        self, superpixels: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Compute the nodes and edges of the region adjacency graph of the superpixels, as skimage.graph.RAG
+           would without building it. The label map is compared with its shifts by the offsets of the
+           connectivity footprint. graph.RAG adds the nodes while it scans the pixels in raster order
+           and, at each pixel, the footprint offsets in order, the label of the pixel before the label
+           of its neighbor. The node order is thus the order of the first (pixel, offset, end) at which
+           a label borders another label.
+        Args:
+            superpixels (np.ndarray): Superpixel instance map
+        Returns:
+            np.ndarray: Labels of the nodes, in the node order of graph.RAG
+            np.ndarray: Edges as pairs of labels, the first label preceding the second in node order
+        """
+        height, width = superpixels.shape
+        labels = superpixels.astype(np.int64)
+        nr_labels = int(labels.max()) + 1
+        # offsets in the order in which the footprint values are passed by ndimage.generic_filter
+        offsets = np.argwhere(ndimage.generate_binary_structure(2, self.connectivity)) - 1
+        # the border is replicated as with mode="nearest"
+        padded = np.pad(labels, 1, mode="edge")
+        first = np.full(nr_labels, np.iinfo(np.int64).max)
+        keys = list()
+        for i, (dy, dx) in enumerate(offsets):
+            neighbors = padded[1 + dy:1 + dy + height, 1 + dx:1 + dx + width]
+            differ = np.flatnonzero(neighbors != labels)
+            if len(differ) == 0:
+                continue
+            u = labels.ravel()[differ]
+            v = neighbors.ravel()[differ]
+            order = (differ * len(offsets) + i) * 2
+            np.minimum.at(first, u, order)
+            np.minimum.at(first, v, order + 1)
+            keys.append(np.unique(np.minimum(u, v) * nr_labels + np.maximum(u, v)))
+
+        nodes = np.flatnonzero(first < np.iinfo(np.int64).max)
+        nodes = nodes[np.argsort(first[nodes], kind="stable")]
+        nodes = nodes[nodes != 0]  # remove background node
+        if len(keys) == 0:
+            return nodes, np.empty((0, 2), dtype=np.int64)
+        keys = np.unique(np.concatenate(keys))
+        edges = np.stack([keys // nr_labels, keys % nr_labels], axis=1)
+        edges = edges[edges[:, 0] != 0]
+        # orient and sort the edges by node order
+        ranks = np.zeros(nr_labels, dtype=np.int64)
+        ranks[nodes] = np.arange(len(nodes))
+        edges = np.where((ranks[edges[:, 0]] > ranks[edges[:, 1]])[:, None], edges[:, ::-1], edges)
+        edges = edges[np.lexsort((ranks[edges[:, 1]], ranks[edges[:, 0]]))]
+        return nodes, edges
 
     def _extract_superpixels(
         self, image: np.ndarray, tissue_mask: np.ndarray = None
@@ -424,132 +471,168 @@ class ColorMergedSuperpixelExtractor(MergedSuperpixelExtractor):
         self.w_mean = w_mean
         super().__init__(**kwargs)
 
-    def _color_features_per_channel(self, img_ch: np.ndarray) -> np.ndarray:
-        """Extract color histograms from image channel
+    @staticmethod
+    def _color_histograms(
+        labels: np.ndarray, pixels: np.ndarray, nr_labels: int
+    ) -> np.ndarray:
+        """Extract the color histograms of all labels at once
         Args:
-            img_ch (np.ndarray): Image channel
+            labels (np.ndarray): Label of each pixel, shape [n]
+            pixels (np.ndarray): Color of each pixel, shape [n, nr_channels]
+            nr_labels (int): Number of labels, ie largest label + 1
         Returns:
-            np.ndarray: Histogram of the image channel
+            np.ndarray: Histograms, shape [nr_labels, nr_channels, nr_bins]
         """
-        hist, _ = np.histogram(img_ch, bins=np.arange(0, 257, 64))  # 8 bins
-        return hist
+        edges = COLOR_HISTOGRAM_BINS
+        nr_bins = len(edges) - 1
+        # same binning as np.histogram: half-open bins, the last one closed
+        bins = np.searchsorted(edges, pixels, side="right") - 1
+        bins[pixels == edges[-1]] = nr_bins - 1
+        valid = (bins >= 0) & (bins < nr_bins)
+        channels = np.broadcast_to(np.arange(pixels.shape[1]), pixels.shape)
+        keys = (labels[:, None] * pixels.shape[1] + channels) * nr_bins + bins
+        histograms = np.bincount(
+            keys[valid], minlength=nr_labels * pixels.shape[1] * nr_bins
+        )
+        return histograms.reshape(nr_labels, pixels.shape[1], nr_bins)
 
-    def _generate_graph(
+    def _color_statistics(
         self, input_image: np.ndarray, superpixels: np.ndarray
-    ) -> graph:
-        """Construct RAG graph using initial superpixel instance map
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Compute the pixel counts, color sums and color histograms of all superpixels
+        Args:
+            input_image (np.ndarray): Input image
+            superpixels (np.ndarray): Superpixel instance map
+        Returns:
+            np.ndarray: Number of pixels per label, shape [nr_labels]
+            np.ndarray: Sum of the pixel colors per label, shape [nr_labels, nr_channels]
+            np.ndarray: Color histograms per label, shape [nr_labels, nr_channels, nr_bins]
+        """
+        labels = superpixels.ravel()
+        pixels = input_image.reshape(-1, input_image.shape[-1]).astype(np.int64)
+        nr_labels = labels.max() + 1
+        counts = np.bincount(labels, minlength=nr_labels)
+        sums = np.stack(
+            [
+                np.bincount(labels, weights=pixels[:, c], minlength=nr_labels)
+                for c in range(pixels.shape[1])
+            ],
+            axis=1,
+        ).astype(np.int64)
+        histograms = self._color_histograms(labels, pixels, nr_labels)
+        return counts, sums, histograms
+
+    def _color_distances(
+        self,
+        means: np.ndarray,
+        histograms: np.ndarray,
+        u: np.ndarray,
+        v: np.ndarray,
+        mean_scale: float,
+    ) -> np.ndarray:
+        """Compute the weights of the edges between the labels u and v
+        Args:
+            means (np.ndarray): Normalised mean color per label, shape [nr_labels, 3]
+            histograms (np.ndarray): Normalised r, g, b histograms per label, shape [nr_labels, 3, nr_bins]
+            u (np.ndarray): Labels of the first end of the edges
+            v (np.ndarray): Labels of the second end of the edges
+            mean_scale (float): Scale of the mean color distance, 2 for the edges of the initial graph
+                                and 1 for the edges of a merged superpixel, as in the HACT-Net implementation
+        Returns:
+            np.ndarray: Edge weights
+        """
+        diff_mean = _row_norms(means[u] - means[v]) / mean_scale
+        diff_r = _row_norms(histograms[u, 0] - histograms[v, 0]) / 2
+        diff_g = _row_norms(histograms[u, 1] - histograms[v, 1]) / 2
+        diff_b = _row_norms(histograms[u, 2] - histograms[v, 2]) / 2
+        diff_hist = (diff_r + diff_g + diff_b) / 3
+        return self.w_hist * diff_hist + self.w_mean * diff_mean
+
+    def _merge_hierarchical(
+        self, input_image: np.ndarray, superpixels: np.ndarray
+    ) -> np.ndarray:
+        """Greedily merge the most similar adjacent superpixels until no edge weight is below the threshold.
+           Follows the same merging order as skimage.graph.merge_hierarchical on a color RAG of the superpixels,
+           but keeps the node features in per-label arrays updated in place and the edges in a heap of
+           (weight, src, dst) entries, invalidated lazily with per-label versions.
         Args:
             input_image (np.ndarray): Input image
             superpixels (np.ndarray): Initial superpixel instance map
         Returns:
-            graph: Constructed graph
+            np.ndarray: Merged superpixel map, with labels starting at 0
         """
-        g = graph.RAG(superpixels, connectivity=self.connectivity)
-        if 0 in g.nodes:
-            g.remove_node(n=0)  # remove background node
-
-        for n in g:
-            g.nodes[n].update(
-                {
-                    "labels": [n],
-                    "N": 0,
-                    "x": np.array([0, 0, 0]),
-                    "y": np.array([0, 0, 0]),
-                    "r": np.array([]),
-                    "g": np.array([]),
-                    "b": np.array([]),
-                }
+        nodes, edges = self._region_adjacency(superpixels)
+        counts, sums, histograms = self._color_statistics(
+            input_image, superpixels)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means = sums / counts[:, None]
+            means = means / _row_norms(means)[:, None]
+            r = histograms[:, 0] / _row_norms(histograms[:, 0])[:, None]
+            features = np.stack(
+                [
+                    r,
+                    r / _row_norms(histograms[:, 1])[:, None],
+                    r / _row_norms(histograms[:, 2])[:, None],
+                ],
+                axis=1,
             )
 
-        for index in np.ndindex(superpixels.shape):
-            current = superpixels[index]
-            if current == 0:
+        weights = self._color_distances(
+            means, features, edges[:, 0], edges[:, 1], 2)
+        heap = [
+            (w, u, v, 0, 0)
+            for w, (u, v) in zip(weights.tolist(), edges.tolist())
+        ]
+        heapq.heapify(heap)
+        neighbors = {n: set() for n in nodes.tolist()}
+        for u, v in edges.tolist():
+            neighbors[u].add(v)
+            neighbors[v].add(u)
+        versions = dict.fromkeys(neighbors, 0)
+
+        merges = list()
+        while len(heap) > 0 and heap[0][0] < self.threshold:
+            _, src, dst, src_version, dst_version = heapq.heappop(heap)
+            # skip edges whose ends were merged since they were pushed
+            if versions[src] != src_version or versions[dst] != dst_version:
                 continue
-            g.nodes[current]["N"] += 1
-            g.nodes[current]["x"] += input_image[index]
-            g.nodes[current]["y"] = np.vstack(
-                (g.nodes[current]["y"], input_image[index])
-            )
-
-        for n in g:
-            g.nodes[n]["mean"] = g.nodes[n]["x"] / g.nodes[n]["N"]
-            g.nodes[n]["mean"] = g.nodes[n]["mean"] / \
-                np.linalg.norm(g.nodes[n]["mean"])
-
-            g.nodes[n]["y"] = np.delete(g.nodes[n]["y"], 0, axis=0)
-            g.nodes[n]["r"] = self._color_features_per_channel(
-                g.nodes[n]["y"][:, 0])
-            g.nodes[n]["g"] = self._color_features_per_channel(
-                g.nodes[n]["y"][:, 1])
-            g.nodes[n]["b"] = self._color_features_per_channel(
-                g.nodes[n]["y"][:, 2])
-
-            g.nodes[n]["r"] = g.nodes[n]["r"] / np.linalg.norm(g.nodes[n]["r"])
-            g.nodes[n]["g"] = g.nodes[n]["r"] / np.linalg.norm(g.nodes[n]["g"])
-            g.nodes[n]["b"] = g.nodes[n]["r"] / np.linalg.norm(g.nodes[n]["b"])
-
-        for x, y, d in g.edges(data=True):
-            diff_mean = np.linalg.norm(
-                g.nodes[x]["mean"] - g.nodes[y]["mean"]) / 2
-
-            diff_r = np.linalg.norm(g.nodes[x]["r"] - g.nodes[y]["r"]) / 2
-            diff_g = np.linalg.norm(g.nodes[x]["g"] - g.nodes[y]["g"]) / 2
-            diff_b = np.linalg.norm(g.nodes[x]["b"] - g.nodes[y]["b"]) / 2
-            diff_hist = (diff_r + diff_g + diff_b) / 3
-
-            diff = self.w_hist * diff_hist + self.w_mean * diff_mean
-
-            d["weight"] = diff
-
-        return g
-
-    def _weighting_function(
-        self, graph: graph.RAG, src: int, dst: int, n: int
-    ) -> Dict[str, Any]:
-        diff_mean = np.linalg.norm(
-            graph.nodes[dst]["mean"] -
-            graph.nodes[n]["mean"])
-
-        diff_r = np.linalg.norm(
-            graph.nodes[dst]["r"] - graph.nodes[n]["r"]) / 2
-        diff_g = np.linalg.norm(
-            graph.nodes[dst]["g"] - graph.nodes[n]["g"]) / 2
-        diff_b = np.linalg.norm(
-            graph.nodes[dst]["b"] - graph.nodes[n]["b"]) / 2
-        diff_hist = (diff_r + diff_g + diff_b) / 3
-
-        diff = self.w_hist * diff_hist + self.w_mean * diff_mean
-
-        return {"weight": diff}
-
-    def _merging_function(self, graph: graph.RAG, src: int, dst: int) -> None:
-        graph.nodes[dst]["x"] += graph.nodes[src]["x"]
-        graph.nodes[dst]["N"] += graph.nodes[src]["N"]
-        graph.nodes[dst]["mean"] = graph.nodes[dst]["x"] / \
-            graph.nodes[dst]["N"]
-        graph.nodes[dst]["mean"] = graph.nodes[dst]["mean"] / np.linalg.norm(
-            graph.nodes[dst]["mean"]
-        )
-
-        graph.nodes[dst]["y"] = np.vstack(
-            (graph.nodes[dst]["y"], graph.nodes[src]["y"])
-        )
-        graph.nodes[dst]["r"] = self._color_features_per_channel(
-            graph.nodes[dst]["y"][:, 0]
-        )
-        graph.nodes[dst]["g"] = self._color_features_per_channel(
-            graph.nodes[dst]["y"][:, 1]
-        )
-        graph.nodes[dst]["b"] = self._color_features_per_channel(
-            graph.nodes[dst]["y"][:, 2]
-        )
-
-        graph.nodes[dst]["r"] = graph.nodes[dst]["r"] / np.linalg.norm(
-            graph.nodes[dst]["r"]
-        )
-        graph.nodes[dst]["g"] = graph.nodes[dst]["r"] / np.linalg.norm(
-            graph.nodes[dst]["g"]
-        )
-        graph.nodes[dst]["b"] = graph.nodes[dst]["r"] / np.linalg.norm(
-            graph.nodes[dst]["b"]
-        )
+            versions[src] += 1
+            versions[dst] += 1
+            merges.append((src, dst))
+
+            sums[dst] += sums[src]
+            counts[dst] += counts[src]
+            histograms[dst] += histograms[src]
+            mean = sums[dst] / counts[dst]
+            means[dst] = mean / np.linalg.norm(mean)
+            r = histograms[dst, 0] / np.linalg.norm(histograms[dst, 0])
+            features[dst, 0] = r
+            features[dst, 1] = r / np.linalg.norm(histograms[dst, 1])
+            features[dst, 2] = r / np.linalg.norm(histograms[dst, 2])
+
+            for n in neighbors[src]:
+                neighbors[n].discard(src)
+                if n != dst:
+                    neighbors[n].add(dst)
+            neighbors[dst] |= neighbors.pop(src)
+            neighbors[dst] -= {src, dst}
+
+            if len(neighbors[dst]) > 0:
+                nbrs = np.fromiter(neighbors[dst], dtype=np.int64)
+                weights = self._color_distances(
+                    means, features, np.full_like(nbrs, dst), nbrs, 1)
+                for w, n in zip(weights.tolist(), nbrs.tolist()):
+                    heapq.heappush(
+                        heap, (w, dst, n, versions[dst], versions[n]))
+
+        # resolve the label each superpixel ends up in, last merges first
+        roots = np.arange(superpixels.max() + 1)
+        for src, dst in reversed(merges):
+            roots[src] = roots[dst]
+        # merged superpixels are numbered in node order, as in graph.merge_hierarchical
+        remaining = nodes[roots[nodes] == nodes]
+        ranks = np.zeros_like(roots)
+        ranks[remaining] = np.arange(len(remaining))
+        label_map = np.arange(superpixels.max() + 1)
+        label_map[nodes] = ranks[roots[nodes]]
+        return label_map[superpixels]
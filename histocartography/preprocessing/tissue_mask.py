@@ -119,6 +119,22 @@ class TissueMask(PipelineStep):
                 output_image.save(output_path)
         return output
 
+    def _save_from_cache(self, path: Path, output_name: str, output: np.ndarray) -> None:
+        """Save a cached tissue mask as a png image in the output directory
+
+        Args:
+            path (Path): Path of the cache file
+            output_name (str): Name of output file
+            output (np.ndarray): Tissue mask
+        """
+        if self.store is not None or self.save_path is None:
+            super()._save_from_cache(path, output_name, output)
+            return
+        output_path = self.output_dir / f"{output_name}.png"
+        if not output_path.exists():
+            with Image.fromarray(output) as output_image:
+                output_image.save(output_path)
+
     def precompute(
         self,
         link_path: Union[None, str, Path] = None,
@@ -251,6 +267,8 @@ class GaussianTissueMask(TissueMask):
 
 
 class AnnotationPostProcessor(PipelineStep):
+    cacheable = False
+
     def __init__(self, background_index: int, **kwargs: Any) -> None:
         self.background_index = background_index
         super().__init__(**kwargs)
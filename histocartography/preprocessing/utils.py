@@ -1,9 +1,22 @@
 """Preprocessing utilities"""
 import logging
+import multiprocessing
+import threading
+import weakref
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
+from typing import Any, Callable, Dict, Hashable, Tuple, Union
 
 import numpy as np
 from PIL import Image
+from scipy import ndimage
+from scipy.spatial import cKDTree
+import torch
+
+PARALLEL_BACKENDS = ["processes", "threads"]
+
+_MODEL_CACHE: Dict[Hashable, torch.nn.Module] = dict()
+_MODEL_CACHE_LOCK = threading.Lock()
 
 
 def fast_histogram(input_array: np.ndarray, nr_values: int) -> np.ndarray:
@@ -22,6 +35,293 @@ def fast_histogram(input_array: np.ndarray, nr_values: int) -> np.ndarray:
     return output_array
 
 
+class NeighborIndex:
+    """KD-tree over a set of points for k-nearest neighbor queries, shared by the stages that need
+    the neighborhoods of instance centroids. A query takes O(N log N) time and O(N k) memory.
+    """
+
+    def __init__(self, points: np.ndarray) -> None:
+        """
+        Args:
+            points (np.ndarray): Points of shape [nr_points, nr_dimensions]
+        """
+        self.points = np.asarray(points, dtype=np.float64)
+        self.tree = cKDTree(self.points) if len(self.points) > 0 else None
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def query(self, k: int, include_self: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+        """Finds the k nearest neighbors of every point, sorted by increasing distance. Neighbors at
+           equal distances, which are common with integer centroids, are taken and sorted by
+           increasing index. The result thus does not depend on the order in which the KD-tree or
+           sklearn.neighbors visit tied points.
+
+        Args:
+            k (int): Number of neighbors. Clipped to the number of available points.
+            include_self (bool, optional): Whether a point is its own neighbor. If False, a point
+                is removed from its own neighbors as in sklearn.neighbors.kneighbors_graph.
+                Defaults to True.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Distances and indices of shape [nr_points, k]
+        """
+        nr_points = len(self.points)
+        k = max(0, min(k, nr_points if include_self else nr_points - 1))
+        if k == 0:
+            return np.empty((nr_points, 0)), np.empty((nr_points, 0), dtype=np.int64)
+        if include_self:
+            return self._query(k)
+        distances, indices = self._query(k + 1)
+        # drop the point itself, or the farthest neighbor if it is tied with duplicates
+        is_self = indices == np.arange(nr_points)[:, np.newaxis]
+        is_self[~is_self.any(axis=1), -1] = True
+        keep = ~is_self
+        return distances[keep].reshape(nr_points, k), indices[keep].reshape(nr_points, k)
+
+    def _query(self, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Finds the k nearest neighbors of every point, including itself, with ties broken by index.
+           The KD-tree returns tied neighbors in arbitrary order, so more candidates are queried for
+           the points whose k-th neighbor is tied with the next one, until the tie is resolved.
+
+        Args:
+            k (int): Number of neighbors, between 1 and the number of points
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Distances and indices of shape [nr_points, k]
+        """
+        nr_points = len(self.points)
+        distances = np.empty((nr_points, k))
+        indices = np.empty((nr_points, k), dtype=np.int64)
+        rows = np.arange(nr_points)
+        nr_candidates = min(k + 1, nr_points)
+        while len(rows) > 0:
+            candidate_distances, candidate_indices = self.tree.query(self.points[rows], k=nr_candidates)
+            candidate_distances = candidate_distances.reshape(len(rows), nr_candidates)
+            candidate_indices = candidate_indices.reshape(len(rows), nr_candidates)
+            # the candidates hold all neighbors tied with the k-th one
+            done = (candidate_distances[:, -1] > candidate_distances[:, k - 1]) | (nr_candidates == nr_points)
+            order = np.lexsort((candidate_indices[done], candidate_distances[done]))[:, :k]
+            distances[rows[done]] = np.take_along_axis(candidate_distances[done], order, axis=1)
+            indices[rows[done]] = np.take_along_axis(candidate_indices[done], order, axis=1)
+            rows = rows[~done]
+            nr_candidates = min(2 * nr_candidates, nr_points)
+        return distances, indices
+
+
+def boundary_label_pairs(instance_map: np.ndarray, kernel_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Finds all pairs of different labels (a, b) such that a pixel of b lies in the dilation of a by a
+    square kernel of size kernel_size, as computed by cv2.dilate. Instead of dilating every instance,
+    the label map is compared with its shifts within the kernel, in O(kernel_size^2 H W) time.
+
+    Args:
+        instance_map (np.ndarray): Label map of shape [H, W]
+        kernel_size (int): Size of the square dilation kernel
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Labels a and b of the unique pairs, sorted by (a, b)
+    """
+    height, width = instance_map.shape
+    labels = instance_map.astype(np.int64)
+    nr_labels = int(labels.max()) + 1 if labels.size > 0 else 1
+    anchor = kernel_size // 2
+    keys = list()
+    for dy in range(-anchor, kernel_size - anchor):
+        for dx in range(-anchor, kernel_size - anchor):
+            if dy == 0 and dx == 0:
+                continue
+            # pixel q of label b is reached from pixel q + (dy, dx) of label a
+            b = labels[max(0, -dy):height - max(0, dy), max(0, -dx):width - max(0, dx)]
+            a = labels[max(0, dy):height + min(0, dy), max(0, dx):width + min(0, dx)]
+            differ = a != b
+            keys.append(np.unique(a[differ] * nr_labels + b[differ]))
+    keys = np.unique(np.concatenate(keys)) if len(keys) > 0 else np.empty(0, dtype=np.int64)
+    return keys // nr_labels, keys % nr_labels
+
+
+class RegionIndex:
+    """Compact table of the regions of an instance map, shared by the stages that process the same map
+    instead of recomputing skimage.measure.regionprops in every stage. Instances are indexed from 0 to
+    nr_instances - 1 in increasing order of their label, which is the order of regionprops.
+
+    Use RegionIndex.of to get the index of an instance map. It is computed once per instance map object,
+    also for outputs reloaded from disk, and kept as long as the instance map is alive. Instance maps are
+    thus expected not to be modified in place once indexed.
+    """
+
+    _registry: Dict[int, Tuple[weakref.ref, "RegionIndex"]] = dict()
+
+    def __init__(self, instance_map: np.ndarray) -> None:
+        """
+        Args:
+            instance_map (np.ndarray): Instance map. The background has value 0 and is ignored.
+        """
+        instance_map = np.asarray(instance_map)
+        self.shape = instance_map.shape
+        self.labels = np.unique(instance_map)
+        self.labels = self.labels[self.labels > 0]
+        self.nr_instances = len(self.labels)
+        # index map with 0 as background and the instance indices shifted by 1
+        if self.nr_instances > 0 and self.labels[-1] < 2 ** 24:
+            lookup = np.zeros(self.labels[-1] + 1, dtype=np.int32)
+            lookup[self.labels] = np.arange(1, self.nr_instances + 1)
+            self.index_map = lookup[np.maximum(instance_map, 0)]
+        else:
+            self.index_map = np.searchsorted(
+                self.labels, instance_map).astype(np.int32) + 1
+            self.index_map[instance_map <= 0] = 0
+        self.rows, self.cols = np.nonzero(self.index_map)
+        self.ids = self.index_map[self.rows, self.cols] - 1
+        self.slices = ndimage.find_objects(self.index_map)
+        self.areas = np.bincount(self.ids, minlength=self.nr_instances)
+        self.centroids = np.stack(
+            [self.sum(self.rows) / self.areas, self.sum(self.cols) / self.areas], axis=1
+        ).reshape(-1, 2)
+        self.bboxes = np.array(
+            [[s[0].start, s[1].start, s[0].stop, s[1].stop] for s in self.slices],
+            dtype=np.int64,
+        ).reshape(-1, 4)
+        self._order = None
+
+    @classmethod
+    def of(cls, instance_map: np.ndarray) -> "RegionIndex":
+        """Region index of an instance map, computed on the first request for this instance map object
+
+        Args:
+            instance_map (np.ndarray): Instance map
+
+        Returns:
+            RegionIndex: Region index of the instance map
+        """
+        key = id(instance_map)
+        entry = cls._registry.get(key)
+        if entry is not None and entry[0]() is instance_map:
+            return entry[1]
+        index = cls(instance_map)
+        try:
+            reference = weakref.ref(instance_map, lambda _: cls._registry.pop(key, None))
+        except TypeError:  # not referenceable, e.g. a list
+            return index
+        cls._registry[key] = (reference, index)
+        return index
+
+    def sum(self, values: np.ndarray) -> np.ndarray:
+        """Sum of per-pixel values for each instance
+
+        Args:
+            values (np.ndarray): Values of the foreground pixels, in the order of rows and cols
+
+        Returns:
+            np.ndarray: Sum per instance
+        """
+        return np.bincount(self.ids, weights=values,
+                           minlength=self.nr_instances)
+
+    def image(self, index: int) -> np.ndarray:
+        """Binary image of an instance cropped to its bounding box
+
+        Args:
+            index (int): Index of the instance
+
+        Returns:
+            np.ndarray: Binary image of the instance
+        """
+        return self.index_map[self.slices[index]] == index + 1
+
+    def pixels(self, index: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Coordinates of the pixels of an instance, in raster order
+
+        Args:
+            index (int): Index of the instance
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Rows and columns of the pixels
+        """
+        if self._order is None:
+            # foreground pixels grouped by instance, with the offset of each instance
+            self._order = np.argsort(self.ids, kind="stable")
+            self._offsets = np.concatenate(([0], np.cumsum(self.areas)))
+        pixels = self._order[self._offsets[index]:self._offsets[index + 1]]
+        return self.rows[pixels], self.cols[pixels]
+
+
+def get_worker_pool(
+    n_jobs: int, parallel_backend: str = "processes"
+) -> Union[multiprocessing.pool.Pool, ThreadPool]:
+    """Pool of n_jobs workers. Falls back to threads inside daemonic processes, eg. the workers of
+       a BatchPipelineRunner, which cannot have children.
+
+    Args:
+        n_jobs (int): Number of workers
+        parallel_backend (str, optional): Either "processes" or "threads". Defaults to "processes".
+
+    Returns:
+        Union[multiprocessing.pool.Pool, ThreadPool]: Worker pool
+    """
+    use_processes = (
+        parallel_backend == "processes"
+        and not multiprocessing.current_process().daemon
+    )
+    pool_class = multiprocessing.Pool if use_processes else ThreadPool
+    return pool_class(n_jobs)
+
+
+def get_cached_model(key: Hashable, loader: Callable[[], torch.nn.Module]) -> torch.nn.Module:
+    """Model loaded once per process and shared by all the stages and pipelines asking for the same key.
+       The shared model must not be modified in place, so the key holds every parameter of the loader.
+
+    Args:
+        key (Hashable): Path of the model and parameters of the loader
+        loader (Callable[[], torch.nn.Module]): Loads the model if it is not cached
+
+    Returns:
+        torch.nn.Module: Shared model
+    """
+    with _MODEL_CACHE_LOCK:
+        if key not in _MODEL_CACHE:
+            _MODEL_CACHE[key] = loader()
+        return _MODEL_CACHE[key]
+
+
+def clear_model_cache() -> None:
+    """Release the models shared through get_cached_model"""
+    with _MODEL_CACHE_LOCK:
+        _MODEL_CACHE.clear()
+
+
+def load_model(path: Union[str, Path], map_location: Any = None) -> torch.nn.Module:
+    """Load a TorchScript artifact saved by export_model, or else a pickled module
+
+    Args:
+        path (Union[str, Path]): Path of the model
+        map_location (Any, optional): Device of the loaded tensors. Defaults to None.
+
+    Returns:
+        torch.nn.Module: Loaded model
+    """
+    try:
+        return torch.jit.load(str(path), map_location=map_location)
+    except RuntimeError:
+        # not a TorchScript archive
+        return torch.load(path, map_location=map_location)
+
+
+def export_model(model: torch.nn.Module, example_input: torch.Tensor, path: Union[str, Path]) -> None:
+    """Trace a model in eval mode and save it as a TorchScript artifact. The artifact loads without
+       the model definition and runs its forward without the python overhead. Control flow is fixed
+       to the one of the example_input, whose batch size can change at inference.
+
+    Args:
+        model (torch.nn.Module): Model to export
+        example_input (torch.Tensor): Input of the model, of the shape used at inference
+        path (Union[str, Path]): Path of the artifact
+    """
+    model.eval()
+    with torch.no_grad():
+        traced_model = torch.jit.trace(model, example_input)
+    torch.jit.save(traced_model, str(path))
+
+
 def load_image(image_path: Path) -> np.ndarray:
     """Loads an image from a given path and returns it as a numpy array
 
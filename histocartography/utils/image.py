@@ -29,16 +29,26 @@ def pad_image(image, im_h, im_w):
     return image, last_h, last_w
 
 
+def get_patch_coords(last_h, last_w):
+    # left, bottom, right, top of the output of every window, in raster order
+    return [[col, row, col + STEP_SIZE[0], row + STEP_SIZE[1]]
+            for row in range(0, last_h, STEP_SIZE[0])
+            for col in range(0, last_w, STEP_SIZE[1])]
+
+
+def get_tissue_fractions(tissue_mask, last_h, last_w):
+    # fraction of tissue in the output of every window, in the order of get_patch_coords.
+    # the outputs of the windows tile the padded image, whose padding holds no tissue
+    mask = np.zeros((last_h, last_w), dtype=bool)
+    mask[:tissue_mask.shape[0], :tissue_mask.shape[1]] = tissue_mask > 0
+    mask = mask.reshape(last_h // STEP_SIZE[0], STEP_SIZE[0], last_w // STEP_SIZE[1], STEP_SIZE[1])
+    return (np.count_nonzero(mask, axis=(1, 3)) / (STEP_SIZE[0] * STEP_SIZE[1])).ravel()
+
+
 def extract_patches_from_image(image, im_h, im_w):
     x, last_h, last_w = pad_image(image, im_h, im_w)
-    sub_patches = []
-    coords = []
+    coords = get_patch_coords(last_h, last_w)
     # generating subpatches from original
-    for row in range(0, last_h, STEP_SIZE[0]):
-        for col in range(0, last_w, STEP_SIZE[1]):
-            win = x[row:row + WIN_SIZE[0],
-                    col:col + WIN_SIZE[1]]
-            sub_patches.append(win)
-            # left, bottom, right, top
-            coords.append([col, row, col + STEP_SIZE[0], row + STEP_SIZE[1]])
+    sub_patches = [x[row:row + WIN_SIZE[0], col:col + WIN_SIZE[1]]
+                   for col, row, _, _ in coords]
     return sub_patches, coords
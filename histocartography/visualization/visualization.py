@@ -32,6 +32,9 @@ class BaseImageVisualization(PipelineStep):
     Base visualization class
     """
 
+    # visualizations are PIL images, they are not cached
+    cacheable = False
+
     def __init__(
         self,
         instance_style: str = "outline",
@@ -161,6 +164,8 @@ class BaseGraphVisualization(PipelineStep):
     Base visualization class
     """
 
+    cacheable = False
+
     def __init__(
         self,
         instance_visualizer: BaseImageVisualization = None,
@@ -432,6 +437,8 @@ class HACTVisualization(PipelineStep):
     Hierarchical Cell to Tissue visualization class
     """
 
+    cacheable = False
+
     def __init__(
         self,
         cell_visualizer: BaseGraphVisualization = None,
@@ -9,7 +9,7 @@ from PIL import Image
 import shutil
 
 from histocartography import PipelineRunner
-from histocartography.metrics import IoU, Dice, MeanIoU, MeanDice
+from histocartography.metrics import IoU, Dice, MeanIoU, MeanDice, AggregatedJaccardIndex
 
 
 class SegmentationMetricsTestCase(unittest.TestCase):
@@ -207,6 +207,33 @@ class SegmentationMetricsTestCase(unittest.TestCase):
         self.assertLessEqual(out, 1.)
         self.assertGreaterEqual(out, 0.)
 
+    def test_aji_computation(self):
+        """
+        Test Aggregated Jaccard Index computation.
+        """
+
+        gt = np.zeros((10, 10), dtype=np.int32)
+        gt[:4, :4] = 1
+        gt[6:, 6:] = 2
+        pred = np.zeros((10, 10), dtype=np.int32)
+        pred[:4, :2] = 5
+        pred[:4, 2:4] = 7
+        pred[6:, 6:8] = 3
+        pred[0, 9] = 9
+
+        evaluator = AggregatedJaccardIndex()
+
+        # identical and relabelled instance maps
+        self.assertEqual(evaluator([gt, gt], [gt, gt]), 1.)
+        self.assertEqual(evaluator([gt * 3], [gt]), 1.)
+        self.assertEqual(evaluator([torch.from_numpy(gt)], [gt]), 1.)
+
+        # gt 1 matches 5 (8 / 16), gt 2 matches 3 (8 / 16), 7 and 9 are unmatched
+        out = evaluator([pred], [gt])
+        self.assertIsInstance(out, float)
+        self.assertAlmostEqual(out, 16 / (32 + 8 + 1))
+        self.assertEqual(evaluator([np.zeros_like(gt)], [gt]), 0.)
+
     def tearDown(self):
         """Tear down the tests."""
 
@@ -122,6 +122,61 @@ class HACTModelTestCase(unittest.TestCase):
         self.assertEqual(logits.shape[0], 1)
         self.assertEqual(logits.shape[1], 7)
 
+    def test_hact_model_with_sparse_assignment(self):
+        """Test HACT model with a batch of assignment index vectors."""
+
+        # 1. Load a cell graph and a tissue graph, and batch them
+        cell_graph, _ = load_graphs(os.path.join(
+            self.cg_graph_path, self.cg_graph_name))
+        cell_graph = cell_graph[0]
+        cell_graph = set_graph_on_cuda(cell_graph) if IS_CUDA else cell_graph
+        cg_node_dim = cell_graph.ndata['feat'].shape[1]
+
+        tissue_graph, _ = load_graphs(os.path.join(
+            self.tg_graph_path, self.tg_graph_name))
+        tissue_graph = tissue_graph[0]
+        tissue_graph = set_graph_on_cuda(
+            tissue_graph) if IS_CUDA else tissue_graph
+        tg_node_dim = tissue_graph.ndata['feat'].shape[1]
+
+        assignment = torch.randint(
+            tissue_graph.number_of_nodes(), (cell_graph.number_of_nodes(),))
+        assignment = assignment.cuda() if IS_CUDA else assignment
+        assignment_matrix = torch.nn.functional.one_hot(
+            assignment, tissue_graph.number_of_nodes()).t().float()
+
+        # 2. load config
+        config_fname = os.path.join(
+            self.current_path, 'config', 'hact_model.yml')
+        with open(config_fname, 'r') as file:
+            config = yaml.safe_load(file)
+
+        model = HACTModel(
+            cg_gnn_params=config['cg_gnn_params'],
+            tg_gnn_params=config['tg_gnn_params'],
+            classification_params=config['classification_params'],
+            cg_node_dim=cg_node_dim,
+            tg_node_dim=tg_node_dim,
+            num_classes=3
+        ).to(DEVICE)
+        model.eval()
+
+        # 3. forward pass with index vectors and with assignment matrices
+        with torch.no_grad():
+            logits = model(
+                dgl.batch([cell_graph, cell_graph]),
+                dgl.batch([tissue_graph, tissue_graph]),
+                [assignment, assignment]
+            )
+            expected_logits = model(
+                dgl.batch([cell_graph, cell_graph]),
+                dgl.batch([tissue_graph, tissue_graph]),
+                [assignment_matrix, assignment_matrix]
+            )
+
+        self.assertEqual(logits.shape, (2, 3))
+        self.assertTrue(torch.allclose(logits, expected_logits, atol=1e-5))
+
     def tearDown(self):
         """Tear down the tests."""
 
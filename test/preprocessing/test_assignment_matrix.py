@@ -53,6 +53,26 @@ class GraphBuilderTestCase(unittest.TestCase):
         # check all nuclei assigned to only one superpixel
         self.assertEqual(np.all(np.sum(assignment_matrix, axis=1) == 1), True)
 
+    def test_sparse_assignment(self):
+        """
+        Test that the sparse assignment indexes the ones of the assignment matrix.
+        """
+
+        # 1. define dummy data: nuclei centroids and tissue map
+        image_size = (1000, 1000)
+        nr_nuclei = 100
+        nuclei_centroids = [[random.randint(0, image_size[0]-1), random.randint(0, image_size[1]-1)] for _ in range(nr_nuclei)]
+        nuclei_centroids = np.asarray(nuclei_centroids)
+        tissue_map = np.asarray([np.tile(np.expand_dims(np.array([i]*100), axis=1), 100) for i in range(1, 101)])
+        tissue_map = np.squeeze(tissue_map.reshape((1, 1000, 1000)), axis=0)
+
+        # 2. build dense and sparse assignments
+        assignment_matrix = AssignmnentMatrixBuilder().process(nuclei_centroids, tissue_map)
+        assignment = AssignmnentMatrixBuilder(sparse=True).process(nuclei_centroids, tissue_map)
+
+        self.assertEqual(assignment.shape, (100,))  # check number of nuclei
+        self.assertTrue(np.array_equal(np.argmax(assignment_matrix, axis=1), assignment))
+
     def tearDown(self):
         """Tear down the tests."""
 
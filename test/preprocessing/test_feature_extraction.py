@@ -6,9 +6,27 @@ import yaml
 import os
 import torch
 import shutil
+import torchvision
 
 from histocartography import PipelineRunner
+from histocartography.preprocessing import (
+    AugmentedDeepFeatureExtractor,
+    DeepFeatureExtractor,
+    GridAugmentedDeepFeatureExtractor,
+    GridDeepFeatureExtractor,
+    H5Loader,
+    HandcraftedFeatureExtractor,
+    MaskedGridDeepFeatureExtractor,
+)
+from histocartography.preprocessing.feature_extraction import (
+    GridPatchDataset,
+    InstanceMapPatchDataset,
+    MaskedGridPatchDataset,
+    _build_augmentations,
+    _build_batch_augmentations,
+)
 from histocartography.utils import download_test_data
+from PIL import Image
 
 
 class FeatureExtractionTestCase(unittest.TestCase):
@@ -28,6 +46,9 @@ class FeatureExtractionTestCase(unittest.TestCase):
         if os.path.exists(self.out_path) and os.path.isdir(self.out_path):
             shutil.rmtree(self.out_path)
         os.makedirs(self.out_path)
+        self.random_image = np.random.default_rng(0).integers(0, 256, size=(200, 200, 3), dtype=np.uint8)
+        self.model_path = os.path.join(self.out_path, 'resnet18.pth')
+        torch.save(torchvision.models.resnet18(), self.model_path)
 
     def test_handcrafted_feature_extractor(self):
         """
@@ -62,6 +83,43 @@ class FeatureExtractionTestCase(unittest.TestCase):
 
         self.assertTrue(np.array_equal(features, reload_features))
 
+    def test_handcrafted_feature_extractor_bulk(self):
+        """
+        Test that the bulk handcrafted feature extraction matches the per-region extraction.
+        """
+        image = np.array(
+            Image.open(os.path.join(self.image_path, self.image_name)))
+        instance_map, _ = H5Loader()._process(
+            path=os.path.join(self.nuclei_map_path, self.nuclei_map_name)
+        )
+
+        bulk_features = HandcraftedFeatureExtractor().process(
+            image, instance_map)
+        features = HandcraftedFeatureExtractor(bulk=False).process(
+            image, instance_map)
+
+        self.assertEqual(bulk_features.shape, (331, 24))
+        np.testing.assert_array_equal(bulk_features.numpy(), features.numpy())
+
+        parallel_features = HandcraftedFeatureExtractor(n_jobs=2).process(
+            image, instance_map)
+        np.testing.assert_array_equal(parallel_features.numpy(), features.numpy())
+
+    def test_handcrafted_crowdedness(self):
+        """
+        Test that the KD-tree based crowdedness matches the distances to all other centroids.
+        """
+        centroids = np.random.default_rng(0).uniform(0, 1000, size=(500, 2))
+        mean_crowdedness, std_crowdedness = \
+            HandcraftedFeatureExtractor._compute_crowdedness(centroids, k=10)
+
+        dist = np.linalg.norm(
+            centroids[:, np.newaxis] - centroids[np.newaxis], axis=-1)
+        nearest = np.sort(dist, axis=1)[:, :11]
+        self.assertEqual(mean_crowdedness.shape, (500, 1))
+        self.assertTrue(np.allclose(mean_crowdedness[:, 0], nearest.mean(axis=1)))
+        self.assertTrue(np.allclose(std_crowdedness[:, 0], nearest.std(axis=1)))
+
     def test_deep_tissue_feature_extractor_noaug(self):
         """
         Test deep tissue feature extractor with pipeline runner and without augmentation.
@@ -334,6 +392,157 @@ class FeatureExtractionTestCase(unittest.TestCase):
 
         self.assertTrue(np.array_equal(features, reload_features))
 
+    def test_deep_feature_aggregation(self):
+        """
+        Test that the patch embeddings of each instance are averaged for any batch size.
+        """
+        image = self.random_image[:100, :100]
+        instance_map = np.zeros((100, 100), dtype=np.int32)
+        instance_map[10:40, 10:40] = 1
+        instance_map[50:70, 60:90] = 2
+        instance_map[90:92, 0:2] = 3  # too small to hold a patch
+
+        features = [
+            DeepFeatureExtractor(
+                architecture=self.model_path, patch_size=16, stride=4, batch_size=batch_size
+            ).process(image, instance_map)
+            for batch_size in [1, 5, 64]
+        ]
+
+        self.assertEqual(features[0].shape, (3, 512))
+        self.assertTrue(torch.all(features[0][2] == 0))
+        for batch_features in features[1:]:
+            self.assertTrue(torch.allclose(batch_features, features[0], atol=1e-5))
+
+    def test_single_pass_augmentations(self):
+        """
+        Test that embedding stacked augmentations matches reading the patches once per augmentation.
+        """
+        image = self.random_image[:64, :64]
+        instance_map = np.zeros((64, 64), dtype=np.int32)
+        instance_map[5:30, 5:30] = 1
+        instance_map[35:60, 30:60] = 2
+
+        kwargs = dict(
+            architecture=self.model_path, patch_size=16, resize_size=24,
+            rotations=[0, 90, 270], flips=['n', 'h', 'v'])
+        extractors = [
+            AugmentedDeepFeatureExtractor(stride=4, **kwargs),
+            GridAugmentedDeepFeatureExtractor(stride=16, **kwargs),
+        ]
+        for extractor, inputs in zip(extractors, [(image, instance_map), (image,)]):
+            self.assertEqual(len(extractor.batch_augmentations), 9)
+            features = extractor.process(*inputs)
+            extractor.batch_augmentations = None
+            expected_features = extractor.process(*inputs)
+            self.assertEqual(features.shape, expected_features.shape)
+            self.assertEqual(features.shape[-2:], (9, 512))
+            self.assertTrue(torch.allclose(features, expected_features, atol=1e-5))
+
+        # other rotations are applied patch by patch
+        self.assertIsNone(_build_batch_augmentations(rotations=[0, 45], flips=['n']))
+
+    def test_masked_grid_skips_background(self):
+        """
+        Test that only the patches with enough tissue are embedded.
+        """
+        image = self.random_image[:64, :64]
+        mask = np.zeros((64, 64), dtype=np.uint8)
+        mask[:20, :40] = 1
+
+        kwargs = dict(architecture=self.model_path, patch_size=16, batch_size=3)
+        index_filter, features = MaskedGridDeepFeatureExtractor(
+            tissue_thresh=0.25, **kwargs).process(image, mask)
+        grid_features = GridDeepFeatureExtractor(**kwargs).process(image)
+
+        expected_filter = np.zeros((4, 4), dtype=bool)
+        expected_filter[0, :3] = True  # tissue fractions 1, 1 and 0.5
+        expected_filter[1, :2] = True  # tissue fractions 0.25, 0.25 and 0.125
+        self.assertEqual(list(index_filter.loc['is_valid']), expected_filter.ravel().tolist())
+        self.assertEqual(features.shape, (512, 16))
+        for (h, w), is_valid in index_filter.loc['is_valid'].items():
+            if is_valid:
+                self.assertTrue(np.allclose(features[(h, w)], grid_features[h, w].numpy(), atol=1e-5))
+            else:
+                self.assertTrue(np.all(features[(h, w)] == 0))
+
+    def test_instance_map_patches(self):
+        """
+        Test the patches enumerated around each instance.
+        """
+        rng = np.random.default_rng(0)
+        instance_map = np.zeros((150, 120), dtype=np.int32)
+        for label in range(1, 30):
+            y, x = rng.integers(0, 140, size=2)
+            h, w = rng.integers(5, 30, size=2)
+            instance_map[y:y + h, x:x + w] = label
+        image = np.zeros((150, 120, 3), dtype=np.uint8)
+
+        dataset = InstanceMapPatchDataset(
+            image=image, instance_map=instance_map, patch_size=15, stride=3)
+        padded_map = np.pad(instance_map, 15)
+
+        self.assertGreater(len(dataset), 0)
+        self.assertEqual(len(dataset.patch_coordinates), len(dataset.patch_instance_ids))
+        for (x, y), region_count, label, overlap in zip(
+                dataset.patch_coordinates,
+                dataset.patch_region_count,
+                dataset.patch_instance_ids,
+                dataset.patch_overlap):
+            self.assertEqual(dataset.regions.labels[region_count], label)
+            self.assertAlmostEqual(overlap * 15 * 15, np.sum(padded_map[y:y + 14, x:x + 14] == label))
+            self.assertGreater(overlap, 0.25)
+        # patches are on a grid anchored at the centroids
+        centroids = np.round(dataset.regions.centroids[dataset.patch_region_count] + 15).astype(int)
+        self.assertTrue(np.all((dataset.patch_coordinates[:, ::-1] + 7 - centroids) % 3 == 0))
+
+    def test_batched_patch_datasets(self):
+        """
+        Test that the batched patch datasets match the datasets transforming patch by patch.
+        """
+        image = self.random_image
+        instance_map = np.zeros((200, 200), dtype=np.int32)
+        for label in range(1, 9):
+            instance_map[22 * label - 20:22 * label, 22 * label - 20:22 * label] = label
+        mask = np.zeros((200, 200, 1), dtype=np.uint8)
+        mask[:100] = 1
+        transform = _build_augmentations(
+            rotations=[45], flips=['h'], padding=32, fill_value=255, output_size=(32, 32))[0]
+        kwargs = dict(
+            patch_size=32,
+            mean=[0.485, 0.456, 0.406],
+            std=[0.229, 0.224, 0.225],
+        )
+
+        def collate_all(dataset):
+            return dataset.collate([dataset[i] for i in range(len(dataset))])
+
+        for resize_size in [None, 64]:
+            # resizing on tensors is off by at most one intensity level
+            tolerance = 1e-5 if resize_size is None else 1.01 / (255 * 0.224)
+            datasets = [
+                InstanceMapPatchDataset(
+                    image=image,
+                    instance_map=instance_map,
+                    stride=8,
+                    resize_size=resize_size,
+                    transform=transform,
+                    with_instance_masking=True,
+                    **kwargs),
+                GridPatchDataset(
+                    image=image, stride=32, resize_size=resize_size, transform=transform, **kwargs),
+                MaskedGridPatchDataset(
+                    image=image, mask=mask, stride=32, resize_size=resize_size, **kwargs),
+            ]
+            for dataset in datasets:
+                expected = collate_all(dataset)
+                dataset.batched = True
+                output = collate_all(dataset)
+                self.assertEqual(output[0], expected[0])
+                for tensor, expected_tensor in zip(output[1:], expected[1:]):
+                    self.assertEqual(tensor.shape, expected_tensor.shape)
+                    self.assertLessEqual((tensor.float() - expected_tensor.float()).abs().max(), tolerance)
+
     def tearDown(self):
         """Tear down the tests."""
 
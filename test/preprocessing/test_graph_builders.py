@@ -7,6 +7,7 @@ import torch
 from PIL import Image
 import shutil
 import dgl
+import cv2
 
 from histocartography import PipelineRunner
 from histocartography.preprocessing import DeepFeatureExtractor
@@ -229,6 +230,74 @@ class GraphBuilderTestCase(unittest.TestCase):
             graph.number_of_edges(),
             1655)  # check number of edges
 
+    def test_knn_builder_topology(self):
+        """
+        Test that the KD-tree based KNN builder matches a dense kNN adjacency, also when centroids are tied.
+        """
+        h5_loader = H5Loader()
+        instance_map, _ = h5_loader._process(
+            path=os.path.join(
+                self.nuclei_map_path,
+                self.nuclei_map_name
+            )
+        )
+        features = torch.zeros((331, 1))
+
+        knn_builder = KNNGraphBuilder(k=5, thresh=50)
+        graph = knn_builder.process(instance_map, features)
+
+        # dense kNN adjacency, neighbors at equal distances taken by increasing index
+        centroids = graph.ndata['centroid'].numpy().astype(np.float64)
+        distances = np.linalg.norm(centroids[:, np.newaxis] - centroids[np.newaxis], axis=2)
+        np.fill_diagonal(distances, np.inf)
+        candidates = np.broadcast_to(np.arange(len(centroids)), distances.shape)
+        neighbors = np.lexsort((candidates, distances))[:, :5]
+        adj = np.zeros(distances.shape)
+        np.put_along_axis(adj, neighbors, np.take_along_axis(distances, neighbors, axis=1), axis=1)
+        adj[adj > 50] = 0
+        src, dst = graph.edges()
+        expected_src, expected_dst = np.nonzero(adj)
+        self.assertTrue(np.array_equal(src.numpy(), expected_src))
+        self.assertTrue(np.array_equal(dst.numpy(), expected_dst))
+
+        # check the position features against a per-node average
+        centroids = graph.ndata['centroid'].numpy()
+        average_distances = np.stack([
+            np.abs(centroids[graph.successors(node).numpy()] - centroids[node]).mean(axis=0)
+            for node in range(graph.num_nodes())
+        ])
+        average_distances = (average_distances - average_distances.min(axis=0)) / \
+            (average_distances.max(axis=0) - average_distances.min(axis=0))
+        self.assertTrue(np.allclose(
+            graph.ndata['position'][:, 2:].numpy(), average_distances, atol=1e-6))
+
+    def test_rag_builder_topology(self):
+        """
+        Test that the RAG builder matches the adjacency of dilated instances.
+        """
+        h5_loader = H5Loader()
+        instance_map, _ = h5_loader._process(
+            path=os.path.join(
+                self.nuclei_map_path,
+                self.nuclei_map_name
+            )
+        )
+        features = torch.zeros((331, 1))
+
+        rag_builder = RAGGraphBuilder(kernel_size=5)
+        graph = rag_builder.process(instance_map, features)
+
+        kernel = np.ones((5, 5), np.uint8)
+        adj = np.zeros((331, 331))
+        for instance_id in range(1, 332):
+            mask = (instance_map == instance_id).astype(np.uint8)
+            boundary = cv2.dilate(mask, kernel, iterations=1) - mask
+            adj[instance_id - 1, np.unique(instance_map[boundary.astype(bool)]) - 1] = 1
+        src, dst = graph.edges()
+        expected_src, expected_dst = np.nonzero(adj)
+        self.assertTrue(np.array_equal(src.numpy(), expected_src))
+        self.assertTrue(np.array_equal(dst.numpy(), expected_dst))
+
     def tearDown(self):
         """Tear down the tests."""
 
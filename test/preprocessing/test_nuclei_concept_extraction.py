@@ -88,6 +88,39 @@ class NucleiConceptExtractionTestCase(unittest.TestCase):
         # check number of node features
         self.assertEqual(concepts.shape[1], 2)
 
+        # 4. the lazily computed concepts match the columns of all concepts
+        all_concepts = NucleiConceptExtractor().process(image, instance_map)
+        self.assertTrue(
+            np.array_equal(concepts, all_concepts[:, [0, 2]]))
+
+    def test_concept_extractor_parallel(self):
+        """Test nuclei concept extraction with a pool of workers."""
+
+        # 1. load an image
+        image = np.array(
+            Image.open(
+                os.path.join(
+                    self.image_path,
+                    self.image_name)))
+
+        # 2. load nuclei
+        h5_loader = H5Loader()
+        instance_map, instance_centroids = h5_loader._process(
+            path=os.path.join(
+                self.nuclei_map_path,
+                self.nuclei_map_name
+            )
+        )
+
+        # 3. extract nuclei concepts with and without workers
+        concepts = NucleiConceptExtractor().process(image, instance_map)
+        for parallel_backend in ['processes', 'threads']:
+            nuclei_concept_extractor = NucleiConceptExtractor(
+                n_jobs=2, parallel_backend=parallel_backend)
+            parallel_concepts = nuclei_concept_extractor.process(image, instance_map)
+            # same concepts in the same (label) order
+            self.assertTrue(np.array_equal(concepts, parallel_concepts))
+
     def tearDown(self):
         """Tear down the tests."""
 
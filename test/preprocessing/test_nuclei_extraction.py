@@ -10,6 +10,11 @@ import yaml
 
 from histocartography import PipelineRunner
 from histocartography.preprocessing import NucleiExtractor
+from histocartography.preprocessing.nuclei_extraction import (
+    ImageToPatchDataset,
+    process_np_hv_channels,
+    process_np_hv_channels_tiled,
+)
 from histocartography.utils import download_test_data
 
 
@@ -115,6 +120,118 @@ class NucleiExtractionTestCase(unittest.TestCase):
         self.assertEqual(instance_map.shape[1], image.shape[1])
         self.assertEqual(len(instance_centroids), 331)
 
+    def test_nuclei_extractor_tiled(self):
+        """Test nuclei extraction tile by tile."""
+
+        # 1. load an image
+        image = np.array(
+            Image.open(
+                os.path.join(
+                    self.image_path,
+                    self.image_name)))
+
+        # 2. extract nuclei on a single tile and on small tiles
+        extractor = NucleiExtractor(
+            tile_size=max(image.shape)
+        )
+        instance_map, instance_centroids = extractor.process(image.copy())
+        self.assertEqual(len(instance_centroids), 331)
+        self.assertEqual(instance_map.dtype, np.uint16)
+
+        extractor = NucleiExtractor(
+            tile_size=256,
+            tile_overlap=64
+        )
+        instance_map, instance_centroids = extractor.process(image.copy())
+
+        # 3. run tests
+        self.assertEqual(instance_map.shape[0], image.shape[0])
+        self.assertEqual(instance_map.shape[1], image.shape[1])
+        self.assertEqual(instance_map.dtype, np.uint16)
+        labels = np.unique(instance_map)
+        self.assertTrue(np.array_equal(labels[1:], np.arange(1, len(instance_centroids) + 1)))
+        for label, (x, y) in enumerate(instance_centroids, start=1):
+            mask = instance_map == label
+            self.assertAlmostEqual(x, np.nonzero(mask)[1].mean(), delta=0.5)
+            self.assertAlmostEqual(y, np.nonzero(mask)[0].mean(), delta=0.5)
+
+    def test_nuclei_extractor_cache_key(self):
+        """Test that the execution parameters changing the output are part of the stage cache key."""
+
+        config_fname = os.path.join(
+            self.current_path,
+            'config',
+            'nuclei_extraction',
+            'nuclei_extractor.yml')
+        cache_path = os.path.join(self.out_path, 'cache')
+
+        # 1. extract nuclei without and with tiling, skipping windows and reduced precision
+        for params, nr_misses in [
+            ({}, 1),
+            ({'tile_size': 256, 'tile_overlap': 64}, 1),
+            ({'tile_size': 256, 'tile_overlap': 64}, 0),
+            ({'tile_size': 256, 'tile_overlap': 64, 'min_tissue_fraction': 0.5}, 1),
+            ({'tile_size': 256, 'tile_overlap': 64, 'min_tissue_fraction': 0.5, 'precision': 'bf16'}, 1),
+        ]:
+            with open(config_fname, 'r') as file:
+                config = yaml.safe_load(file)
+            config['stages'][1]['preprocessing']['params'].update(params)
+            pipeline = PipelineRunner(cache_path=cache_path, **config)
+            pipeline.run(
+                output_name=self.image_name.replace('.png', ''),
+                image_path=os.path.join(self.image_path, self.image_name)
+            )
+
+            # 2. run tests
+            self.assertEqual(pipeline.cache.nr_misses, nr_misses)
+            self.assertEqual(pipeline.cache.nr_hits, 1 - nr_misses)
+            self.assertEqual(
+                pipeline.stages[1].cache_id,
+                NucleiExtractor.__name__ + '(pretrained_data=pannuke)')
+
+    def test_patch_dataset_with_tissue_mask(self):
+        """Test that windows without enough tissue are skipped."""
+
+        image = np.full((500, 400, 3), 255, dtype=np.uint8)
+        tissue_mask = np.zeros((500, 400), dtype=np.uint8)
+        tissue_mask[:100, :100] = 1
+
+        dataset = ImageToPatchDataset(image)
+        masked_dataset = ImageToPatchDataset(image, tissue_mask, min_tissue_fraction=0.1)
+
+        self.assertEqual(len(dataset), 12)
+        self.assertEqual(len(masked_dataset), 1)
+        self.assertEqual(len(masked_dataset.skipped_coords), 11)
+        coord, patch = masked_dataset[0]
+        self.assertEqual(coord, [0, 0, 164, 164])
+        self.assertEqual(patch.shape, (3, 256, 256))
+
+    def test_tiled_post_processing(self):
+        """Test that the tiled post-processing matches the whole image."""
+
+        # 1. simulate a prediction with touching nuclei
+        rng = np.random.default_rng(0)
+        nuclei = np.zeros((400, 300), dtype=np.int32)
+        for label in range(1, 201):
+            y, x = rng.integers(0, 400), rng.integers(0, 300)
+            cv2.circle(nuclei, (int(x), int(y)), int(rng.integers(4, 10)), label, -1)
+        rows, cols = np.nonzero(nuclei)
+        ids = nuclei[rows, cols]
+        areas = np.maximum(np.bincount(ids, minlength=201), 1)
+        pred = np.zeros((400, 300, 3), dtype=np.float32)
+        pred[:, :, 0] = nuclei > 0
+        pred[rows, cols, 1] = (cols - np.bincount(ids, cols, 201)[ids] / areas[ids]) / 10
+        pred[rows, cols, 2] = (rows - np.bincount(ids, rows, 201)[ids] / areas[ids]) / 10
+
+        # 2. post-process the whole image and tiles
+        instance_map = process_np_hv_channels(pred)
+        tiled_instance_map = process_np_hv_channels_tiled(
+            pred, tile_size=96, halo=16, n_jobs=2, parallel_backend="threads")
+
+        # 3. run tests
+        self.assertGreater(len(np.unique(instance_map)), 100)
+        self.assertTrue(np.array_equal(instance_map, tiled_instance_map))
+
     def tearDown(self):
         """Tear down the tests."""
 
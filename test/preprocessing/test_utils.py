@@ -0,0 +1,130 @@
+"""Unit test for preprocessing.utils"""
+import os
+import tempfile
+import unittest
+import numpy as np
+import torch
+from skimage.measure import regionprops
+
+from histocartography.preprocessing.graph_builders import KNNGraphBuilder
+from preprocessing.utils import (
+    NeighborIndex,
+    RegionIndex,
+    clear_model_cache,
+    export_model,
+    get_cached_model,
+    load_model,
+)
+
+
+class UtilsTestCase(unittest.TestCase):
+    """UtilsTestCase class."""
+
+    @classmethod
+    def setUpClass(self):
+        rng = np.random.default_rng(0)
+        self.instance_map = np.zeros((128, 128), dtype=np.int32)
+        for label in rng.choice(np.arange(1, 1000), size=40, replace=False):
+            y, x = rng.integers(0, 120, size=2)
+            h, w = rng.integers(2, 9, size=2)
+            self.instance_map[y:y + h, x:x + w] = label
+
+    def test_region_index(self):
+        """
+        Test that the region index matches regionprops.
+        """
+        regions = regionprops(self.instance_map)
+        index = RegionIndex(self.instance_map)
+
+        self.assertEqual(index.nr_instances, len(regions))
+        self.assertTrue(np.array_equal(index.labels, [r.label for r in regions]))
+        self.assertTrue(np.array_equal(index.areas, [r.area for r in regions]))
+        self.assertTrue(np.array_equal(index.centroids, [r.centroid for r in regions]))
+        self.assertTrue(np.array_equal(index.bboxes, [r.bbox for r in regions]))
+        for i, region in enumerate(regions):
+            rows, cols = index.pixels(i)
+            self.assertTrue(np.array_equal(np.stack([rows, cols], axis=1), region.coords))
+
+    def test_region_index_is_shared(self):
+        """
+        Test that the region index is computed once per instance map.
+        """
+        instance_map = self.instance_map.copy()
+        index = RegionIndex.of(instance_map)
+        self.assertIs(RegionIndex.of(instance_map), index)
+        self.assertIsNot(RegionIndex.of(instance_map.copy()), index)
+
+        # a graph builder reuses the index of the instance map
+        centroids = KNNGraphBuilder()._get_node_centroids(instance_map)
+        self.assertTrue(np.array_equal(centroids, np.round(index.centroids[:, ::-1])))
+
+    def test_neighbor_index_with_ties(self):
+        """
+        Test that neighbors at equal distances are taken by increasing index.
+        """
+        # regular lattice of nuclei, where most neighbors are tied
+        instance_map = np.zeros((60, 60), dtype=np.int32)
+        for label, (y, x) in enumerate(np.ndindex(6, 6), start=1):
+            instance_map[10 * y + 3:10 * y + 7, 10 * x + 3:10 * x + 7] = label
+        centroids = KNNGraphBuilder()._get_node_centroids(instance_map)
+        distances = np.linalg.norm(centroids[:, np.newaxis] - centroids[np.newaxis], axis=2)
+        np.fill_diagonal(distances, np.inf)
+        candidates = np.broadcast_to(np.arange(len(centroids)), distances.shape)
+
+        for k in range(1, 10):
+            _, neighbors = NeighborIndex(centroids).query(k, include_self=False)
+            expected = np.lexsort((candidates, distances))[:, :k]
+            self.assertTrue(np.array_equal(neighbors, expected))
+
+        # the kNN graph follows the same order
+        graph = KNNGraphBuilder(k=3)._process(
+            instance_map, torch.zeros((len(centroids), 1)))
+        src, dst = graph.edges()
+        expected = np.lexsort((candidates, distances))[:, :3]
+        self.assertTrue(np.array_equal(src.numpy(), np.repeat(np.arange(len(centroids)), 3)))
+        self.assertTrue(np.array_equal(dst.numpy(), np.sort(expected, axis=1).ravel()))
+
+    def test_model_cache(self):
+        """
+        Test that a model is loaded once per key.
+        """
+        loads = []
+
+        def loader():
+            loads.append(1)
+            return torch.nn.Linear(2, 2)
+
+        model = get_cached_model(("linear", "cpu"), loader)
+        self.assertIs(get_cached_model(("linear", "cpu"), loader), model)
+        self.assertIsNot(get_cached_model(("linear", "cuda:0"), loader), model)
+        self.assertEqual(len(loads), 2)
+        clear_model_cache()
+        self.assertIsNot(get_cached_model(("linear", "cpu"), loader), model)
+
+    def test_export_model(self):
+        """
+        Test that an exported model gives the outputs of the model, for any batch size.
+        """
+        model = torch.nn.Sequential(
+            torch.nn.Conv2d(3, 4, 3), torch.nn.ReLU(), torch.nn.AdaptiveAvgPool2d(1))
+        inputs = torch.rand(5, 3, 16, 16)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            traced_path = os.path.join(tmp_dir, "traced.pt")
+            pickled_path = os.path.join(tmp_dir, "pickled.pt")
+            export_model(model, torch.zeros(1, 3, 16, 16), traced_path)
+            torch.save(model, pickled_path)
+            traced_model = load_model(traced_path)
+            pickled_model = load_model(pickled_path)
+
+        self.assertIsInstance(traced_model, torch.jit.ScriptModule)
+        self.assertNotIsInstance(pickled_model, torch.jit.ScriptModule)
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(traced_model(inputs), model(inputs)))
+            self.assertTrue(torch.equal(pickled_model(inputs), model(inputs)))
+
+    def tearDown(self):
+        """Tear down the tests."""
+
+
+if __name__ == "__main__":
+    unittest.main()
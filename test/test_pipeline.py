@@ -0,0 +1,217 @@
+"""Unit test for pipeline"""
+import unittest
+import h5py
+import numpy as np
+import pandas as pd
+import yaml
+import os
+import shutil
+from PIL import Image
+
+from histocartography import PipelineRunner, BatchPipelineRunner
+
+
+class PipelineTestCase(unittest.TestCase):
+    """PipelineTestCase class."""
+
+    @classmethod
+    def setUpClass(self):
+        self.current_path = os.path.dirname(__file__)
+        self.data_path = os.path.join(self.current_path, 'data')
+        self.config_fname = os.path.join(
+            self.current_path,
+            'preprocessing',
+            'config',
+            'tissue_mask',
+            'tissue_mask.yml')
+        self.out_path = os.path.join(self.data_path, 'pipeline_test')
+        if os.path.exists(self.out_path) and os.path.isdir(self.out_path):
+            shutil.rmtree(self.out_path)
+        os.makedirs(self.out_path)
+
+        # dummy image: dark tissue-like disk on a bright background
+        image = np.full((256, 256, 3), 235, dtype=np.uint8)
+        yy, xx = np.mgrid[:256, :256]
+        image[(yy - 128) ** 2 + (xx - 128) ** 2 < 80 ** 2] = (150, 60, 140)
+        self.image_path = os.path.join(self.out_path, 'dummy.png')
+        Image.fromarray(image).save(self.image_path)
+
+    def _get_metadata(self, nr_items):
+        """Build a metadata dataframe that lists the same image multiple times."""
+        image_path = self.image_path
+        return pd.DataFrame(
+            {'image_path': [image_path] * nr_items},
+            index=['item_{}'.format(i) for i in range(nr_items)]
+        )
+
+    def test_batch_pipeline_runner_with_persistent_workers(self):
+        """
+        Test batch pipeline runner where each worker builds its pipeline once.
+        """
+        with open(self.config_fname, 'r') as file:
+            config = yaml.safe_load(file)
+
+        save_path = os.path.join(self.out_path, 'persistent')
+        os.makedirs(save_path)
+        runner = BatchPipelineRunner(
+            pipeline_config=config,
+            save_path=save_path,
+            persistent_workers=True
+        )
+        runner.run(metadata=self._get_metadata(4), cores=2)
+
+        # every item is processed and timed
+        self.assertEqual(
+            sorted(runner.item_times.keys()),
+            ['item_{}'.format(i) for i in range(4)]
+        )
+        # each worker reports its warm-up exactly once
+        self.assertTrue(1 <= len(runner.warmup_times) <= 2)
+
+    def test_batch_pipeline_runner_single_core(self):
+        """
+        Test batch pipeline runner on a single core with returned outputs.
+        """
+        with open(self.config_fname, 'r') as file:
+            config = yaml.safe_load(file)
+
+        save_path = os.path.join(self.out_path, 'single_core')
+        os.makedirs(save_path)
+        runner = BatchPipelineRunner(
+            pipeline_config=config,
+            save_path=save_path
+        )
+        out = runner.run(
+            metadata=self._get_metadata(2),
+            cores=1,
+            return_out=True)
+
+        self.assertEqual(len(out), 2)
+        self.assertEqual(len(runner.warmup_times), 1)
+        self.assertEqual(len(runner.item_times), 2)
+        self.assertTrue('tissue_mask' in out['item_0'])
+
+    def test_batch_pipeline_runner_with_consolidated_storage(self):
+        """
+        Test that concurrent workers append the outputs of all images to one store per stage.
+        """
+        with open(self.config_fname, 'r') as file:
+            config = yaml.safe_load(file)
+
+        save_path = os.path.join(self.out_path, 'consolidated')
+        os.makedirs(save_path)
+        runner = BatchPipelineRunner(
+            pipeline_config=config,
+            save_path=save_path,
+            persistent_workers=True,
+            storage='consolidated'
+        )
+        runner.run(metadata=self._get_metadata(4), cores=2)
+
+        # a single store holds the outputs of all images
+        pipeline = runner._build_pipeline_runner()
+        store = pipeline.stages[-1].store
+        self.assertEqual(
+            sorted(store.keys()),
+            ['item_{}'.format(i) for i in range(4)]
+        )
+        self.assertEqual(
+            [f for f in os.listdir(pipeline.final_path) if f.endswith('.png')],
+            []
+        )
+
+        # random access by output name
+        output = pipeline.run(output_name='item_2', image_path=self.image_path)
+        self.assertTrue(
+            np.array_equal(
+                output['tissue_mask'],
+                store.read(pipeline.stages[-1], 'item_2')
+            )
+        )
+
+    def test_pipeline_runner_with_stage_cache(self):
+        """
+        Test that the stage cache is keyed on the stage parameters and inputs.
+        """
+        cache_path = os.path.join(self.out_path, 'cache')
+
+        # 1. first run computes and caches the tissue mask
+        with open(self.config_fname, 'r') as file:
+            config = yaml.safe_load(file)
+        pipeline = PipelineRunner(cache_path=cache_path, **config)
+        output = pipeline.run(output_name='dummy', image_path=self.image_path)
+        self.assertEqual(pipeline.cache.nr_misses, 1)
+        self.assertEqual(pipeline.cache.nr_hits, 0)
+
+        # 2. re-run with a new runner reuses the cached output
+        with open(self.config_fname, 'r') as file:
+            config = yaml.safe_load(file)
+        pipeline = PipelineRunner(cache_path=cache_path, **config)
+        reload_output = pipeline.run(output_name='dummy', image_path=self.image_path)
+        self.assertEqual(pipeline.cache.nr_misses, 0)
+        self.assertEqual(pipeline.cache.nr_hits, 1)
+        self.assertTrue(
+            np.array_equal(output['tissue_mask'], reload_output['tissue_mask'])
+        )
+
+        # 3. changing a stage parameter invalidates the cached output
+        with open(self.config_fname, 'r') as file:
+            config = yaml.safe_load(file)
+        config['stages'][1]['preprocessing']['params']['kernel_size'] = 10
+        pipeline = PipelineRunner(cache_path=cache_path, **config)
+        pipeline.run(output_name='dummy', image_path=self.image_path)
+        self.assertEqual(pipeline.cache.nr_misses, 1)
+        self.assertEqual(len(pipeline.cache), 2)
+
+    def test_pipeline_runner_with_stage_cache_and_output_path(self):
+        """
+        Test that cached stage outputs are also saved to the output directory.
+        """
+        cache_path = os.path.join(self.out_path, 'cache_with_output')
+
+        # 1. on a cache miss and on a cache hit, the tissue mask is saved
+        for i, nr_hits in enumerate([0, 1]):
+            with open(self.config_fname, 'r') as file:
+                config = yaml.safe_load(file)
+            output_path = os.path.join(self.out_path, 'cached_output_{}'.format(i))
+            os.makedirs(output_path)
+            pipeline = PipelineRunner(
+                output_path=output_path, cache_path=cache_path, **config)
+            output = pipeline.run(output_name='dummy', image_path=self.image_path)
+            self.assertEqual(pipeline.cache.nr_hits, nr_hits)
+
+            # 2. run tests
+            fname = os.path.join(pipeline.final_path, 'dummy.png')
+            self.assertTrue(os.path.isfile(fname))
+            self.assertTrue(
+                np.array_equal(np.array(Image.open(fname)), output['tissue_mask'])
+            )
+
+    def test_pipeline_runner_with_compression_options(self):
+        """
+        Test that the compression options of a stage are applied to its saved outputs.
+        """
+        with open(self.config_fname, 'r') as file:
+            config = yaml.safe_load(file)
+        config['stages'][1]['preprocessing']['params'].update(
+            compression='lzf', shuffle=True
+        )
+
+        pipeline = PipelineRunner(**config)
+        output = pipeline.run(image_path=self.image_path)
+
+        fname = os.path.join(self.out_path, 'compression.h5')
+        with h5py.File(fname, 'w') as f:
+            pipeline.stages[-1]._set_outputs(f, output['tissue_mask'])
+        with h5py.File(fname, 'r') as f:
+            dataset = f['default_key_0']
+            self.assertEqual(dataset.compression, 'lzf')
+            self.assertTrue(dataset.shuffle)
+            self.assertTrue(np.array_equal(dataset[()], output['tissue_mask']))
+
+    def tearDown(self):
+        """Tear down the tests."""
+
+
+if __name__ == "__main__":
+    unittest.main()